@@ -0,0 +1,177 @@
+'''
+MIT License
+
+Copyright (c) 2024 Mo Zhou <lumin@debian.org>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+from typing import Callable, List, Optional, Tuple
+import re
+import rich
+from . import defaults
+from .tokens import estimate_tokens
+console = rich.get_console()
+
+__doc__ = '''
+Fit the information gathered from various sources into the context window
+of the target model. Every source block is measured in tokens. When the
+whole prompt does not fit, the largest blocks are truncated to their fair
+share of the budget, following a per-source policy about which part of the
+text matters the most.
+'''
+
+# fraction of the kept lines that is taken from the head of a block. The
+# rest is taken from its tail. e.g., the newest BTS messages and the end of
+# command outputs (where the errors are) are more relevant than the middle.
+HEAD_FRACTION = {
+    'bts': 0.2,
+    'buildd': 0.5,
+    'cmd': 0.2,
+    'file': 0.5,
+    'man': 0.5,
+    'tldr': 0.5,
+    'html': 1.0,
+    'archw': 1.0,
+    'pynew': 1.0,
+    'policy': 1.0,
+    'devref': 1.0,
+    'policy_search': 1.0,
+    'devref_search': 1.0,
+}
+
+# tokens reserved for the reply of LLM
+REPLY_RESERVE = 1024
+
+
+def context_window(ag) -> Optional[int]:
+    '''
+    the context window of the target model, or None if unknown.
+    --context_window overrides the built-in table. With the ZMQ frontend,
+    the model is the one the backend runs.
+    '''
+    if ag.context_window > 0:
+        return ag.context_window
+    if ag.frontend == 'openai':
+        model = ag.openai_model
+    elif ag.frontend == 'zmq' and getattr(ag, 'frontend_instance', None):
+        model = ag.frontend_instance.info().get('llm', None)
+    else:
+        return None
+    window = defaults.CONTEXT_WINDOWS.get(model, None)
+    if window is None and model not in _unknown:
+        _unknown.add(model)
+        console.log(f'warning! the context window of {model} is unknown, so'
+                    + ' the gathered information is not truncated. Set it'
+                    + ' with --context_window.')
+    return window
+
+
+# the models whose context window is unknown, warned about once
+_unknown = set()
+
+
+def prompt_budget(ag, fixed: str = '',
+                  count: Callable[[str], int] = estimate_tokens) -> Optional[int]:
+    '''
+    number of tokens available for the gathered information, given the
+    fixed part of the prompt (system message, question, etc.)
+    '''
+    window = context_window(ag)
+    if window is None:
+        return None
+    reserve = min(REPLY_RESERVE, window // 4)
+    return max(0, window - reserve - count(fixed))
+
+
+def allocate(sizes: List[int], budget: int) -> List[int]:
+    '''
+    water-filling: blocks smaller than the fair share are kept in full, and
+    the remaining budget is split evenly among the larger ones.
+    '''
+    caps = list(sizes)
+    remaining, pending = budget, len(sizes)
+    for i in sorted(range(len(sizes)), key=lambda i: sizes[i]):
+        share = remaining // pending
+        caps[i] = min(sizes[i], share)
+        remaining -= caps[i]
+        pending -= 1
+    return caps
+
+
+def split_fences(text: str) -> Tuple[List[str], List[str], List[str]]:
+    '''
+    split the lines of a block into the caption with the opening markdown
+    fence, the content, and the closing fence with what follows.
+    '''
+    lines = text.split('\n')
+    fences = [i for (i, x) in enumerate(lines) if re.match(r'^```', x)]
+    if len(fences) >= 2:
+        return lines[:fences[0] + 1], lines[fences[0] + 1:fences[-1]], \
+            lines[fences[-1]:]
+    return [], lines, []
+
+
+def truncate(text: str, max_tokens: int, head: float = 0.5,
+             count: Callable[[str], int] = estimate_tokens) -> str:
+    '''
+    drop lines from the middle of a block so that it fits in max_tokens.
+    The caption and the markdown fences around the content are kept.
+    '''
+    prologue, body, epilogue = split_fences(text)
+    budget = max_tokens - count('\n'.join(prologue + epilogue)) - 16
+    budget_head = int(budget * head)
+    budget_tail = budget - budget_head
+    kept_head, kept_tail = [], []
+    for line in body:
+        budget_head -= count(line) + 1
+        if budget_head < 0:
+            break
+        kept_head.append(line)
+    for line in reversed(body[len(kept_head):]):
+        budget_tail -= count(line) + 1
+        if budget_tail < 0:
+            break
+        kept_tail.append(line)
+    omitted = len(body) - len(kept_head) - len(kept_tail)
+    if omitted <= 0:
+        return text
+    marker = f'[... {omitted} lines omitted to fit the context window ...]'
+    return '\n'.join(prologue + kept_head + [marker]
+                     + kept_tail[::-1] + epilogue)
+
+
+def fit(blocks: List[Tuple[str, str]], budget: int,
+        count: Callable[[str], int] = estimate_tokens) -> List[str]:
+    '''
+    blocks: list of (source key, text), e.g., ('bts', '...').
+    count: function counting the tokens of a text.
+    returns the texts, truncated when needed so that they fit in budget.
+    '''
+    sizes = [count(text) for (_, text) in blocks]
+    if sum(sizes) <= budget:
+        return [text for (_, text) in blocks]
+    caps = allocate(sizes, budget)
+    ret = []
+    for (key, text), size, cap in zip(blocks, sizes, caps):
+        if size > cap:
+            console.log(f'assembler> truncating --{key} from ~{size} to '
+                        + f'~{cap} tokens to fit the context window.')
+            text = truncate(text, cap, HEAD_FRACTION.get(key, 0.5), count)
+        ret.append(text)
+    return ret
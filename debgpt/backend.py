@@ -22,18 +22,46 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 '''
 from rich.status import Status
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple, Union
+from collections import OrderedDict
 import argparse
+import json
+import os
+import time
 import zmq
-from . import llm
+from . import tokens
 import rich
-import torch as th
 console = rich.get_console()
 
 
+def _check(messages: List[Dict]) -> None:
+    '''
+    messages are dicts with a role and a text content
+    '''
+    if not isinstance(messages, list) or not all(
+            isinstance(x, dict) and isinstance(x.get('role'), str)
+            and isinstance(x.get('content'), str) for x in messages):
+        raise ValueError('messages must be a list of {"role", "content"}')
+    if not messages:
+        raise ValueError('no messages')
+
+
 class AbstractBackend:
-    def __init__(self, args):
-        self.llm = llm.create_llm(args)
+    def __init__(self, args, model=None):
+        '''
+        model: the LLM instance. By default, it is created from args.
+        '''
+        if model is None:
+            from . import llm
+            model = llm.create_llm(args)
+        self.llm = model
+        if args.kv_cache > 0:
+            self.llm.enable_kv_cache(args.kv_cache * 2**20)
+        if args.prefix_cache > 0:
+            self.llm.enable_prefix_cache(args.prefix_cache * 2**20)
+        # cached token counting for the console log
+        self.token_counter = tokens.TokenCounter(lambda: (
+            lambda text: self.llm.tok.encode(text, add_special_tokens=False)))
 
     def listen(self, args):
         raise NotImplementedError
@@ -42,41 +70,233 @@ class AbstractBackend:
         raise NotImplementedError
 
 
-def stat_messages(messages: List[Dict], llm):
-    context_size = llm.tok.apply_chat_template(messages, tokenize=True,
-                                               return_tensors='pt').size(1)
+def stat_messages(messages: List[Dict], counter: tokens.TokenCounter):
+    context_size = counter(messages)
     ret = f'num_msgs={len(messages)}, ctx_size={context_size}; '
     ret += f'latest={messages[-1]}'
     return ret
 
 
 class ZMQBackend(AbstractBackend):
-    def __init__(self, args):
-        super().__init__(args)
-        self.socket = zmq.Context().socket(zmq.REP)
+    '''
+    The backend listens on a ROUTER socket, which serves the REQ sockets of
+    the frontends just like a REP socket would, but can take requests from
+    several clients at the same time. Requests arriving within the batching
+    window (--batch_window milliseconds, at most --batch_size of them) are
+    processed by LLM as one padded batch.
+
+    Protocol. A request is either a list of messages, or a dict
+    {'messages': [...], 'stream': bool}. The reply is the list of messages
+    with the new LLM message appended, in a single frame. For streaming
+    requests, the reply is preceded by [b'token', text] multipart messages,
+    one for each piece of generated text. When several requests arrive in
+    the same batching window, streaming ones included, they are generated
+    together, and each streaming request gets its whole text as one token.
+    So clients are not served one after another; a lone request is still
+    streamed piece by piece.
+
+    When the request dict carries the 'uuid' of the conversation and a 'seq'
+    number, the backend keeps the conversation, so that 'messages' only
+    contains the messages after the first 'seq' ones. The reply is then
+    {'seq': int, 'message': {...}} with only the new LLM message. If 'seq'
+    does not match the kept conversation, the reply is {'resync': true}, and
+    the client should send the whole conversation with seq = 0.
+
+    The request {'info': true} is answered with the model and its generation
+    settings (see info()).
+    '''
+    # maximum number of conversations kept in memory
+    max_sessions: int = 256
+
+    def __init__(self, args, model=None):
+        super().__init__(args, model)
+        self.batch_size = args.batch_size
+        self.batch_window = args.batch_window / 1000
+        self.sessions: OrderedDict[str, List[Dict]] = OrderedDict()
+        self.socket = self.create_socket(args)
+
+    def create_socket(self, args) -> zmq.Socket:
+        socket = zmq.Context().socket(zmq.ROUTER)
         binduri = args.host + ':' + str(args.port)
-        self.socket.bind(binduri)
-        console.log(f'ZMQBackend> bind URI {binduri}. Ready to serve.')
+        socket.bind(binduri)
+        console.log(f'ZMQBackend> bind URI {binduri}. Ready to serve.'
+                    + f' (batch_size={self.batch_size})')
+        return socket
+
+    def recv(self) -> Tuple[List[bytes], bytes]:
+        '''
+        receive one request. returns the routing envelope (client identity,
+        and the empty delimiter frame) and the request frame.
+        '''
+        frames = self.socket.recv_multipart()
+        return frames[:-1], frames[-1]
+
+    @staticmethod
+    def parse(frame: bytes) -> Dict:
+        request = json.loads(frame)
+        if isinstance(request, list):
+            request = {'messages': request}
+        if not isinstance(request, dict):
+            raise TypeError(f'unexpected request {request!r}')
+        return request
+
+    def send(self, envelope: List[bytes], reply: Union[List, Dict]) -> None:
+        self.socket.send_multipart(envelope + [zmq.utils.jsonapi.dumps(reply)])
+
+    def send_error(self, envelope: List[bytes], request: Dict,
+                   error: Exception) -> None:
+        '''
+        reply with the error, e.g., CUDA out of memory. The conversation is
+        dropped, so that the client resends it next time.
+        '''
+        console.log(f'ZMQBackend> request failed: {error!r}', markup=False)
+        if isinstance(request, dict) and isinstance(request.get('uuid'), str):
+            self.sessions.pop(request['uuid'], None)
+        self.send(envelope, {'error': f'{type(error).__name__}: {error}'})
+
+    def send_token(self, envelope: List[bytes], piece: str) -> None:
+        self.socket.send_multipart(envelope + [b'token', piece.encode()])
+
+    def resolve(self, request: Dict) -> Optional[List[Dict]]:
+        '''
+        the whole conversation of a request, or None if it has to be resent.
+        '''
+        if 'uuid' not in request:
+            return request['messages']
+        uuid, seq = request['uuid'], request['seq']
+        if seq == 0:
+            session = []
+        elif uuid in self.sessions and len(self.sessions[uuid]) == seq:
+            session = self.sessions[uuid]
+        else:
+            return None
+        session.extend(request['messages'])
+        self.sessions[uuid] = session
+        self.sessions.move_to_end(uuid)
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+        return session
+
+    def info(self) -> Dict:
+        '''
+        the model and its generation settings, e.g., for the response cache
+        of the frontends
+        '''
+        return {'llm': getattr(self.llm, 'NAME', type(self.llm).__name__),
+                'kwargs': {k: v for (k, v) in getattr(self.llm, 'kwargs', {}).items()
+                           if isinstance(v, (str, int, float, bool))}}
 
     def listen(self):
+        '''
+        yield batches of (envelope, request, conversation). Blocks until the
+        first request arrives, then collects more until the batch is full or
+        the batching window is over.
+        '''
         while True:
-            msg = self.socket.recv_json()
-            yield msg
+            batch = []
+            deadline = time.time() + self.batch_window
+            while len(batch) < self.batch_size:
+                if batch:
+                    timeout = int(1000 * (deadline - time.time()))
+                    if timeout <= 0 or not self.socket.poll(timeout, zmq.POLLIN):
+                        break
+                envelope, frame = self.recv()
+                request = None
+                try:
+                    request = self.parse(frame)
+                    if request.get('info', False):
+                        self.send(envelope, self.info())
+                        continue
+                    session = self.resolve(request)
+                    if session is not None:
+                        _check(session)
+                except Exception as e:
+                    # a malformed request
+                    self.send_error(envelope, request, e)
+                    continue
+                if session is None:
+                    console.log(f'ZMQBackend> resync session {request["uuid"]}')
+                    self.send(envelope, {'resync': True})
+                    continue
+                console.log(
+                    f'ZMQBackend> recv query: {stat_messages(session, self.token_counter)}', markup=False)
+                batch.append((envelope, request, session))
+            yield batch
 
     def server(self):
-        for query in self.listen():
-            console.log(
-                f'ZMQBackend> recv query: {stat_messages(query, self.llm)}', markup=False)
-            with Status('LLM Calculating ...', spinner='line'):
-                reply = self.llm(query)
-            console.log(
-                f'ZMQBackend> send reply: {stat_messages(reply, self.llm)}', markup=False)
-            msg_json = zmq.utils.jsonapi.dumps(reply)
-            self.socket.send(msg_json)
+        '''
+        serve forever. A failed generation is answered with {'error': ...}
+        to the clients of the affected requests.
+        '''
+        for batch in self.listen():
+            if len(batch) == 1 and batch[0][1].get('stream', False):
+                envelope, request, session = batch[0]
+                try:
+                    for piece in self.llm.generate_stream(session, request.get('uuid')):
+                        self.send_token(envelope, piece)
+                except Exception as e:
+                    self.send_error(envelope, request, e)
+                    continue
+                self.send_reply(envelope, request, session)
+                continue
+            queries = [session for (_, _, session) in batch]
+            try:
+                with Status(f'LLM Calculating ({len(queries)}) ...', spinner='line'):
+                    if len(queries) == 1:
+                        replies = [self.llm(queries[0], batch[0][1].get('uuid'))]
+                    else:
+                        replies = self.llm.generate_batch(queries)
+            except Exception as e:
+                for (envelope, request, _) in batch:
+                    self.send_error(envelope, request, e)
+                continue
+            for (envelope, request, _), reply in zip(batch, replies):
+                if request.get('stream', False):
+                    self.send_token(envelope, reply[-1]['content'])
+                self.send_reply(envelope, request, reply)
+
+    def send_reply(self, envelope: List[bytes], request: Dict,
+                   session: List[Dict]) -> None:
+        console.log(
+            f'ZMQBackend> send reply: {stat_messages(session, self.token_counter)}', markup=False)
+        if 'uuid' in request:
+            self.send(envelope, {'seq': len(session), 'message': session[-1]})
+        else:
+            self.send(envelope, session)
+
+
+class ZMQWorker(ZMQBackend):
+    '''
+    A worker of broker.Broker. It is the same as ZMQBackend, except that it
+    connects to the broker with a DEALER socket instead of binding the
+    endpoint. The broker forwards the frames of the clients as they are, so
+    the requests and the replies are unchanged.
+    '''
+
+    def __init__(self, args, address: str, identity: bytes, model=None):
+        self.address = address
+        self.identity = identity
+        super().__init__(args, model)
+
+    def create_socket(self, args) -> zmq.Socket:
+        socket = zmq.Context().socket(zmq.DEALER)
+        socket.setsockopt(zmq.IDENTITY, self.identity)
+        socket.connect(self.address)
+        # the model is loaded. Ask the broker for requests.
+        from .broker import READY
+        socket.send(READY)
+        console.log(f'ZMQWorker> {self.identity.decode()} on {args.device}'
+                    + f' connected to {self.address}.'
+                    + f' (batch_size={self.batch_size})')
+        return socket
 
 
 def create_backend(args):
-    if args.backend_impl == 'zmq':
+    if args.backend_impl == 'zmq' and (getattr(args, 'workers', 1) > 1
+                                       or getattr(args, 'worker_devices', '')):
+        from .broker import Broker
+        backend = Broker(args)
+    elif args.backend_impl == 'zmq':
         backend = ZMQBackend(args)
     else:
         raise NotImplementedError(args.backend_impl)
@@ -84,6 +304,8 @@ def create_backend(args):
 
 
 if __name__ == '__main__':
+    import torch as th
+    from . import llm
     ag = argparse.ArgumentParser()
     ag.add_argument('--port', '-p', type=int, default=11177,
                     help='"11177" looks like "LLM"')
@@ -91,14 +313,27 @@ if __name__ == '__main__':
     ag.add_argument('--backend_impl', type=str,
                     default='zmq', choices=('zmq',))
     ag.add_argument('--max_new_tokens', type=int, default=512)
+    ag.add_argument('--batch_size', type=int, default=1)
+    ag.add_argument('--batch_window', type=float, default=50)
+    ag.add_argument('--kv_cache', type=int, default=0)
+    ag.add_argument('--prefix_cache', type=int, default=0)
+    ag.add_argument('--workers', type=int, default=1)
+    ag.add_argument('--worker_devices', type=str, default='')
+    ag.add_argument('--worker_timeout', type=float, default=600.0)
     ag.add_argument('--llm', type=str, default='Mistral7B')
     ag.add_argument('--device', type=str,
                     default='cuda' if th.cuda.is_available() else 'cpu')
     ag.add_argument('--precision', type=str,
                     default='fp16' if th.cuda.is_available() else '4bit')
+    ag.add_argument('--debgpt_home', type=str,
+                    default=os.path.expanduser('~/.debgpt'))
+    ag.add_argument('--prepare', action='store_true')
     ag = ag.parse_args()
     console.log(ag)
 
+    if ag.prepare:
+        llm.prepare(ag)
+        exit(0)
     backend = create_backend(ag)
     try:
         backend.server()
@@ -0,0 +1,177 @@
+'''
+MIT License
+
+Copyright (c) 2024 Mo Zhou <lumin@debian.org>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+from typing import Dict, List, Set, Tuple
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import time
+import rich
+from . import frontend
+console = rich.get_console()
+
+# the prompt sources a job may specify, same as the command line arguments
+SOURCES = ('bts', 'cmd', 'buildd', 'file', 'policy', 'devref', 'tldr', 'man',
+           'html', 'pynew', 'archw', 'policy_search', 'devref_search')
+
+
+def job_id(job: Dict) -> str:
+    '''
+    jobs without an explicit "id" are identified by their content
+    '''
+    return hashlib.sha256(json.dumps(job, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def load_manifest(path: str) -> List[Dict]:
+    '''
+    read the JSONL manifest. Each line is a job, like
+        {"id": "pytorch", "bts": "src:pytorch", "ask": ":summary"}
+    where the sources take one value or a list of values.
+    '''
+    jobs = []
+    with open(path, 'rt') as f:
+        for lineno, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            job = json.loads(line)
+            unknown = set(job) - set(SOURCES) - {'id', 'ask'}
+            if unknown:
+                raise ValueError(f'{path}:{lineno}: unknown keys {sorted(unknown)}')
+            job['id'] = str(job['id']) if 'id' in job else job_id(job)
+            jobs.append(job)
+    ids = [job['id'] for job in jobs]
+    if len(set(ids)) != len(ids):
+        raise ValueError(f'{path}: duplicated job ids')
+    return jobs
+
+
+def finished_jobs(path: str) -> Set[str]:
+    '''
+    ids of the jobs that have succeeded according to the results file
+    '''
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, 'rt') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # e.g., the last line of an interrupted run
+                continue
+            if record.get('error', None) is None:
+                done.add(record['id'])
+    return done
+
+
+def job_args(ag, job: Dict) -> Tuple[argparse.Namespace, List[str]]:
+    '''
+    turn a job into the argparse results and argument order, as if its
+    sources were specified in the command line.
+    '''
+    jag = argparse.Namespace(**vars(ag))
+    order = []
+    for key in SOURCES:
+        setattr(jag, key, [])
+    for key, value in job.items():
+        if key in SOURCES:
+            values = value if isinstance(value, list) else [value]
+            getattr(jag, key).extend(str(x) for x in values)
+            order.extend([key] * len(values))
+    jag.ask = job.get('ask', ag.ask)
+    return jag, order
+
+
+def build_prompt(ag, job: Dict) -> str:
+    from .cli import gather_information_ordered
+    jag, order = job_args(ag, job)
+    prompt = gather_information_ordered(None, jag, order)
+    if not prompt:
+        raise ValueError('empty prompt')
+    return prompt
+
+
+def run(ag) -> None:
+    '''
+    run the jobs that have not finished yet, and append their results to
+    the results file as soon as each of them completes.
+    '''
+    jobs = load_manifest(ag.manifest)
+    results = ag.results if ag.results is not None \
+        else os.path.splitext(ag.manifest)[0] + '.results.jsonl'
+    done = finished_jobs(results)
+    todo = [job for job in jobs if job['id'] not in done]
+    console.log(f'batch> {len(jobs)} jobs, {len(jobs) - len(todo)} already'
+                + f' finished. Writing results to {results}')
+    with open(results, 'at') as out:
+        asyncio.run(_run(ag, todo, out))
+
+
+async def _run(ag, jobs: List[Dict], out) -> None:
+    f = ag.frontend_instance
+    if f is not None:
+        f.stream = False
+    loop = asyncio.get_running_loop()
+    pool = ThreadPoolExecutor(max_workers=ag.max_concurrency)
+    semaphore = asyncio.Semaphore(ag.max_concurrency)
+    # frontends without concurrent queries serve one job at a time
+    lock = asyncio.Lock()
+    completed = 0
+
+    def _query(prompt: str) -> str:
+        f.reset()
+        return f.query(prompt)
+
+    async def _job(job: Dict) -> None:
+        nonlocal completed
+        record = {'id': job['id'], 'reply': None, 'error': None}
+        start = time.time()
+        try:
+            prompt = await loop.run_in_executor(pool, build_prompt, ag, job)
+            if f is None:
+                # dryrun: the prompts are the results
+                record['prompt'] = prompt
+            elif isinstance(f, frontend.AsyncOpenAIFrontend):
+                result = await f.aquery(prompt, semaphore)
+                record['reply'], record['error'] = result['reply'], result['error']
+                record['retries'] = result['retries']
+            else:
+                async with lock:
+                    record['reply'] = await loop.run_in_executor(pool, _query, prompt)
+        except Exception as e:
+            record['error'] = f'{type(e).__name__}: {e}'
+        record['latency'] = time.time() - start
+        out.write(json.dumps(record) + '\n')
+        out.flush()
+        completed += 1
+        status = 'ok' if record['error'] is None else record['error']
+        console.log(f'batch> [{completed}/{len(jobs)}] {job["id"]}: {status}'
+                    + f' ({record["latency"]:.1f}s)', markup=False)
+
+    try:
+        await asyncio.gather(*[_job(job) for job in jobs])
+    finally:
+        pool.shutdown()
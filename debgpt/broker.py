@@ -0,0 +1,302 @@
+'''
+MIT License
+
+Copyright (c) 2024 Mo Zhou <lumin@debian.org>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+from typing import Callable, Dict, List, Optional
+from collections import OrderedDict, deque
+import argparse
+import json
+import multiprocessing
+import time
+import zmq
+import rich
+console = rich.get_console()
+
+__doc__ = '''
+Serve one ZMQ endpoint with a pool of backend worker processes, e.g., one
+for each GPU, or several on the CPU.
+
+    frontends (DEALER) --> ROUTER [broker] ROUTER <-- workers (DEALER)
+
+The broker does not load any model. It forwards the frames of the clients
+as they are to the least loaded worker, prefixed with the identity of the
+worker, and forwards the frames coming back from the worker (the streamed
+tokens, then the reply) to the client. So the protocol seen by the clients
+is exactly that of backend.ZMQBackend, and each worker is a ZMQBackend
+that connects to the broker instead of binding the endpoint
+(backend.ZMQWorker).
+
+The conversations kept by the workers (see the uuid and seq of the
+protocol) stick to the worker that has them. When the conversation moves
+to another worker, that worker replies with a resync, and the client
+resends the whole conversation.
+
+A worker sends READY once its model is loaded, and only then receives
+requests. Workers that exit are restarted, with an increasing delay if they
+keep failing. A worker that has requests in flight, but sends nothing
+(neither a token nor a reply) for --worker_timeout seconds, is considered
+wedged and is killed.
+
+When a worker exits or is killed, the client of its oldest request in
+flight, which is the one being processed, gets the reply {'error': ...}.
+This request is not sent again, as it may crash or wedge the next worker as
+well. Neither are the requests whose tokens were already streamed to the
+client. The other requests in flight are sent again to another worker.
+'''
+
+READY = b'ready'
+
+
+class Worker(object):
+    '''
+    the broker side of a worker process
+    '''
+
+    def __init__(self, index: int, device: str):
+        self.index = index
+        self.device = device
+        self.generation = 0
+        self.identity: Optional[bytes] = None
+        self.process = None
+        self.ready = False
+        # envelope -> the frames of the requests in flight
+        self.inflight: Dict[tuple, List[bytes]] = {}
+        # the envelopes of those whose tokens are being streamed
+        self.streaming: set = set()
+        # why the worker was killed
+        self.error: Optional[str] = None
+        # consecutive failures, and when the next start is allowed
+        self.failures = 0
+        self.start_after = 0.0
+        self.started = 0.0
+        # the last time the worker made progress on its requests in flight
+        self.progress = 0.0
+
+    def __repr__(self):
+        return f'worker {self.index} ({self.device})'
+
+
+def run_worker(args: Dict, address: str, identity: bytes) -> None:
+    '''
+    entry point of the worker processes
+    '''
+    from . import backend
+    worker = backend.ZMQWorker(argparse.Namespace(**args), address, identity)
+    try:
+        worker.server()
+    except KeyboardInterrupt:
+        pass
+
+
+class Broker(object):
+    # how often (seconds) the worker processes are checked
+    health_interval: float = 1.0
+    # a worker that ran for this long (seconds) is considered recovered
+    stable_after: float = 60.0
+    max_restart_delay: float = 60.0
+    # maximum number of conversations whose worker is remembered
+    max_sessions: int = 4096
+
+    def __init__(self, args, target: Callable = run_worker):
+        '''
+        args.workers: number of worker processes
+        args.worker_devices: comma separated devices, assigned to the
+            workers in turn, e.g., cuda:0,cuda:1. Empty means args.device.
+        args.worker_timeout: seconds without progress before a worker with
+            requests in flight is killed.
+        target: the function run by the worker processes, see run_worker
+        '''
+        self.target = target
+        # the arguments of the workers. Only the plain values are passed.
+        self.worker_args = {k: v for (k, v) in vars(args).items()
+                            if isinstance(v, (str, int, float, bool, list,
+                                              type(None)))}
+        devices = [x for x in args.worker_devices.split(',') if x] \
+            if args.worker_devices else [args.device]
+        nworkers = max(args.workers, len(devices))
+        self.workers = [Worker(i, devices[i % len(devices)])
+                        for i in range(nworkers)]
+        self.by_identity: Dict[bytes, Worker] = {}
+        self.affinity: OrderedDict[str, Worker] = OrderedDict()
+        # slack of load before a conversation moves to another worker
+        self.slack = max(1, args.batch_size)
+        self.timeout = getattr(args, 'worker_timeout', 600.0)
+        self.queue: deque = deque()
+        self.context = zmq.Context()
+        self.frontend = self.context.socket(zmq.ROUTER)
+        binduri = args.host + ':' + str(args.port)
+        self.frontend.bind(binduri)
+        self.backend = self.context.socket(zmq.ROUTER)
+        port = self.backend.bind_to_random_port('tcp://127.0.0.1')
+        self.address = f'tcp://127.0.0.1:{port}'
+        self.mp = multiprocessing.get_context('spawn')
+        console.log(f'Broker> bind URI {binduri}. Starting {nworkers} workers'
+                    + f' on {", ".join(w.device for w in self.workers)}.')
+
+    def start(self, worker: Worker) -> None:
+        worker.generation += 1
+        worker.identity = f'worker-{worker.index}-{worker.generation}'.encode()
+        self.by_identity[worker.identity] = worker
+        args = dict(self.worker_args, device=worker.device)
+        worker.process = self.mp.Process(
+            target=self.target, args=(args, self.address, worker.identity),
+            daemon=True)
+        worker.process.start()
+        worker.started = time.time()
+
+    def check(self) -> None:
+        '''
+        health check: kill the wedged workers, and restart the workers that
+        have exited. See abandon() for their requests in flight.
+        '''
+        now = time.time()
+        for worker in self.workers:
+            if worker.process is not None and worker.process.is_alive():
+                if not worker.inflight or now - worker.progress <= self.timeout:
+                    if worker.ready and now - worker.started > self.stable_after:
+                        worker.failures = 0
+                    continue
+                self.expire(worker)
+            if worker.process is not None:
+                self.abandon(worker)
+                worker.ready = False
+                worker.process = None
+                delay = min(self.max_restart_delay, 2 ** worker.failures - 1)
+                worker.failures += 1
+                worker.start_after = now + delay
+            if now >= worker.start_after:
+                self.start(worker)
+
+    def expire(self, worker: Worker) -> None:
+        '''
+        kill a wedged worker
+        '''
+        console.log(f'Broker> {worker} made no progress in {self.timeout}s.'
+                    + ' Killing it.')
+        worker.error = f'no progress in {self.timeout}s on {worker}'
+        worker.process.kill()
+        worker.process.join()
+
+    def abandon(self, worker: Worker) -> None:
+        '''
+        the requests in flight of a worker that has exited. The one being
+        processed, and those already streamed, fail. The others are resent.
+        '''
+        error = worker.error or \
+            f'{worker} exited with code {worker.process.exitcode}'
+        worker.error = None
+        resend = []
+        for i, (envelope, frames) in enumerate(worker.inflight.items()):
+            if i == 0 or envelope in worker.streaming:
+                self.frontend.send_multipart(
+                    list(envelope) + [json.dumps({'error': error}).encode()])
+            else:
+                resend.append(frames)
+        console.log(f'Broker> {error}. {len(worker.inflight) - len(resend)}'
+                    + f' requests failed, {len(resend)} to resend.')
+        self.queue.extendleft(reversed(resend))
+        del self.by_identity[worker.identity]
+        worker.inflight.clear()
+        worker.streaming.clear()
+
+    def choose(self, uuid: Optional[str]) -> Optional[Worker]:
+        '''
+        the worker that keeps the conversation, unless it is overloaded,
+        or the least loaded worker.
+        '''
+        ready = [w for w in self.workers if w.ready]
+        if not ready:
+            return None
+        least = min(ready, key=lambda w: len(w.inflight))
+        worker = self.affinity.get(uuid, None) if uuid else None
+        if worker is None or not worker.ready or \
+                len(worker.inflight) > len(least.inflight) + self.slack:
+            worker = least
+        if uuid:
+            self.affinity[uuid] = worker
+            self.affinity.move_to_end(uuid)
+            while len(self.affinity) > self.max_sessions:
+                self.affinity.popitem(last=False)
+        return worker
+
+    def dispatch(self) -> None:
+        while self.queue:
+            frames = self.queue[0]
+            try:
+                uuid = json.loads(frames[-1]).get('uuid', None)
+            except (ValueError, AttributeError):
+                uuid = None
+            worker = self.choose(uuid)
+            if worker is None:
+                return
+            self.queue.popleft()
+            if not worker.inflight:
+                worker.progress = time.time()
+            worker.inflight[tuple(frames[:-1])] = frames
+            self.backend.send_multipart([worker.identity] + frames)
+
+    def from_worker(self, frames: List[bytes]) -> None:
+        worker = self.by_identity.get(frames[0], None)
+        if worker is None:
+            # a worker that has been declared dead
+            return
+        frames = frames[1:]
+        if frames == [READY]:
+            console.log(f'Broker> {worker} is ready.')
+            worker.ready = True
+            return
+        worker.progress = time.time()
+        if b'' not in frames:
+            console.log(f'Broker> malformed message from {worker}.')
+            return
+        # forward to the client. The envelope ends with the empty frame.
+        delim = frames.index(b'')
+        envelope = tuple(frames[:delim + 1])
+        if frames[delim + 1:delim + 2] == [b'token']:
+            worker.streaming.add(envelope)
+        else:
+            worker.inflight.pop(envelope, None)
+            worker.streaming.discard(envelope)
+        self.frontend.send_multipart(frames)
+
+    def server(self):
+        poller = zmq.Poller()
+        poller.register(self.frontend, zmq.POLLIN)
+        poller.register(self.backend, zmq.POLLIN)
+        last_check = 0.0
+        try:
+            while True:
+                if time.time() - last_check >= self.health_interval:
+                    self.check()
+                    last_check = time.time()
+                events = dict(poller.poll(int(1000 * self.health_interval)))
+                if self.backend in events:
+                    while self.backend.poll(0, zmq.POLLIN):
+                        self.from_worker(self.backend.recv_multipart())
+                if self.frontend in events:
+                    while self.frontend.poll(0, zmq.POLLIN):
+                        self.queue.append(self.frontend.recv_multipart())
+                self.dispatch()
+        finally:
+            for worker in self.workers:
+                if worker.process is not None:
+                    worker.process.terminate()
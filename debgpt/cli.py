@@ -25,20 +25,24 @@ SOFTWARE.
 import warnings
 warnings.filterwarnings("ignore")
 
-from typing import List, Optional
-from prompt_toolkit.styles import Style
+# keep the imports here light: prompt_toolkit, the frontends and the text
+# loaders are imported when they are needed (see tests/test_startup.py)
+from typing import Callable, Dict, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from rich.markup import escape
 from rich.panel import Panel
-from prompt_toolkit import PromptSession
-from prompt_toolkit.completion import Completer, Completion
 import argparse
+import inspect
 import re
 import os
 import sys
-from . import frontend
-from . import debian
+import time
 from . import defaults
-from .task import task_backend, task_git, task_git_commit, task_replay, task_fortune
+from . import journal
+from . import web
+from . import assembler
+from .task import task_backend, task_batch, task_git, task_git_commit, task_replay, task_fortune, task_stdin
 import shlex
 import rich
 console = rich.get_console()
@@ -59,6 +63,17 @@ def generate_config_file(ag) -> None:
     exit(0)
 
 
+def _parse_ttl(spec: str) -> Dict[str, float]:
+    '''
+    parse the "source=seconds,source=seconds" syntax of --http_cache_ttl
+    '''
+    ttl = {}
+    for item in filter(None, spec.split(',')):
+        source, seconds = item.split('=')
+        ttl[source.strip()] = float(seconds)
+    return ttl
+
+
 def parse_args(argv):
     '''
     argparse with subparsers. Generate a config.toml template as byproduct.
@@ -84,6 +99,9 @@ use Meta+Enter to accept the input instead.')
                     help='hide the first (generated) prompt; do not print argparse results')
     ag.add_argument('--verbose', '-v', action='store_true',
                     help='verbose mode. helpful for debugging')
+    ag.add_argument('--resume', '-R', type=str, default=None,
+                    help='continue a previous conversation, given its UUID \
+or the path to its journal (debgpt_home/<UUID>.jsonl).')
     ag.add_argument('--output', '-o', type=str, default=None,
                     help='write the last LLM message to specified file')
     ag.add_argument('--version', action='store_true',
@@ -99,6 +117,70 @@ it to web-based LLMs in that case.")
     config_template += '\n'.join('# ' + x for x in textwrap.wrap(
         ag._option_string_actions['--frontend'].help))
     config_template += f'''\nfrontend = {repr(conf.frontend)}\n'''
+    config_template += '\n'
+
+    ag.add_argument('--http_cache_ttl', type=_parse_ttl,
+                    default=conf['http_cache_ttl'],
+                    help='Web pages retrieved by the prompt loaders are \
+cached in debgpt_home, and revalidated with the server after a time-to-live \
+(seconds), which can be overriden per source, e.g., "bts=60,policy=86400". \
+Sources are bts, buildd, html, archw, pynew, policy, devref.')
+    ag.add_argument('--no_http_cache', action='store_true',
+                    help='bypass the HTTP cache for web pages.')
+    ag.add_argument('--http_timeout', type=float,
+                    default=conf['http_timeout'],
+                    help='timeout (seconds) for connecting to and reading \
+from web servers.')
+    ag.add_argument('--http_retries', type=int,
+                    default=conf['http_retries'],
+                    help='number of retries, with exponential backoff, when \
+a web server fails or is unreachable.')
+    ag.add_argument('--jobs', '-j', type=int, default=conf['jobs'],
+                    help='number of prompt sources (--bts, --html, --man, \
+etc.) to load concurrently. The generated prompt is the same regardless.')
+    config_template += '\n'.join('# ' + x for x in textwrap.wrap(
+        ag._option_string_actions['--http_cache_ttl'].help))
+    config_template += '\nhttp_cache_ttl = {' + ', '.join(
+        f'{k} = {v}' for (k, v) in conf.http_cache_ttl.items()) + '}\n'
+    config_template += '\n'
+    ag.add_argument('--cmd_timeout', type=float,
+                    default=conf['cmd_timeout'],
+                    help='seconds after which the commands of --cmd, --man \
+and --tldr are killed. Their output so far is kept.')
+    ag.add_argument('--cmd_max_lines', type=int,
+                    default=conf['cmd_max_lines'],
+                    help='maximum number of lines read from the output of \
+each command.')
+    ag.add_argument('--cmd_max_bytes', type=int,
+                    default=conf['cmd_max_bytes'],
+                    help='maximum number of bytes read from the output of \
+each command.')
+    config_template += '\n'.join('# ' + x for x in textwrap.wrap(
+        ag._option_string_actions['--jobs'].help))
+    config_template += f'''\njobs = {repr(conf.jobs)}\n'''
+    config_template += '\n'.join('# ' + x for x in textwrap.wrap(
+        ag._option_string_actions['--cmd_timeout'].help))
+    config_template += f'''\ncmd_timeout = {repr(conf.cmd_timeout)}\n'''
+    config_template += '\n'
+
+    ag.add_argument('--response_cache', action='store_true',
+                    default=conf['response_cache'],
+                    help='reuse the LLM reply when exactly the same \
+conversation was sent with the same model and sampling parameters before. \
+Replies are cached in debgpt_home.')
+    ag.add_argument('--no_response_cache', action='store_true',
+                    help='bypass the response cache, even if it is enabled \
+in the config file.')
+    ag.add_argument('--response_cache_size', type=int,
+                    default=conf['response_cache_size'],
+                    help='size limit (MiB) of the response cache. The least \
+recently used replies are evicted first.')
+    config_template += '\n'.join('# ' + x for x in textwrap.wrap(
+        ag._option_string_actions['--response_cache'].help))
+    config_template += f'''\nresponse_cache = {repr(conf.response_cache).lower()}\n'''
+    config_template += '\n'.join('# ' + x for x in textwrap.wrap(
+        ag._option_string_actions['--response_cache_size'].help))
+    config_template += f'''\nresponse_cache_size = {repr(conf.response_cache_size)}\n'''
 
     # LLM Inference Arguments
     config_template += '''\n
@@ -120,6 +202,22 @@ See https://platform.openai.com/docs/api-reference/chat/create \
     ag.add_argument('--top_p', '-P', type=float, default=conf['top_p'])
     # TODO: add this in config template
 
+    ag.add_argument('--context_window', type=int,
+                    default=conf['context_window'],
+                    help='context window (in tokens) of the LLM. When the \
+information gathered for the first prompt does not fit, the largest sources \
+are truncated. The default (0) looks up the context window from the model \
+name. The dryrun frontend does not truncate unless this is set.')
+    ag.add_argument('--map_reduce', action='store_true',
+                    help='instead of truncating the sources that do not fit \
+in the context window, split them into chunks, ask the question about every \
+chunk in parallel, and put the partial answers in the first prompt.')
+    ag.add_argument('--map_concurrency', type=int, default=8,
+                    help='maximum number of --map_reduce queries in flight.')
+    config_template += '\n'.join('# ' + x for x in textwrap.wrap(
+        ag._option_string_actions['--context_window'].help))
+    config_template += f'''\ncontext_window = {repr(conf.context_window)}\n'''
+
     # Specific to OpenAI Frontend
     config_template += '''\n
 ##############################
@@ -187,6 +285,18 @@ Their prices vary. See https://platform.openai.com/docs/models .')
     # -- 6. Debian Developers References
     ag.add_argument('--devref', type=str, default=[], action='append',
                     help='load specified devref section(s).')
+    # -- 5/6. Search Debian Policy / Developers References
+    ag.add_argument('--policy_search', '--policy-search', type=str,
+                    default=[], action='append',
+                    help='load the policy sections most relevant to the \
+given keywords, e.g., "maintainer scripts dpkg triggers".')
+    ag.add_argument('--devref_search', '--devref-search', type=str,
+                    default=[], action='append',
+                    help='load the devref sections most relevant to the \
+given keywords.')
+    ag.add_argument('--search_topk', type=int, default=3,
+                    help='number of sections loaded by --policy_search and \
+--devref_search.')
     # -- 7. TLDR Manual Page
     ag.add_argument('--tldr', type=str, default=[], action='append',
                     help='add tldr page to the prompt.')
@@ -221,9 +331,39 @@ Their prices vary. See https://platform.openai.com/docs/models .')
     ps_backend.add_argument('--backend_impl', type=str,
                             default='zmq', choices=('zmq',))
     ps_backend.add_argument('--max_new_tokens', type=int, default=512)
+    ps_backend.add_argument('--batch_size', type=int, default=1,
+                            help='maximum number of concurrent requests \
+processed together as one batch.')
+    ps_backend.add_argument('--batch_window', type=float, default=50,
+                            help='milliseconds to wait for more requests \
+to join a batch, after the first one arrives.')
+    ps_backend.add_argument('--kv_cache', type=int, default=0,
+                            help='memory budget (MiB) for keeping the \
+past key/values of conversations, so that follow-up turns skip the prefill \
+of earlier turns. It comes on top of the memory of the LLM. 0 (default) \
+disables it.')
+    ps_backend.add_argument('--prefix_cache', type=int, default=0,
+                            help='memory budget (MiB) for the past key/values \
+of prompt prefixes shared across all clients, such as the system message. \
+It comes on top of the memory of the LLM. 0 (default) disables it.')
+    ps_backend.add_argument('--workers', type=int, default=1,
+                            help='number of worker processes, each holding \
+an instance of the LLM, behind the same endpoint.')
+    ps_backend.add_argument('--worker_devices', type=str, default='',
+                            help='comma separated devices assigned to the \
+workers in turn, e.g., cuda:0,cuda:1 for one worker on each GPU. The default \
+is --device for all of them.')
+    ps_backend.add_argument('--worker_timeout', type=float, default=600.0,
+                            help='seconds without progress (no token, no \
+reply) before a worker with requests in flight is killed and restarted. Its \
+current request fails.')
     ps_backend.add_argument('--llm', type=str, default='Mistral7B')
     ps_backend.add_argument('--device', type=str, default='cuda')
     ps_backend.add_argument('--precision', type=str, default='fp16')
+    ps_backend.add_argument('--prepare', action='store_true',
+                            help='quantize or convert the weights of --llm \
+at --precision once, and store them in debgpt_home, then quit. The backend \
+then loads them directly, which takes seconds instead of minutes.')
     ps_backend.set_defaults(func=task_backend)
 
     # Task: git
@@ -239,13 +379,37 @@ Their prices vary. See https://platform.openai.com/docs/models .')
     ps_replay = subps.add_parser(
         'replay', help='replay a conversation from a JSON file')
     ps_replay.add_argument('json_file_path', type=str,
-                           help='path to the JSON file')
+                           help='path to the JSON file, or the JSONL journal')
+    ps_replay.add_argument('--tail', type=int, default=None,
+                           help='only replay the last N messages')
+    ps_replay.add_argument('--grep', type=str, default=None,
+                           help='only replay the messages matching the \
+regular expression')
+    ps_replay.add_argument('--pager', action='store_true',
+                           help='page through the output with $PAGER')
     ps_replay.set_defaults(func=task_replay)
 
+    # Task: batch
+    ps_batch = subps.add_parser('batch', help='run the prompt jobs of a \
+JSONL manifest concurrently, and append the results to a JSONL file. Jobs \
+that already finished are skipped when running the same manifest again.')
+    ps_batch.add_argument('manifest', type=str,
+                          help='one job per line, e.g., {"id": "pytorch", \
+"bts": "src:pytorch", "ask": ":summary"}. Besides "id" and "ask", the keys \
+are the prompt sources (bts, buildd, file, policy, ...), with one value or a \
+list of values.')
+    ps_batch.add_argument('results', type=str, nargs='?', default=None,
+                          help='the results file. (default: the manifest \
+path with the .results.jsonl suffix)')
+    ps_batch.add_argument('--max_concurrency', type=int, default=8,
+                          help='maximum number of jobs being processed at \
+the same time.')
+    ps_batch.set_defaults(func=task_batch, concurrent=True)
+
     # Task: stdin
     ps_stdin = subps.add_parser(
         'stdin', help='read stdin as the first prompt. Should combine with -Q.')
-    ps_stdin.set_defaults(func=lambda ag: debian.stdin())
+    ps_stdin.set_defaults(func=task_stdin)
 
     # Task: fortune
     ps_fortune = subps.add_parser('fortune', help='fortune mode. Note, it is \
@@ -285,7 +449,7 @@ def parse_args_order(argv) -> List[str]:
             dest.append(long.lstrip('--'))
     def _match_l(probe: str, long: str, dest: List[str]):
         if probe == long or probe.startswith(long+'='):
-            dest.append(long.lstrip('--'))
+            dest.append(long.lstrip('--').replace('-', '_'))
     for item in argv:
         _match_l(item, '--bts', order)
         _match_l(item, '--cmd', order)
@@ -293,6 +457,10 @@ def parse_args_order(argv) -> List[str]:
         _match_ls(item, '--file', '-f', order)
         _match_l(item, '--policy', order)
         _match_l(item, '--devref', order)
+        _match_l(item, '--policy_search', order)
+        _match_l(item, '--policy-search', order)
+        _match_l(item, '--devref_search', order)
+        _match_l(item, '--devref-search', order)
         _match_l(item, '--tldr', order)
         _match_l(item, '--man', order)
         _match_l(item, '--html', order)
@@ -301,6 +469,83 @@ def parse_args_order(argv) -> List[str]:
     return order
 
 
+def _ordered_loaders(ag, ag_order) -> List[Tuple[str, str, Callable[[], str]]]:
+    '''
+    following the argument order, bind the specified arguments to the
+    debian.* functions with different function signatures. Returns a list
+    of (key, spec, loader) where loader() produces the text.
+    '''
+    from . import debian
+    limits = {'timeout': ag.cmd_timeout, 'max_lines': ag.cmd_max_lines,
+              'max_bytes': ag.cmd_max_bytes}
+    loaders = []
+    for key in ag_order:
+        spec = getattr(ag, key).pop(0)
+        if key in ('buildd', 'pynew', 'archw'):
+            func = partial(getattr(debian, key), spec)
+        elif key == 'file':
+            func = partial(debian.file, spec, debgpt_home=ag.debgpt_home)
+        elif key in ('man', 'tldr'):
+            # coroutines. see _run_loaders
+            func = partial(getattr(debian, 'a' + key), spec,
+                           debgpt_home=ag.debgpt_home, **limits)
+        elif key == 'cmd':
+            func = partial(debian.acommand_line, spec, **limits)
+        elif key == 'bts':
+            func = partial(debian.bts, spec, raw=ag.bts_raw)
+        elif key == 'html':
+            func = partial(debian.html, spec, raw=False)
+        elif key in ('policy', 'devref'):
+            func = partial(getattr(debian, key), spec,
+                           debgpt_home=ag.debgpt_home)
+        elif key in ('policy_search', 'devref_search'):
+            func = partial(getattr(debian, key), spec,
+                           debgpt_home=ag.debgpt_home, k=ag.search_topk)
+        else:
+            raise NotImplementedError(key)
+        loaders.append((key, spec, func))
+    return loaders
+
+
+def _run_loaders(loaders: List[Tuple[str, str, Callable[[], str]]],
+                 jobs: int = 1, verbose: bool = False) -> List[str]:
+    '''
+    run the loaders in an event loop, at most `jobs` of them at a time. With
+    jobs = 1, they run strictly one after another in their original order,
+    e.g., --cmd make --cmd 'cat build.log'. The loaders that are coroutines
+    (the commands of --cmd, --man, --tldr) are awaited, and the others run
+    in a thread pool of size `jobs`. The results are always returned in the
+    original order of the loaders.
+    '''
+    import asyncio
+
+    async def _run(loader, pool):
+        key, spec, func = loader
+        start = time.time()
+        if inspect.iscoroutinefunction(func):
+            info = await func()
+        elif pool is None:
+            info = func()
+        else:
+            info = await asyncio.get_running_loop().run_in_executor(pool, func)
+        if verbose:
+            console.log(f'gather> --{key} {spec}: {time.time() - start:.3f}s')
+        return info
+
+    async def _limited(loader, pool, semaphore):
+        async with semaphore:
+            return await _run(loader, pool)
+
+    async def _gather():
+        if jobs <= 1:
+            return [await _run(x, None) for x in loaders]
+        semaphore = asyncio.Semaphore(jobs)
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            return await asyncio.gather(*[_limited(x, pool, semaphore)
+                                          for x in loaders])
+    return asyncio.run(_gather())
+
+
 def gather_information_ordered(msg: Optional[str], ag, ag_order) -> Optional[str]:
     '''
     based on the argparse results, as well as the argument order, collect
@@ -311,28 +556,34 @@ def gather_information_ordered(msg: Optional[str], ag, ag_order) -> Optional[str
         msg = '' if msg is None else msg
         return msg + '\n' + info
 
-    # following the argument order, dispatch to debian.* functions with
-    # different function signatures
-    for key in ag_order:
-        if key in ('file', 'tldr', 'man', 'buildd', 'pynew', 'archw'):
-            spec = getattr(ag, key).pop(0)
-            func = getattr(debian, key)
-            msg = _append_info(msg, func(spec))
-        elif key == 'cmd':
-            cmd_line = ag.cmd.pop(0)
-            msg = _append_info(msg, debian.command_line(cmd_line))
-        elif key == 'bts':
-            bts_id = ag.bts.pop(0)
-            msg = _append_info(msg, debian.bts(bts_id, raw=ag.bts_raw))
-        elif key == 'html':
-            url = ag.html.pop(0)
-            msg = _append_info(msg, debian.html(url, raw=False))
-        elif key in ('policy', 'devref'):
-            spec = getattr(ag, key).pop(0)
-            func = getattr(debian, key)
-            msg = _append_info(msg, func(spec, debgpt_home=ag.debgpt_home))
+    # the loaders may run concurrently (--jobs), but their results are
+    # joined in the argument order, so the prompt stays the same.
+    loaders = _ordered_loaders(ag, ag_order)
+    infos = _run_loaders(loaders, ag.jobs, ag.verbose)
+
+    # truncate the gathered information if it exceeds the context window
+    fixed = (msg or '') + defaults.QUESTIONS.get(ag.ask, ag.ask)
+    if ag.frontend == 'openai':
+        fixed += defaults.OPENAI_SYSTEM_MESSAGE
+    f = getattr(ag, 'frontend_instance', None)
+    count = f.token_counter.count_text if f is not None \
+        else assembler.estimate_tokens
+    budget = assembler.prompt_budget(ag, fixed, count)
+    if budget is not None and getattr(ag, 'map_reduce', False):
+        if f is None:
+            console.log('map-reduce needs an LLM frontend. Truncating instead.')
         else:
-            raise NotImplementedError(key)
+            from . import mapreduce
+            question = defaults.QUESTIONS.get(ag.ask, ag.ask) \
+                or defaults.QUESTIONS[':summary']
+            infos = mapreduce.run(f, [(key, spec, info) for ((key, spec, _), info)
+                                      in zip(loaders, infos)],
+                                  question, budget, count, ag.map_concurrency)
+    if budget is not None:
+        infos = assembler.fit([(key, info) for ((key, _, _), info)
+                               in zip(loaders, infos)], budget, count)
+    for info in infos:
+        msg = _append_info(msg, info)
 
     # --ask should be processed as the last one
     if ag.ask:
@@ -356,7 +607,12 @@ def gather_information_ordered(msg: Optional[str], ag, ag_order) -> Optional[str
     return msg
 
 
-def interactive_mode(f: frontend.AbstractFrontend, ag):
+def interactive_mode(f, ag):
+    from prompt_toolkit import PromptSession
+    from prompt_toolkit.completion import Completer, Completion
+    from prompt_toolkit.styles import Style
+    from . import frontend
+
     # create prompt_toolkit style
     prompt_style = Style([('prompt', 'bold fg:ansibrightcyan'),
                           ('', 'bold ansiwhite')])
@@ -381,9 +637,16 @@ def interactive_mode(f: frontend.AbstractFrontend, ag):
     prompt_session = PromptSession(style=prompt_style, multiline=ag.multiline,
                                    completer=CustomCompleter())
 
+    # the prompt shows the session length, and the context usage in tokens
+    window = assembler.context_window(ag)
+
+    def _prompt_message() -> str:
+        usage = f'{f.num_tokens()}' + ('' if window is None else f'/{window}')
+        return f'{os.getlogin()}[{len(f.session)}|{usage}]> '
+
     # loop
     try:
-        while text := prompt_session.prompt(f'{os.getlogin()}[{len(f.session)}]> '):
+        while text := prompt_session.prompt(_prompt_message()):
             # parse escaped interaction commands
             if text.startswith('/'):
                 cmd = shlex.split(text)
@@ -419,6 +682,11 @@ def main(argv=sys.argv[1:]):
         exit(0)
     if ag.verbose:
         console.log(ag)
+    web.configure_session(timeout=ag.http_timeout, retries=ag.http_retries,
+                          pool_maxsize=max(4, ag.jobs))
+    if not ag.no_http_cache:
+        web.enable_cache(os.path.join(ag.debgpt_home, 'http_cache'),
+                         ag.http_cache_ttl)
 
     # parse argument order
     ag_order = parse_args_order(argv)
@@ -426,8 +694,11 @@ def main(argv=sys.argv[1:]):
         console.log('Argument Order:', ag_order)
 
     # initialize the frontend
+    from . import frontend
     f = frontend.create_frontend(ag)
     ag.frontend_instance = f
+    if ag.resume is not None and f is not None:
+        f.resume(journal.locate(ag.resume, ag.debgpt_home))
 
     # create task-specific prompts. note, some special tasks will exit()
     # in their subparser default function when then finished, such as backend,
@@ -21,14 +21,18 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 '''
-from typing import List, Union
+from typing import Dict, List, Optional, Tuple, Union
 import re
-import requests
-from . import policy as debgpt_policy
-from bs4 import BeautifulSoup
+from . import web
+import hashlib
+import json
 import os
+import shutil
+import signal
 import subprocess
 import sys
+import threading
+import time
 import rich
 console = rich.get_console()
 
@@ -43,29 +47,30 @@ prompt, and sent through frontend to the backend for LLM to process.
 ########################
 
 
-def _load_html(url: str) -> List[str]:
+def _load_html(url: str, *, source: str = 'html') -> List[str]:
     '''
     read HTML from url, convert it into plain text, then list of lines
     '''
-    r = requests.get(url)
-    soup = BeautifulSoup(r.text, features="html.parser")
-    text = soup.get_text().strip()
+    from . import htmltext
+    r = web.get(url, source=source)
+    text = htmltext.get_text(r.text).strip()
     text = re.sub('\n\n+\n', '\n\n', text)
     text = [x.rstrip() for x in text.split('\n')]
     return text
 
 
 def _load_bts(identifier: str) -> List[str]:
+    from . import htmltext
     url = f'https://bugs.debian.org/{identifier}'
-    r = requests.get(url)
-    soup = BeautifulSoup(r.text, features="html.parser")
+    r = web.get(url, source='bts')
 
     if not identifier.startswith('src:'):
         # delete useless system messages
-        _ = [x.clear() for x in soup.find_all('p', attrs={'class': 'msgreceived'})]
-        _ = [x.clear() for x in soup.find_all('div', attrs={'class': 'infmessage'})]
+        drop = (('p', 'msgreceived'), ('div', 'infmessage'))
+    else:
+        drop = ()
 
-    text = soup.get_text().strip()
+    text = htmltext.get_text(r.text, drop=drop).strip()
     text = re.sub('\n\n+\n', '\n\n', text)
     text = [x.strip() for x in text.split('\n')]
 
@@ -77,7 +82,7 @@ def _load_bts(identifier: str) -> List[str]:
     return text
 
 
-def _load_html_raw(url: str) -> List[str]:
+def _load_html_raw(url: str, *, source: str = 'html') -> List[str]:
     '''
     read the raw HTML.
     XXX: if we do not preprocess the raw HTML, the input sequence to LLM
@@ -85,7 +90,7 @@ def _load_html_raw(url: str) -> List[str]:
     when the length exceeds a certain value, depending on the CUDA memory
     available in the backend machine.
     '''
-    r = requests.get(url)
+    r = web.get(url, source=source)
     text = r.text.strip()
     text = re.sub('\n\n+\n', '\n\n', text)
     text = [x.strip() for x in text.split('\n')]
@@ -98,14 +103,143 @@ def _load_file(path: str) -> List[str]:
     return lines
 
 
-def _load_cmdline(cmd: Union[str, List]) -> List[str]:
+# budgets of the command line loaders (--cmd, --man, --tldr)
+CMD_MAX_BYTES = 4 * 2**20
+CMD_MAX_LINES = 50000
+CMD_TIMEOUT = 60.0
+
+
+async def _arun_cmdline(cmd: Union[str, List], *,
+                        max_bytes: int = CMD_MAX_BYTES,
+                        max_lines: int = CMD_MAX_LINES,
+                        timeout: float = CMD_TIMEOUT
+                        ) -> Tuple[List[str], bool]:
+    '''
+    run the command, reading its stdout incrementally until the end, or
+    until the byte / line budget or the timeout runs out. In the latter
+    cases the command is killed, and a note is appended to the lines.
+    Returns the lines, and whether the command timed out.
+    '''
+    import asyncio
+    import codecs
     if isinstance(cmd, str):
         cmd = cmd.split(' ')
-    stdout = subprocess.check_output(cmd).decode()
-    lines = [x.rstrip() for x in stdout.split('\n')]
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, stdout=asyncio.subprocess.PIPE, start_new_session=True)
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    lines, partial, nbytes, note = [], '', 0, None
+    timed_out = False
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise asyncio.TimeoutError
+            chunk = await asyncio.wait_for(proc.stdout.read(2**16), remaining)
+            if not chunk:
+                partial += decoder.decode(b'', final=True)
+                break
+            chunk = chunk[:max_bytes - nbytes]
+            nbytes += len(chunk)
+            pieces = (partial + decoder.decode(chunk)).split('\n')
+            partial = pieces.pop(-1)
+            lines.extend(pieces)
+            if len(lines) >= max_lines:
+                del lines[max_lines:]
+                partial = None
+                note = f'[... output truncated at {max_lines} lines ...]'
+                break
+            if nbytes >= max_bytes:
+                note = f'[... output truncated at {max_bytes} bytes ...]'
+                break
+    except asyncio.TimeoutError:
+        note = f'[... command timed out after {timeout}s ...]'
+        timed_out = True
+    if note is not None:
+        # kill the whole process group, as children keep the pipe open
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    returncode = await proc.wait()
+    if note is None and returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
+    if partial is not None:
+        lines.append(partial)
+    if note is not None:
+        lines.append(note)
+    return [x.rstrip() for x in lines], timed_out
+
+
+def _load_cmdline(cmd: Union[str, List], **limits) -> List[str]:
+    import asyncio
+    lines, _ = asyncio.run(_arun_cmdline(cmd, **limits))
+    return lines
+
+
+def _cmd_cache_path(debgpt_home: str, key: Dict) -> str:
+    digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+    return os.path.join(debgpt_home, 'cmd_cache', digest + '.txt')
+
+
+async def _arun_cached(cmd: str, key: Optional[Dict],
+                       debgpt_home: Optional[str], **limits) -> List[str]:
+    '''
+    like _arun_cmdline, but the output is cached in debgpt_home under the
+    given key (no caching if key or debgpt_home is None).
+    '''
+    path = None if key is None or debgpt_home is None \
+        else _cmd_cache_path(debgpt_home, dict(key, limits=limits))
+    if path is not None and os.path.exists(path):
+        with open(path, 'rt') as f:
+            return f.read().split('\n')
+    lines, timed_out = await _arun_cmdline(cmd, **limits)
+    if path is not None and not timed_out:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wt') as f:
+            f.write('\n'.join(lines))
+        os.replace(tmp, path)
     return lines
 
 
+async def _man_key(name: str) -> Optional[Dict]:
+    '''
+    identify the man page by its source file. It changes together with the
+    version of the package shipping it.
+    '''
+    import asyncio
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            'man', '-w', *name.split(' '), stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL)
+        try:
+            stdout, _ = await asyncio.wait_for(proc.communicate(), 10)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            return None
+        st = os.stat(stdout.decode().strip())
+    except (OSError, ValueError):
+        return None
+    return {'man': name, 'path': stdout.decode().strip(), 'size': st.st_size,
+            'mtime_ns': st.st_mtime_ns}
+
+
+def _tldr_key(name: str) -> Optional[Dict]:
+    '''
+    identify the tldr page by the client. The clients update their pages
+    on their own, so the entries also expire weekly.
+    '''
+    client = shutil.which('tldr')
+    if client is None:
+        return None
+    client = os.path.realpath(client)
+    return {'tldr': name, 'client': client,
+            'mtime_ns': os.stat(client).st_mtime_ns,
+            'week': int(time.time() // (7 * 86400))}
+
+
 def _load_stdin() -> List[str]:
     lines = [x.rstrip() for x in sys.stdin.readlines()]
     return lines
@@ -122,9 +256,9 @@ def archw(identifier: str):
     https://wiki.archlinux.org/title/Archiving_and_compression
     '''
     url = f'https://wiki.archlinux.org/title/{identifier}'
-    r = requests.get(url)
-    soup = BeautifulSoup(r.text, features='html.parser')
-    text = soup.get_text().split('\n')
+    from . import htmltext
+    r = web.get(url, source='archw')
+    text = htmltext.get_text(r.text).split('\n')
     lines = [f'Here is the Arch Wiki about {identifier}:']
     lines.extend(['```', *text, '```', ''])
     return '\n'.join(lines)
@@ -142,7 +276,10 @@ def html(url: str, *, raw: bool = False):
 
 def buildd(p: str, *, suite: str = 'sid', raw: bool = False):
     url = f'https://buildd.debian.org/status/package.php?p={p}&suite={suite}'
-    text = _load_html_raw(url) if raw else _load_html(url)
+    if raw:
+        text = _load_html_raw(url, source='buildd')
+    else:
+        text = _load_html(url, source='buildd')
     lines = [
         f'The following is the build status of package {p}:']
     lines.extend(['```'] + text + ['```', ''])
@@ -160,7 +297,9 @@ def policy(section: str, *, debgpt_home: str):
     '''
     the policy cache in plain text format will be stored in debgpt_home
     '''
-    doc = debgpt_policy.DebianPolicy(os.path.join(debgpt_home, 'policy.txt'))
+    from . import policy as debgpt_policy
+    doc = debgpt_policy.DebianPolicy.shared(
+        os.path.join(debgpt_home, 'policy.txt'))
     text = doc[section].split('\n')
     lines = [f'''The following is the section {section} of Debian Policy:''']
     lines.extend(['```'] + text + ['```', ''])
@@ -171,7 +310,9 @@ def devref(section: str, *, debgpt_home: str):
     '''
     similar to policy, the devref cache will be stored in debgpt_home
     '''
-    doc = debgpt_policy.DebianDevref(os.path.join(debgpt_home, 'devref.txt'))
+    from . import policy as debgpt_policy
+    doc = debgpt_policy.DebianDevref.shared(
+        os.path.join(debgpt_home, 'devref.txt'))
     text = doc[section].split('\n')
     lines = [
         f'''The following is the section {section} of Debian Developer's Reference:''']
@@ -179,41 +320,94 @@ def devref(section: str, *, debgpt_home: str):
     return '\n'.join(lines)
 
 
-def man(name: str):
-    text = _load_cmdline(f'man {name}')
+def _search(doc, name: str, query: str, k: int) -> str:
+    numbers = doc.search(query, k)
+    if not numbers:
+        return f'''No section of {name} matches "{query}".\n'''
+    lines = [f'''The following are the sections of {name} most relevant to "{query}":''']
+    for number in numbers:
+        lines.extend(['```'] + doc.section(number).split('\n') + ['```', ''])
+    return '\n'.join(lines)
+
+
+def policy_search(query: str, *, debgpt_home: str, k: int = 3):
+    '''
+    only the k sections of the policy that are most relevant to the query
+    '''
+    from . import policy as debgpt_policy
+    doc = debgpt_policy.DebianPolicy.shared(
+        os.path.join(debgpt_home, 'policy.txt'))
+    return _search(doc, 'Debian Policy', query, k)
+
+
+def devref_search(query: str, *, debgpt_home: str, k: int = 3):
+    from . import policy as debgpt_policy
+    doc = debgpt_policy.DebianDevref.shared(
+        os.path.join(debgpt_home, 'devref.txt'))
+    return _search(doc, "Debian Developer's Reference", query, k)
+
+
+async def aman(name: str, *, debgpt_home: Optional[str] = None, **limits):
+    '''
+    the man page, cached in debgpt_home if specified.
+    '''
+    key = await _man_key(name) if debgpt_home is not None else None
+    text = await _arun_cached(f'man {name}', key, debgpt_home, **limits)
     lines = [f'''The following is the manual page of {name}:''']
     lines.extend(['```'] + text + ['```', ''])
     return '\n'.join(lines)
 
 
-def tldr(name: str):
-    text = _load_cmdline(f'tldr {name}')
+def man(name: str, **kwargs):
+    import asyncio
+    return asyncio.run(aman(name, **kwargs))
+
+
+async def atldr(name: str, *, debgpt_home: Optional[str] = None, **limits):
+    key = _tldr_key(name) if debgpt_home is not None else None
+    text = await _arun_cached(f'tldr {name}', key, debgpt_home, **limits)
     lines = [f'''The following is the tldr of the program {name}:''']
     lines.extend(['```'] + text + ['```', ''])
     return '\n'.join(lines)
 
 
-def command_line(cmd: str):
-    text = _load_cmdline(cmd)
+def tldr(name: str, **kwargs):
+    import asyncio
+    return asyncio.run(atldr(name, **kwargs))
+
+
+async def acommand_line(cmd: str, **limits):
+    text, _ = await _arun_cmdline(cmd, **limits)
     lines = [f'''The following is the output of command line `{cmd}`:''']
     lines.extend(['```'] + text + ['```', ''])
     return '\n'.join(lines)
 
 
+def command_line(cmd: str, **limits):
+    import asyncio
+    return asyncio.run(acommand_line(cmd, **limits))
+
+
 def stdin():
     text = _load_stdin()
     return '\n'.join(text)
 
 
-def file(path: str):
+def file(path: str, *, debgpt_home: Optional[str] = None):
+    '''
+    the file. path:start-end selects a range of lines, like a python slice,
+    e.g., setup.py:1-10, or build.log:-500- for the last 500 lines. Only
+    the selected lines are read, see lineindex.
+    '''
     if ':' in path:
         # it is a special syntax to specify line range e.g. setup.py:1-10
-        path, lrange = path.split(':')
-        text = _load_file(path)
-        start, end = re.match(r'^(\d*)-(\d*)', lrange).groups()
+        path, lrange = path.rsplit(':', 1)
+        start, end = re.match(r'^(-?\d*)-(-?\d*)', lrange).groups()
         start = int(start) if start else None
         end = int(end) if end else None
-        text = text[start:end]
+        from . import lineindex
+        text = lineindex.read_lines(path, start, end, None if debgpt_home is None
+                                    else os.path.join(debgpt_home, 'line_index'))
     else:
         text = _load_file(path)
     lines = [f'''The following is a file named {path}:''']
@@ -238,7 +432,8 @@ def pynew(version_section: str):
         version, section = version_section, None
     # retrieve webpage
     url = f'https://docs.python.org/3/whatsnew/{version}.html'
-    doc = requests.get(url).text
+    from bs4 import BeautifulSoup
+    doc = web.get(url, source='pynew').text
     soup = BeautifulSoup(doc, features='html.parser')
     sections = [x.attrs['id'] for x in soup.find_all('section')]
     # extract information from webpage
@@ -44,6 +44,11 @@ class Config(object):
             # CLI/Frontend Bebavior
             'frontend': 'openai',
             'debgpt_home': HOME,
+            'jobs': 1,
+            'context_window': 0,
+            # on-disk cache of LLM replies (opt-in). size in MiB
+            'response_cache': False,
+            'response_cache_size': 64,
             # LLM Inference Parameters
             'temperature': 0.5,
             'top_p': 1.0,
@@ -53,6 +58,14 @@ class Config(object):
             'openai_api_key': 'empty',
             # ZMQ Frontend Specific
             'zmq_backend': 'tcp://localhost:11177',
+            # HTTP cache for the web loaders. {source: seconds}
+            'http_cache_ttl': {},
+            'http_timeout': 30.0,
+            'http_retries': 3,
+            # budgets of the command line loaders (--cmd, --man, --tldr)
+            'cmd_timeout': 60.0,
+            'cmd_max_lines': 50000,
+            'cmd_max_bytes': 4 * 2**20,
         }
         # the built-in defaults will be overriden by config file
         if not os.path.exists(home):
@@ -118,6 +131,26 @@ def print_fortune_question_templates():
     console.print(FORTUNE_QUESTIONS)
 
 
+########################
+# Context Windows
+########################
+
+# number of tokens in the context window of known models. The keys are
+# either the OpenAI model name (--openai_model), or the LLM class name of
+# the self-hosted backend (debgpt backend --llm).
+CONTEXT_WINDOWS = {
+    'gpt-3.5-turbo': 4096,
+    'gpt-3.5-turbo-16k': 16385,
+    'gpt-3.5-turbo-1106': 16385,
+    'gpt-4': 8192,
+    'gpt-4-32k': 32768,
+    'gpt-4-1106-preview': 128000,
+    'gpt-4-turbo-preview': 128000,
+    'Mistral7B': 32768,
+    'Mixtral8x7B': 32768,
+}
+
+
 ########################
 # System Messages
 ########################
@@ -21,17 +21,23 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 '''
-from typing import List, Dict, Union
+from typing import List, Dict, Optional, Union
 from rich.status import Status
 from rich.panel import Panel
 from rich.markup import escape
 import argparse
+import hashlib
 import os
 import json
+import random
 import rich
+import time
 import uuid
 import sys
+import threading
 from . import defaults
+from . import journal
+from . import tokens
 console = rich.get_console()
 
 
@@ -49,6 +55,68 @@ def _check(messages: List[Dict]):
     assert all(x['role'] in ('system', 'user', 'assistant') for x in messages)
 
 
+class ResponseCache(object):
+    '''
+    on-disk cache of LLM replies. The key is the hash of the whole session
+    and the parameters that affect the reply (model, sampling parameters).
+    Each reply is a small JSON file, whose mtime tracks the last use. The
+    least recently used ones are deleted once the total size exceeds
+    max_bytes.
+    '''
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(messages: List[Dict], params: Dict) -> str:
+        blob = json.dumps({'messages': messages, 'params': params},
+                          sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(blob.encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, key: str) -> Optional[str]:
+        try:
+            with open(self._path(key), 'rt') as f:
+                reply = json.load(f)['reply']
+            os.utime(self._path(key))
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            return None
+        return reply
+
+    def put(self, key: str, reply: str) -> None:
+        # write then rename, so that concurrent readers never see partial data
+        tmp = f'{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wt') as f:
+            json.dump({'reply': reply}, f)
+        os.replace(tmp, self._path(key))
+        self._evict()
+
+    def _evict(self) -> None:
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime_ns, st.st_size, path))
+        total = sum(size for (_, size, _) in entries)
+        for (_, size, path) in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
 class AbstractFrontend():
     '''
     The frontend instance holds the whole chat session. The context is the whole
@@ -63,6 +131,16 @@ class AbstractFrontend():
         self.uuid = uuid.uuid4()
         self.session = []
         self.debgpt_home = args.debgpt_home
+        self.token_counter = tokens.TokenCounter()
+        # every turn is appended to the journal as soon as it completes
+        self.session_journal = journal.Journal(
+            os.path.join(self.debgpt_home, f'{self.uuid}.jsonl'))
+        self.response_cache = None
+        if getattr(args, 'response_cache', False) \
+                and not getattr(args, 'no_response_cache', False):
+            self.response_cache = ResponseCache(
+                os.path.join(self.debgpt_home, 'response_cache'),
+                getattr(args, 'response_cache_size', 64) * 2**20)
         console.log(f'{self.NAME}> Starting conversation {self.uuid}')
 
     def reset(self):
@@ -93,13 +171,60 @@ class AbstractFrontend():
         _check(self.session)
 
     def __call__(self, *args, **kwargs):
-        return self.query(*args, **kwargs)
+        reply = self.query(*args, **kwargs)
+        self.session_journal.sync(self.session)
+        return reply
+
+    def resume(self, path: str) -> None:
+        '''
+        continue the conversation recorded in the given journal
+        '''
+        self.session_journal.close()
+        self.session = journal.load(path)
+        self.session_journal = journal.Journal(path, self.session)
+        name = os.path.splitext(os.path.basename(path))[0]
+        try:
+            self.uuid = uuid.UUID(name)
+        except ValueError:
+            pass
+        console.log(f'{self.NAME}> Resuming conversation {self.uuid}'
+                    + f' ({len(self.session)} messages)')
+
+    def cache_params(self) -> Dict:
+        '''
+        everything other than the session that determines the reply
+        '''
+        raise NotImplementedError
+
+    def cached_reply(self, session: List[Dict]) -> Optional[str]:
+        '''
+        the cached reply to the session, if there is one.
+        '''
+        if self.response_cache is None:
+            return None
+        key = ResponseCache.key(session, self.cache_params())
+        reply = self.response_cache.get(key)
+        if reply is not None:
+            console.log(f'{self.NAME}> using the cached reply {key[:12]}')
+        return reply
+
+    def cache_reply(self, session: List[Dict], reply: str) -> None:
+        if self.response_cache is not None:
+            self.response_cache.put(
+                ResponseCache.key(session, self.cache_params()), reply)
+
+    def num_tokens(self) -> int:
+        '''
+        number of tokens in the current session. Only the messages that have
+        not been counted before are tokenized.
+        '''
+        return self.token_counter(self.session)
 
     def dump(self):
-        fpath = os.path.join(self.debgpt_home, str(self.uuid) + '.json')
-        with open(fpath, 'wt') as f:
-            json.dump(self.session, f, indent=2)
-        console.log(f'{self.NAME}> Conversation saved at {fpath}')
+        self.session_journal.sync(self.session)
+        self.session_journal.close()
+        if os.path.exists(self.session_journal.path):
+            console.log(f'{self.NAME}> Conversation saved at {self.session_journal.path}')
 
 
 class OpenAIFrontend(AbstractFrontend):
@@ -119,15 +244,25 @@ class OpenAIFrontend(AbstractFrontend):
         self.session.append({"role": "system", "content": self.system_message})
         self.model = args.openai_model
         self.kwargs = {'temperature': args.temperature, 'top_p': args.top_p}
+        self.token_counter = tokens.TokenCounter(
+            lambda: tokens.tiktoken_encoder(self.model))
         if args.verbose:
             console.log(f'{self.NAME}> model={repr(self.model)}, '
                     + f'temperature={args.temperature}, top_p={args.top_p}.')
 
+    def cache_params(self) -> Dict:
+        return {'model': self.model, **self.kwargs}
+
     def query(self, messages: Union[List, Dict, str]) -> list:
         # add the message into the session
         self.update_session(messages)
         if self.debug:
             console.log('send:', self.session[-1])
+        if (generated_text := self.cached_reply(self.session)) is not None:
+            if self.stream:
+                print(generated_text)
+            self.update_session({'role': 'assistant', 'content': generated_text})
+            return self.session[-1]['content']
         completion = self.client.chat.completions.create(
             model=self.model, messages=self.session, stream=self.stream,
             **self.kwargs)
@@ -145,6 +280,7 @@ class OpenAIFrontend(AbstractFrontend):
                 sys.stdout.flush()
         else:
             generated_text = completion.choices[0].message.content
+        self.cache_reply(self.session, generated_text)
         new_message = {'role': 'assistant', 'content': generated_text}
         self.update_session(new_message)
         if self.debug:
@@ -152,19 +288,162 @@ class OpenAIFrontend(AbstractFrontend):
         return self.session[-1]['content']
 
 
+class AsyncOpenAIFrontend(OpenAIFrontend):
+    '''
+    OpenAI frontend that can also run many independent conversations
+    concurrently, see query_many(...). At most max_concurrency requests are
+    in flight. When the server answers with a rate limit (HTTP 429) or a
+    transient error, every request backs off, honoring the Retry-After
+    header if there is one.
+    '''
+    NAME: str = 'AsyncOpenAIFrontend'
+    max_concurrency: int = 8
+    max_retries: int = 5
+    backoff: float = 1.0
+    max_backoff: float = 60.0
+
+    def __init__(self, args):
+        super().__init__(args)
+        from openai import AsyncOpenAI
+        # retries are handled by ourselves, so that all requests back off
+        self.async_client = AsyncOpenAI(api_key=args.openai_api_key,
+                                        base_url=args.openai_base_url,
+                                        max_retries=0)
+        self.verbose = args.verbose
+        # no request will be sent before this time.time()
+        self.pause_until = 0.0
+
+    def query_many(self, sessions: List[Union[List, str]],
+                   max_concurrency: Optional[int] = None) -> List[Dict]:
+        '''
+        query each of the sessions (a list of messages, or a question that
+        starts a new conversation) concurrently. self.session is left
+        untouched. Returns, in the same order, dicts of
+            messages: the session with the reply appended
+            reply: the reply text (None when failed)
+            error: the error message (None when succeeded)
+            latency: seconds from the first attempt to the reply
+            retries: number of retries
+            usage: prompt_tokens and completion_tokens, as reported by the
+                server (None when unknown, e.g., cached)
+        '''
+        import asyncio
+        return asyncio.run(self.aquery_many(sessions, max_concurrency))
+
+    async def aquery_many(self, sessions: List[Union[List, str]],
+                          max_concurrency: Optional[int] = None) -> List[Dict]:
+        import asyncio
+        semaphore = asyncio.Semaphore(max_concurrency or self.max_concurrency)
+        start = time.time()
+        results = await asyncio.gather(*[self.aquery(x, semaphore)
+                                         for x in sessions])
+        if self.verbose and results:
+            latencies = sorted(x['latency'] for x in results)
+            failed = sum(x['error'] is not None for x in results)
+            console.log(f'{self.NAME}> {len(results)} queries ({failed} failed) in'
+                        + f' {time.time() - start:.1f}s. latency:'
+                        + f' median={latencies[len(latencies)//2]:.1f}s,'
+                        + f' max={latencies[-1]:.1f}s;'
+                        + f' retries={sum(x["retries"] for x in results)}')
+        return results
+
+    async def aquery(self, session: Union[List, str], semaphore) -> Dict:
+        '''
+        query one session. semaphore is the asyncio.Semaphore capping the
+        number of requests in flight.
+        '''
+        import asyncio
+        import openai
+        if isinstance(session, str):
+            session = [{'role': 'system', 'content': self.system_message},
+                       {'role': 'user', 'content': session}]
+        _check(session)
+        result = {'messages': session, 'reply': None, 'error': None,
+                  'latency': 0.0, 'retries': 0, 'usage': None}
+        if (reply := self.cached_reply(session)) is not None:
+            result['messages'] = session + [{'role': 'assistant',
+                                             'content': reply}]
+            result['reply'] = reply
+            return result
+        async with semaphore:
+            start = time.time()
+            while True:
+                await asyncio.sleep(max(0.0, self.pause_until - time.time()))
+                try:
+                    completion = await self.async_client.chat.completions.create(
+                        model=self.model, messages=session, **self.kwargs)
+                    reply = completion.choices[0].message.content
+                    if completion.usage is not None:
+                        result['usage'] = {
+                            'prompt_tokens': completion.usage.prompt_tokens,
+                            'completion_tokens':
+                                completion.usage.completion_tokens}
+                    self.cache_reply(session, reply)
+                    result['messages'] = session + [{'role': 'assistant',
+                                                     'content': reply}]
+                    result['reply'] = reply
+                    break
+                except (openai.RateLimitError, openai.APIConnectionError,
+                        openai.InternalServerError) as e:
+                    if result['retries'] >= self.max_retries:
+                        result['error'] = f'{type(e).__name__}: {e}'
+                        break
+                    delay = self._backoff(e, result['retries'])
+                    self.pause_until = max(self.pause_until, time.time() + delay)
+                    result['retries'] += 1
+                except openai.APIError as e:
+                    result['error'] = f'{type(e).__name__}: {e}'
+                    break
+            result['latency'] = time.time() - start
+        if self.debug:
+            console.log('recv:', result)
+        return result
+
+    def _backoff(self, e: Exception, attempt: int) -> float:
+        '''
+        seconds to wait before the next attempt
+        '''
+        response = getattr(e, 'response', None)
+        if response is not None:
+            try:
+                return min(self.max_backoff,
+                           float(response.headers['retry-after']))
+            except (KeyError, ValueError):
+                pass
+        delay = self.backoff * 2 ** attempt
+        return min(self.max_backoff, delay * (0.5 + random.random()))
+
+
 class ZMQFrontend(AbstractFrontend):
     '''
     ZMQ frontend communicates with a self-hosted ZMQ backend.
+    It uses a DEALER socket, so that the backend can stream the reply back
+    piece by piece. Only the messages that the backend has not seen yet are
+    sent. See backend.ZMQBackend for the protocol.
     '''
     NAME = 'ZMQFrontend'
     debug: bool = False
-    stream: bool = False
+    stream: bool = True
+    # tokenizer of the default backend LLM, for counting tokens locally
+    tokenizer_id: str = 'mistralai/Mistral-7B-Instruct-v0.2'
 
     def __init__(self, args):
         import zmq
         super().__init__(args)
         self.zmq_backend = args.zmq_backend
-        self.socket = zmq.Context().socket(zmq.REQ)
+        self.token_counter = tokens.TokenCounter(
+            lambda: tokens.huggingface_encoder(self.tokenizer_id))
+        # number of messages of this session that the backend already has
+        self.synced = 0
+        # sampling settings (not yet supported by the backend), and the
+        # model of the backend. They are part of the response cache key.
+        self.kwargs = {'temperature': getattr(args, 'temperature', None),
+                       'top_p': getattr(args, 'top_p', None)}
+        self.backend_info: Optional[Dict] = None
+        # a context per frontend would block the garbage collector in
+        # zmq_ctx_term() when collected before its socket
+        self.socket = zmq.Context.instance().socket(zmq.DEALER)
+        self.socket.setsockopt(zmq.LINGER, 0)
         self.socket.connect(self.zmq_backend)
         console.log(
             f'{self.NAME}> Connected to ZMQ backend {self.zmq_backend}.')
@@ -175,31 +454,90 @@ class ZMQFrontend(AbstractFrontend):
         if hasattr(args, 'top_p'):
             console.log('warning! --top_p not yet supported for this frontend')
 
+    def reset(self):
+        super().reset()
+        self.synced = 0
+
+    def cache_params(self) -> Dict:
+        return {'zmq_backend': self.zmq_backend, 'backend': self.info(),
+                **self.kwargs}
+
+    def info(self) -> Dict:
+        '''
+        the model of the backend and its generation settings, asked once
+        '''
+        if self.backend_info is None:
+            self.socket.send_multipart(
+                [b'', json.dumps({'info': True}).encode()])
+            self.backend_info = json.loads(self.socket.recv_multipart()[-1])
+        return self.backend_info
+
     def query(self, content: Union[List, Dict, str]) -> list:
         if isinstance(content, list):
             self.session = content
+            self.synced = 0
         elif isinstance(content, dict):
             self.session.append(content)
         elif isinstance(content, str):
             self.session.append({'role': 'user', 'content': content})
-        _check(self.session)
-        msg_json = json.dumps(self.session)
-        if self.debug:
-            console.log('send:', msg_json)
-        self.socket.send_string(msg_json)
-        msg = self.socket.recv()
-        self.session = json.loads(msg)
-        _check(self.session)
+        if (cached := self.cached_reply(self.session)) is not None:
+            if self.stream:
+                print(cached)
+            # the backend has not seen this turn. resync on the next query.
+            self.session.append({'role': 'assistant', 'content': cached})
+            self.synced = 0
+            return cached
+        # the backend keeps the conversation. only send the new messages.
+        _check(self.session[self.synced:])
+        reply = self._request(self.session[self.synced:], self.synced)
+        if reply.get('resync', False):
+            # e.g., the backend was restarted, or has dropped this session
+            reply = self._request(self.session, 0)
+        _check([reply['message']])
+        self.cache_reply(self.session, reply['message']['content'])
+        self.session.append(reply['message'])
+        self.synced = reply['seq']
         if self.debug:
             console.log('recv:', self.session[-1])
         return self.session[-1]['content']
 
+    def _request(self, messages: List[Dict], seq: int) -> Dict:
+        msg_json = json.dumps({'uuid': str(self.uuid), 'seq': seq,
+                               'messages': messages, 'stream': self.stream})
+        if self.debug:
+            console.log('send:', msg_json)
+        # the empty frame is the delimiter that a REQ socket would add
+        self.socket.send_multipart([b'', msg_json.encode()])
+        chunks = []
+        while True:
+            frames = self.socket.recv_multipart()[1:]
+            if len(frames) == 2 and frames[0] == b'token':
+                piece = frames[1].decode()
+                chunks.append(piece)
+                print(piece, end="")
+                sys.stdout.flush()
+                continue
+            break
+        if chunks and not ''.join(chunks).endswith('\n'):
+            print()
+            sys.stdout.flush()
+        reply = json.loads(frames[-1])
+        if 'error' in reply:
+            raise RuntimeError(f'ZMQ backend: {reply["error"]}')
+        return reply
+
 
 def create_frontend(args):
     if args.frontend == 'zmq':
         frontend = ZMQFrontend(args)
     elif args.frontend == 'openai':
-        frontend = OpenAIFrontend(args)
+        # the batch task and the map-reduce mode send many queries at the
+        # same time
+        concurrent = getattr(args, 'concurrent', False) \
+            or getattr(args, 'map_reduce', False)
+        frontend = AsyncOpenAIFrontend(args) if concurrent \
+            else OpenAIFrontend(args)
+
     elif args.frontend == 'dryrun':
         frontend = None
     else:
@@ -0,0 +1,112 @@
+'''
+MIT License
+
+Copyright (c) 2024 Mo Zhou <lumin@debian.org>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+from typing import Callable, Dict, Iterable, Tuple
+from bs4 import BeautifulSoup
+try:
+    import lxml.html
+    import lxml.etree
+except ImportError:
+    lxml = None
+
+__doc__ = '''
+HTML to plain text conversion for the web loaders.
+
+The reference implementation is BeautifulSoup's get_text() over the pure
+Python html.parser. When lxml is available, a C-backed extractor is used
+instead. It produces the same text (up to whitespace outside the <html>
+element, which the loaders strip anyway), several times faster and with
+fewer copies of the page in memory.
+'''
+
+# bs4 does not count the strings inside these tags as text
+_SKIP_TAGS = frozenset({'script', 'style', 'template', 'rt', 'rp'})
+
+
+def _bs4_get_text(html: str, drop: Iterable[Tuple[str, str]]) -> str:
+    soup = BeautifulSoup(html, features='html.parser')
+    for (tag, cls) in drop:
+        _ = [x.clear() for x in soup.find_all(tag, attrs={'class': cls})]
+    return soup.get_text()
+
+
+def _lxml_get_text(html: str, drop: Iterable[Tuple[str, str]]) -> str:
+    try:
+        root = lxml.html.document_fromstring(html)
+    except (ValueError, lxml.etree.ParserError):
+        # e.g., empty documents, or str with an XML encoding declaration
+        return _bs4_get_text(html, drop)
+    for (tag, cls) in drop:
+        xpath = f'//{tag}[contains(concat(" ", normalize-space(@class), " "), " {cls} ")]'
+        for element in root.xpath(xpath):
+            # unlike bs4's clear(), lxml's clear() also drops the tail
+            tail = element.tail
+            element.clear()
+            element.tail = tail
+    chunks = []
+    # iterwalk gives us the start and end events in document order. The
+    # text of an element follows its start, and the tail follows its end.
+    # Comments and processing instructions only contribute their tails.
+    skipping = 0
+    events = ('start', 'end', 'comment', 'pi')
+    for event, element in lxml.etree.iterwalk(root, events=events):
+        if event == 'start':
+            if skipping or element.tag in _SKIP_TAGS:
+                skipping += 1
+            elif element.text:
+                chunks.append(element.text)
+            continue
+        if event == 'end' and skipping:
+            skipping -= 1
+            if skipping:
+                continue
+        elif skipping:
+            continue
+        if element.tail and element is not root:
+            chunks.append(element.tail)
+    return ''.join(chunks)
+
+
+EXTRACTORS: Dict[str, Callable[[str, Iterable[Tuple[str, str]]], str]] = {
+    'bs4': _bs4_get_text,
+}
+if lxml is not None:
+    EXTRACTORS['lxml'] = _lxml_get_text
+
+# the default extractor: the fastest one available
+extractor: str = 'lxml' if 'lxml' in EXTRACTORS else 'bs4'
+
+
+def set_extractor(name: str) -> None:
+    global extractor
+    if name not in EXTRACTORS:
+        raise ValueError(f'unavailable HTML extractor {name}')
+    extractor = name
+
+
+def get_text(html: str, *, drop: Iterable[Tuple[str, str]] = ()) -> str:
+    '''
+    convert HTML into plain text, like BeautifulSoup(...).get_text().
+    drop: (tag, class) pairs. The contents of matching elements are removed.
+    '''
+    return EXTRACTORS[extractor](html, drop)
@@ -0,0 +1,117 @@
+'''
+MIT License
+
+Copyright (c) 2024 Mo Zhou <lumin@debian.org>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+from typing import Dict, Iterator, List, Optional
+import json
+import os
+
+__doc__ = '''
+Append-only session journal in the JSONL format.
+
+Each line is a chat message {"role": ..., "content": ...}, written and
+flushed as soon as its turn completes, so a crash loses at most the turn in
+progress, and the cost of each turn does not depend on the session length.
+A {"reset": true} line means the session was cleared (or replaced by the
+messages following it).
+'''
+
+
+class Journal(object):
+    '''
+    writes the messages of a session to the journal incrementally.
+    '''
+
+    def __init__(self, path: str, session: Optional[List[Dict]] = None):
+        self.path = path
+        self.file = None
+        # the session list being journaled, and how many of its messages
+        # are already in the journal
+        self.session = session
+        self.written = 0 if session is None else len(session)
+
+    def _write(self, records: List[Dict]) -> None:
+        if self.file is None:
+            self.file = open(self.path, 'at')
+        self.file.write(''.join(json.dumps(x) + '\n' for x in records))
+        self.file.flush()
+
+    def sync(self, session: List[Dict]) -> None:
+        '''
+        append the messages of the session that are not journaled yet. If
+        the session was cleared or replaced since the last call, a reset
+        record is written first, then the whole session.
+        '''
+        records = []
+        if session is not self.session or len(session) < self.written:
+            if self.session is not None:
+                records.append({'reset': True})
+            self.session, self.written = session, 0
+        records.extend(session[self.written:])
+        if records:
+            self._write(records)
+        self.written = len(session)
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def read(path: str) -> Iterator[Dict]:
+    '''
+    iterate over the records of a journal. A truncated last line (e.g.,
+    after a crash) is ignored.
+    '''
+    with open(path, 'rt') as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                if line.endswith('\n'):
+                    raise
+                return
+
+
+def load(path: str) -> List[Dict]:
+    '''
+    the latest state of the session recorded in the journal
+    '''
+    session = []
+    for record in read(path):
+        if record.get('reset', False):
+            session = []
+        else:
+            session.append(record)
+    return session
+
+
+def locate(spec: str, debgpt_home: str) -> str:
+    '''
+    find the journal of a session, given its path or UUID
+    '''
+    if os.path.exists(spec):
+        return spec
+    path = os.path.join(debgpt_home, spec + '.jsonl')
+    if os.path.exists(path):
+        return path
+    raise FileNotFoundError(f'no session journal found for {spec}')
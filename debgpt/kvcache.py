@@ -0,0 +1,231 @@
+'''
+MIT License
+
+Copyright (c) 2024 Mo Zhou <lumin@debian.org>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Sequence, Tuple
+
+
+def common_prefix(a: Sequence[int], b: Sequence[int]) -> int:
+    '''
+    length of the longest common prefix of two token sequences
+    '''
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+class SessionCache(object):
+    '''
+    Computed key/value states (past_key_values) of the latest processed
+    prefix of each conversation, so that a follow-up turn only has to
+    prefill the new tokens. The entries are evicted in least-recently-used
+    order, once the total size exceeds max_bytes.
+
+    The cache does not care what the states are. The caller has to tell
+    their size, and cut them down to the reused prefix.
+    '''
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        # key -> (token ids, states, size in bytes)
+        self.entries: OrderedDict = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def take(self, key: Hashable, ids: Sequence[int]) -> Tuple[int, Optional[Any]]:
+        '''
+        remove the entry of the given conversation from the cache, and
+        return (number of reusable tokens, states). The states are modified
+        in place during generation, so they are not shared. put() them back
+        when done. (0, None) means a miss.
+        '''
+        if key is None or key not in self.entries:
+            self.misses += 1
+            return 0, None
+        cached, states, nbytes = self.entries.pop(key)
+        self.nbytes -= nbytes
+        matched = common_prefix(cached, ids)
+        if matched == 0:
+            self.misses += 1
+            return 0, None
+        self.hits += 1
+        return matched, states
+
+    def put(self, key: Hashable, ids: Sequence[int], states: Any,
+            nbytes: int) -> None:
+        if key is None:
+            return
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key)[2]
+        if nbytes > self.max_bytes:
+            return
+        self.entries[key] = (list(ids), states, nbytes)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            _, (_, _, size) = self.entries.popitem(last=False)
+            self.nbytes -= size
+
+
+class _Node(object):
+    __slots__ = ('ids', 'states', 'nbytes', 'parent', 'children', 'last')
+
+    def __init__(self, ids: List[int], states: Any, nbytes: int,
+                 parent: Optional['_Node']):
+        self.ids = ids
+        self.states = states
+        self.nbytes = nbytes
+        self.parent = parent
+        self.children: Dict[int, '_Node'] = {}
+        self.last = 0
+
+
+class RadixCache(object):
+    '''
+    Prefix tree (radix tree) of computed key/value states, shared across
+    all conversations. Each edge holds a run of tokens and the states of
+    exactly those tokens, so a common prefix, e.g. the system message or a
+    popular policy section, is stored once. A request walks down the tree,
+    and only has to prefill the tokens after the longest cached prefix.
+
+    The states are opaque. slice(states, start, end) has to return a copy
+    of the states of tokens [start, end), and nbytes(states) their size.
+    Least recently used leaves are evicted once the total size exceeds
+    max_bytes.
+    '''
+
+    def __init__(self, max_bytes: int, slice: Callable[[Any, int, int], Any],
+                 nbytes: Callable[[Any], int]):
+        self.max_bytes = max_bytes
+        self.slice = slice
+        self.sizeof = nbytes
+        self.root = _Node([], None, 0, None)
+        self.nbytes = 0
+        self.tick = 0
+        # statistics
+        self.hits = 0
+        self.misses = 0
+        self.hit_tokens = 0
+        self.total_tokens = 0
+
+    def __repr__(self):
+        ratio = self.hit_tokens / max(1, self.total_tokens)
+        return (f'hits={self.hits}, misses={self.misses}, '
+                + f'reused_tokens={self.hit_tokens}/{self.total_tokens} ({100*ratio:.1f}%), '
+                + f'size={self.nbytes/2**20:.1f}MiB')
+
+    def _walk(self, ids: Sequence[int]) -> List[Tuple[_Node, int]]:
+        '''
+        the list of (node, number of matched tokens of its edge) along the
+        path of the longest cached prefix of ids. Only the last edge may be
+        matched partially. The path is complete before anyone modifies the
+        tree (see insert).
+        '''
+        self.tick += 1
+        path = []
+        node, pos = self.root, 0
+        while pos < len(ids):
+            child = node.children.get(ids[pos], None)
+            if child is None:
+                break
+            n = common_prefix(child.ids, ids[pos:pos + len(child.ids)])
+            child.last = self.tick
+            path.append((child, n))
+            if n < len(child.ids):
+                break
+            node, pos = child, pos + n
+        return path
+
+    def match(self, ids: Sequence[int]) -> Tuple[int, List[Any]]:
+        '''
+        return the length of the longest cached prefix of ids, and the list
+        of states covering it, in order.
+        '''
+        matched, segments = 0, []
+        for node, n in self._walk(ids):
+            segments.append(node.states if n == len(node.ids)
+                            else self.slice(node.states, 0, n))
+            matched += n
+        if matched > 0:
+            self.hits += 1
+        else:
+            self.misses += 1
+        self.hit_tokens += matched
+        self.total_tokens += len(ids)
+        return matched, segments
+
+    def insert(self, ids: Sequence[int], states: Any) -> None:
+        '''
+        add the states of the token sequence ids (states cover at least
+        len(ids) tokens, starting from the first one).
+        '''
+        node, pos = self.root, 0
+        for child, n in self._walk(ids):
+            if n < len(child.ids):
+                child = self._split(child, n)
+            node, pos = child, pos + n
+        if pos < len(ids):
+            leaf_states = self.slice(states, pos, len(ids))
+            leaf = _Node(list(ids[pos:]), leaf_states,
+                         self.sizeof(leaf_states), node)
+            leaf.last = self.tick
+            node.children[leaf.ids[0]] = leaf
+            self.nbytes += leaf.nbytes
+        self._evict()
+
+    def _split(self, node: _Node, n: int) -> _Node:
+        '''
+        split the edge of node after n tokens. returns the new upper node.
+        '''
+        head = self.slice(node.states, 0, n)
+        tail = self.slice(node.states, n, len(node.ids))
+        upper = _Node(node.ids[:n], head, self.sizeof(head), node.parent)
+        upper.last = node.last
+        node.parent.children[upper.ids[0]] = upper
+        self.nbytes -= node.nbytes
+        node.ids, node.states, node.nbytes = node.ids[n:], tail, self.sizeof(tail)
+        node.parent = upper
+        upper.children[node.ids[0]] = node
+        self.nbytes += upper.nbytes + node.nbytes
+        return upper
+
+    def _leaves(self) -> List[_Node]:
+        leaves, stack = [], [self.root]
+        while stack:
+            node = stack.pop()
+            if node.children:
+                stack.extend(node.children.values())
+            elif node is not self.root:
+                leaves.append(node)
+        return leaves
+
+    def _evict(self) -> None:
+        while self.nbytes > self.max_bytes:
+            leaf = min(self._leaves(), key=lambda x: x.last)
+            del leaf.parent.children[leaf.ids[0]]
+            self.nbytes -= leaf.nbytes
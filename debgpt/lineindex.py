@@ -0,0 +1,194 @@
+'''
+MIT License
+
+Copyright (c) 2024 Mo Zhou <lumin@debian.org>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+from typing import List, Optional
+from array import array
+import bisect
+import hashlib
+import json
+import mmap
+import os
+import re
+import threading
+
+__doc__ = '''
+Read a range of lines from a large file without reading the whole file.
+
+The file is memory-mapped. Lines end with \n, \r\n or a bare \r (e.g., the
+progress bars in build logs), like in a file opened in text mode, so that
+the lines are the same as those of the whole file. The line index is
+sparse: it records the number of line breaks before every CHUNK bytes, so
+that the start of any line is found by scanning at most one chunk. It is built in one pass and cached
+next to the other debgpt data, keyed on the file identity. The lines
+counted from the end of the file (negative bounds) need no index at all,
+they are found by scanning backwards from the end.
+'''
+
+# granularity of the sparse index, in bytes
+CHUNK = 2**16
+
+# smaller files are indexed on the fly, without caching the index
+CACHE_MIN_BYTES = 2**20
+
+# universal newlines
+BREAK = re.compile(rb'\r\n?|\n')
+
+
+class LineIndex(object):
+    '''
+    counts[k] is the number of line breaks that end in mm[:k * CHUNK]. The
+    last entry is the number of line breaks in the whole file.
+    '''
+
+    def __init__(self, counts: array):
+        self.counts = counts
+
+    @classmethod
+    def build(cls, mm) -> 'LineIndex':
+        counts = array('Q', [0])
+        for pos in range(0, len(mm), CHUNK):
+            chunk = mm[pos:pos + CHUNK]
+            n = chunk.count(b'\n') + chunk.count(b'\r') - chunk.count(b'\r\n')
+            if chunk.endswith(b'\r') and mm[pos + CHUNK:pos + CHUNK + 1] == b'\n':
+                # \r\n across chunks ends in the next one
+                n -= 1
+            counts.append(counts[-1] + n)
+        return cls(counts)
+
+    def offset(self, mm, line: int) -> int:
+        '''
+        byte offset where the given (0-based) line starts, or the file size
+        when the file has no such line.
+        '''
+        if line <= 0:
+            return 0
+        if line > self.counts[-1]:
+            return len(mm)
+        # the chunk where the line-th line break ends
+        k = bisect.bisect_left(self.counts, line) - 1
+        pos = k * CHUNK
+        for _ in range(line - self.counts[k]):
+            pos = BREAK.search(mm, pos).end()
+        return pos
+
+    def save(self, path: str, key: str) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(json.dumps({'key': key, 'chunk': CHUNK,
+                                'newlines': 'universal'}).encode() + b'\n')
+            self.counts.tofile(f)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str, key: str) -> Optional['LineIndex']:
+        try:
+            with open(path, 'rb') as f:
+                header = json.loads(f.readline())
+                if header != {'key': key, 'chunk': CHUNK,
+                              'newlines': 'universal'}:
+                    return None
+                counts = array('Q')
+                counts.frombytes(f.read())
+        except (OSError, ValueError):
+            return None
+        return cls(counts)
+
+
+def _file_key(path: str) -> str:
+    st = os.stat(path)
+    return f'{os.path.realpath(path)}:{st.st_size}:{st.st_mtime_ns}'
+
+
+def index(mm, path: str, cache_dir: Optional[str] = None) -> LineIndex:
+    '''
+    the line index of the file, cached in cache_dir for large files
+    '''
+    if cache_dir is None or len(mm) < CACHE_MIN_BYTES:
+        return LineIndex.build(mm)
+    key = _file_key(path)
+    cache = os.path.join(cache_dir, hashlib.sha256(
+        os.path.realpath(path).encode()).hexdigest() + '.idx')
+    idx = LineIndex.load(cache, key)
+    if idx is None:
+        idx = LineIndex.build(mm)
+        idx.save(cache, key)
+    return idx
+
+
+def tail_offset(mm, n: int) -> int:
+    '''
+    byte offset where the last n lines start. The file is scanned backwards
+    by chunks.
+    '''
+    pos = len(mm)
+    # the final line break terminates the last line
+    if mm[pos - 2:pos] == b'\r\n':
+        pos -= 2
+    elif mm[pos - 1:pos] in (b'\n', b'\r'):
+        pos -= 1
+    while pos > 0:
+        start = max(0, pos - CHUNK)
+        if mm[start - 1:start + 1] == b'\r\n':
+            # do not split \r\n
+            start -= 1
+        ends = [m.end() for m in BREAK.finditer(mm, start, pos)]
+        if len(ends) >= n:
+            return ends[-n]
+        n -= len(ends)
+        pos = start
+    return 0
+
+
+def read_lines(path: str, start: Optional[int] = None,
+               end: Optional[int] = None,
+               cache_dir: Optional[str] = None) -> List[str]:
+    '''
+    the lines [start:end] of the file (python slice semantics, negative
+    bounds count from the end), stripped of trailing whitespace.
+    '''
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            idx = None
+
+            def _offset(line: Optional[int], default: int) -> int:
+                nonlocal idx
+                if line is None:
+                    return default
+                if line < 0:
+                    return tail_offset(mm, -line)
+                if idx is None:
+                    idx = index(mm, path, cache_dir)
+                return idx.offset(mm, line)
+            begin = _offset(start, 0)
+            stop = _offset(end, len(mm))
+            if begin >= stop:
+                return []
+            text = mm[begin:stop].decode('utf-8', errors='replace')
+    lines = re.split(r'\r\n?|\n', text)
+    if lines[-1] == '':
+        # the text ends with a line break
+        lines.pop()
+    return [x.rstrip() for x in lines]
@@ -23,28 +23,62 @@ SOFTWARE.
 '''
 import json
 import os
+import queue
+import shutil
+import threading
+import time
 from prompt_toolkit import prompt
 from prompt_toolkit.styles import Style
 from transformers import pipeline, Conversation
 from transformers import AutoModelForCausalLM, AutoTokenizer
 import transformers
-from transformers import TextStreamer
+from transformers import TextStreamer, TextIteratorStreamer, DynamicCache
+from threading import Thread
 import torch as th
-from typing import Union, List, Dict
+from typing import Union, List, Dict, Optional
 import argparse
 import rich
+from . import kvcache
 console = rich.get_console()
 
 
 class AbstractLLM(object):
+    # past key/values, keyed by conversation, and shared by all requests
+    # in a prefix tree (see kvcache.py)
+    kv_cache: Optional[kvcache.SessionCache] = None
+    prefix_cache: Optional[kvcache.RadixCache] = None
+
     def __init__(self):
         self.device = 'cuda' if th.cuda.is_available() else 'cpu'
 
+    def enable_kv_cache(self, max_bytes: int):
+        self.kv_cache = kvcache.SessionCache(max_bytes)
+
+    def enable_prefix_cache(self, max_bytes: int):
+        self.prefix_cache = kvcache.RadixCache(max_bytes, slice=_slice_states,
+                                               nbytes=_nbytes)
+
+    def uses_cache(self, session: Optional[str]) -> bool:
+        return self.prefix_cache is not None or \
+            (self.kv_cache is not None and session is not None)
+
     @th.no_grad()
-    def generate(self, messages: Union[list, str]):
-        # Used by backend.py for serving a client
+    def generate(self, messages: Union[list, str], session: Optional[str] = None):
+        # Used by backend.py for serving a client. The session identifies
+        # the conversation, for implementations that cache its prefix.
         raise NotImplementedError
 
+    @th.no_grad()
+    def generate_batch(self, batch: List[List[Dict]]):
+        # Used by backend.py for serving several clients at once
+        return [self.generate(messages) for messages in batch]
+
+    def generate_stream(self, messages: List[Dict], session: Optional[str] = None):
+        # Used by backend.py for streaming. Yields pieces of the generated
+        # text, and appends the new message to messages in the end.
+        messages = self.generate(messages, session)
+        yield messages[-1]['content']
+
     @th.no_grad()
     def __call__(self, *args, **kwargs):
         return self.generate(*args, **kwargs)
@@ -65,19 +99,22 @@ class Mistral7B(AbstractLLM):
     NAME = 'Mistral7B'
     model_id = 'mistralai/Mistral-7B-Instruct-v0.2'
     is_pipeline = True
+    # seconds to wait for the next token when streaming
+    stream_timeout: float = 300.0
 
-    def __init__(self, *, device: str, precision: str):
+    def __init__(self, *, device: str, precision: str,
+                 debgpt_home: Optional[str] = None, warmup: bool = True):
         '''
         torch_dtype: th.float32 requires 32GB CUDA memory.
                      th.float16/th.bfloat16 requires 16GB CUDA memory.
                      th.float16 has better hardware compatibility than bfloat16.
                      th.float16 has better compatibility than bfloat16.
+        debgpt_home: where the prepared weights are looked for (see prepare).
+                     They are loaded directly, without quantizing again.
         '''
         super().__init__()
         self.device = device  # overrride abstract class
-        console.log(
-            f'{self.NAME}> Loading {self.model_id} ({device}/{precision})')
-        self.tok = AutoTokenizer.from_pretrained(self.model_id)
+        self.precision = precision
         llm_kwargs = {'torch_dtype': th.float16,
                       'load_in_8bit': False, 'load_in_4bit': False}
         if precision == 'fp16':
@@ -93,16 +130,62 @@ class Mistral7B(AbstractLLM):
             llm_kwargs['bnb_4bit_compute_dtype'] = th.float16
         else:
             raise NotImplementedError(precision)
+        # the prepared weights, unless they were made from another model,
+        # revision or dtype. Stale ones are prepared again after loading.
+        self.prepared_mark = {'model_id': self.model_id,
+                              'revision': _revision(self.model_id),
+                              'precision': precision,
+                              'dtype': str(llm_kwargs['torch_dtype'])}
+        prepared, stale = None, None
+        if debgpt_home is not None:
+            path = prepared_path(debgpt_home, self.model_id, precision)
+            mark = read_mark(path)
+            if mark is not None and matches(mark, self.prepared_mark):
+                prepared = path
+            elif mark is not None:
+                console.log(f'{self.NAME}> Prepared weights at {path} are'
+                            + f' stale ({mark}). Preparing them again.')
+                stale = path
+        source = self.model_id if prepared is None else prepared
+        console.log(
+            f'{self.NAME}> Loading {source} ({device}/{precision})')
+        timings = {}
+        start = time.time()
+        self.tok = AutoTokenizer.from_pretrained(source)
+        # batched generation with a decoder-only model pads on the left
+        self.tok.padding_side = 'left'
+        if self.tok.pad_token is None:
+            self.tok.pad_token = self.tok.eos_token
+        timings['tokenizer'] = time.time() - start
+        start = time.time()
+        if prepared is not None:
+            # the quantization config is stored along with the weights, and
+            # the safetensors files are memory-mapped instead of read.
+            llm_kwargs = {'torch_dtype': llm_kwargs['torch_dtype'],
+                          'low_cpu_mem_usage': True}
         if self.is_pipeline:
-            self.llm = transformers.pipeline('text-generation', model=self.model_id,
+            self.llm = transformers.pipeline('text-generation', model=source,
                                              model_kwargs=llm_kwargs, tokenizer=self.tok, device_map='auto' if self.device == 'cuda' else self.device)
         else:
             self.llm = AutoModelForCausalLM.from_pretrained(
-                self.model_id, llm_kwargs)
+                source, **llm_kwargs)
         if precision in ('fp16', 'fp32', 'bf16') and not self.is_pipeline:
             self.llm.to(self.device)
         else:
             pass
+        timings['weights'] = time.time() - start
+        if stale is not None:
+            save_prepared(self, stale)
+        if warmup:
+            # the first generation initializes the CUDA kernels, etc.
+            start = time.time()
+            inputs = self.tok('Hello', return_tensors='pt').to(self.model.device)
+            self.model.generate(**inputs, max_new_tokens=1, pad_token_id=2)
+            timings['warm-up'] = time.time() - start
+        console.log(f'{self.NAME}> Startup: ' + ', '.join(
+            f'{k} {v:.1f}s' for (k, v) in timings.items())
+            + ('' if prepared is not None or stale is not None else
+               '. Run `debgpt backend --prepare` once to start faster.'))
         self.kwargs = {'max_new_tokens': 512,
                        'do_sample': True,
                        'pad_token_id': 2,
@@ -113,8 +196,16 @@ class Mistral7B(AbstractLLM):
                        'top_p': 0.95,
                        }
 
+    @property
+    def model(self):
+        return self.llm.model if self.is_pipeline else self.llm
+
     @th.no_grad()
-    def generate(self, messages: List[Dict]):
+    def generate(self, messages: List[Dict], session: Optional[str] = None):
+        if self.uses_cache(session):
+            generated = self._generate_cached(messages, session)
+            messages.append({'role': 'assistant', 'content': generated})
+            return messages
         if self.is_pipeline:
             templated = self.tok.apply_chat_template(messages, tokenize=False,
                                                      add_generation_prompt=True)
@@ -137,6 +228,129 @@ class Mistral7B(AbstractLLM):
             messages.append(new_message)
             return messages
 
+    @th.no_grad()
+    def generate_batch(self, batch: List[List[Dict]]):
+        '''
+        generate replies for several independent conversations at once.
+        '''
+        templated = [self.tok.apply_chat_template(messages, tokenize=False,
+                                                  add_generation_prompt=True)
+                     for messages in batch]
+        if self.is_pipeline:
+            outputs = self.llm(templated, batch_size=len(templated),
+                               **self.kwargs)
+            generated = [output[0]['generated_text'][len(text):].lstrip()
+                         for (text, output) in zip(templated, outputs)]
+        else:
+            encoded = self.tok(templated, return_tensors='pt', padding=True,
+                               add_special_tokens=False).to(self.device)
+            input_length = encoded['input_ids'].shape[1]
+            generated_ids = self.llm.generate(**encoded, **self.kwargs)
+            generated = self.tok.batch_decode(generated_ids[:, input_length:],
+                                              skip_special_tokens=True,
+                                              clean_up_tokenization_spaces=True)
+        for messages, text in zip(batch, generated):
+            messages.append({'role': 'assistant', 'content': text})
+        return batch
+
+    @th.no_grad()
+    def _generate_cached(self, messages: List[Dict], session: Optional[str],
+                         streamer=None) -> str:
+        '''
+        generate the reply, reusing computed past key/values. Those of the
+        previous turn of the same conversation are used in place. Otherwise,
+        the longest prefix shared with any earlier request is assembled from
+        the prefix tree. Only the tokens after the cached prefix are
+        prefilled. Full recompute on a cache miss.
+        '''
+        ids = self.tok.apply_chat_template(messages, tokenize=True,
+                                           add_generation_prompt=True)
+        matched, past = 0, None
+        if self.kv_cache is not None and session is not None:
+            matched, past = self.kv_cache.take(session, ids)
+        if self.prefix_cache is not None:
+            shared, segments = self.prefix_cache.match(ids)
+            if shared > matched:
+                matched, past = shared, _join_states(segments)
+        # the last prompt token has to be computed to get the next logits
+        matched = min(matched, len(ids) - 1)
+        cache = {'past_key_values': _crop(past, matched)} if matched > 0 else {}
+        console.log(f'{self.NAME}> reused {matched}/{len(ids)} prompt tokens.'
+                    + (f' prefix cache: {self.prefix_cache}'
+                       if self.prefix_cache is not None else ''))
+        input_ids = th.tensor([ids], device=self.model.device)
+        outputs = self.model.generate(input_ids,
+                                      attention_mask=th.ones_like(input_ids),
+                                      streamer=streamer,
+                                      return_dict_in_generate=True,
+                                      **cache, **self.kwargs)
+        sequence = outputs.sequences[0].tolist()
+        past = outputs.past_key_values
+        if isinstance(past, tuple):
+            # the legacy format, when generate() was given no cache
+            past = DynamicCache.from_legacy_cache(past)
+        if self.prefix_cache is not None:
+            self.prefix_cache.insert(ids, past)
+        if self.kv_cache is not None and session is not None:
+            # the states cover everything but the last generated token
+            self.kv_cache.put(session, sequence[:past.get_seq_length()], past,
+                              _nbytes(past))
+        return self.tok.decode(sequence[len(ids):], skip_special_tokens=True,
+                               clean_up_tokenization_spaces=True).lstrip()
+
+    def generate_stream(self, messages: List[Dict], session: Optional[str] = None):
+        '''
+        yield the generated text piece by piece, while generation runs in a
+        background thread. The complete message is appended to messages
+        when the generation is finished.
+        '''
+        templated = self.tok.apply_chat_template(messages, tokenize=False,
+                                                 add_generation_prompt=True)
+        streamer = TextIteratorStreamer(self.tok, skip_prompt=True,
+                                        skip_special_tokens=True,
+                                        clean_up_tokenization_spaces=True,
+                                        timeout=self.stream_timeout)
+        if self.uses_cache(session):
+            def _generate():
+                self._generate_cached(messages, session, streamer=streamer)
+        elif self.is_pipeline:
+            def _generate():
+                with th.no_grad():
+                    self.llm(templated, streamer=streamer, **self.kwargs)
+        else:
+            encoded = self.tok(templated, return_tensors='pt',
+                               add_special_tokens=False).to(self.device)
+
+            def _generate():
+                with th.no_grad():
+                    self.llm.generate(**encoded, streamer=streamer,
+                                      **self.kwargs)
+        errors = []
+
+        def _target():
+            try:
+                _generate()
+            except BaseException as e:
+                # otherwise the loop below waits for the end forever
+                errors.append(e)
+                streamer.end()
+        thread = Thread(target=_target)
+        thread.start()
+        chunks = []
+        try:
+            for piece in streamer:
+                if not chunks:
+                    piece = piece.lstrip()
+                if piece:
+                    chunks.append(piece)
+                    yield piece
+        except queue.Empty:
+            raise TimeoutError(f'no token generated in {self.stream_timeout}s')
+        thread.join()
+        if errors:
+            raise errors[0]
+        messages.append({'role': 'assistant', 'content': ''.join(chunks)})
+
     def chat(self, chat=Conversation()):
         '''
         https://huggingface.co/docs/transformers/main/en/main_classes/pipelines#transformers.ConversationalPipeline
@@ -176,19 +390,140 @@ class Mistral7B(AbstractLLM):
         return chat
 
 
+def _layers(past) -> List:
+    '''
+    list of (keys, values) tensors per layer, of a transformers cache, or of
+    a segment in the prefix tree.
+    '''
+    if isinstance(past, list):
+        return past
+    if hasattr(past, 'layers'):
+        return [(layer.keys, layer.values) for layer in past.layers]
+    return list(zip(past.key_cache, past.value_cache))
+
+
+def _nbytes(past) -> int:
+    '''
+    memory used by past key/values
+    '''
+    return sum(t.numel() * t.element_size()
+               for layer in _layers(past) for t in layer)
+
+
+def _slice_states(past, start: int, end: int) -> List:
+    '''
+    copy of the past key/values of tokens [start, end)
+    '''
+    return [(k[:, :, start:end].clone(), v[:, :, start:end].clone())
+            for (k, v) in _layers(past)]
+
+
+def _crop(past, n: int) -> DynamicCache:
+    '''
+    the past key/values of the first n tokens
+    '''
+    if hasattr(past, 'crop'):
+        past.crop(n)
+        return past
+    return _join_states([_slice_states(past, 0, n)])
+
+
+def _join_states(segments: List[List]) -> DynamicCache:
+    '''
+    concatenate consecutive segments of past key/values into a cache
+    '''
+    past = DynamicCache()
+    for i, layer in enumerate(zip(*segments)):
+        past.update(th.cat([k for (k, _) in layer], dim=2),
+                    th.cat([v for (_, v) in layer], dim=2), i)
+    return past
+
+
+# marks a complete directory of prepared weights
+PREPARED_MARK = 'debgpt-prepared.json'
+
+
+def prepared_path(debgpt_home: str, model_id: str, precision: str) -> str:
+    return os.path.join(debgpt_home, 'models',
+                        model_id.replace('/', '--') + '-' + precision)
+
+
+def read_mark(path: str) -> Optional[Dict]:
+    try:
+        with open(os.path.join(path, PREPARED_MARK), 'rt') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def matches(mark: Dict, expected: Dict) -> bool:
+    '''
+    whether the prepared weights are made from the expected model. An
+    unknown revision (the model is not in the local huggingface cache)
+    matches any.
+    '''
+    return all(mark.get(k, None) == v for (k, v) in expected.items()
+               if not (k == 'revision' and v is None))
+
+
+def _revision(model_id: str) -> Optional[str]:
+    '''
+    the revision of the model in the local huggingface cache, if any
+    '''
+    try:
+        from huggingface_hub import try_to_load_from_cache
+        path = try_to_load_from_cache(model_id, 'config.json')
+    except Exception:
+        return None
+    if not isinstance(path, str):
+        return None
+    # .../snapshots/<revision>/config.json
+    return os.path.basename(os.path.dirname(path))
+
+
+def save_prepared(model: 'Mistral7B', path: str) -> None:
+    console.log(f'{model.NAME}> Saving the prepared weights to {path}')
+    revision = getattr(model.model.config, '_commit_hash', None) \
+        or model.prepared_mark['revision']
+    tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    model.model.save_pretrained(tmp, safe_serialization=True)
+    model.tok.save_pretrained(tmp)
+    with open(os.path.join(tmp, PREPARED_MARK), 'wt') as f:
+        json.dump(dict(model.prepared_mark, revision=revision,
+                       transformers=transformers.__version__), f)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp, path)
+
+
+def prepare(args) -> str:
+    '''
+    quantize or convert the weights once, and store them in debgpt_home in
+    the safetensors format, along with the tokenizer. Later starts load
+    them directly (see Mistral7B.__init__). Returns the directory.
+    '''
+    model = create_llm(args, prepared=False)
+    path = prepared_path(args.debgpt_home, model.model_id, args.precision)
+    save_prepared(model, path)
+    return path
+
+
 class Mixtral8x7B(Mistral7B):
     NAME = 'Mixtral8x7B'
     model_id = 'mistralai/Mixtral-8x7B-Instruct-v0.1'
     is_pipeline = True
 
 
-def create_llm(args) -> AbstractLLM:
-    # factory
+def create_llm(args, prepared: bool = True) -> AbstractLLM:
+    # factory. prepared: whether to load the prepared weights if any.
+    debgpt_home = getattr(args, 'debgpt_home', None) if prepared else None
     if args.llm == 'Mistral7B':
-        model = Mistral7B(device=args.device, precision=args.precision)
+        model = Mistral7B(device=args.device, precision=args.precision,
+                          debgpt_home=debgpt_home, warmup=prepared)
         model.kwargs['max_new_tokens'] = args.max_new_tokens
     elif args.llm == 'Mixtral8x7B':
-        model = Mixtral8x7B(device=args.device, precision=args.precision)
+        model = Mixtral8x7B(device=args.device, precision=args.precision,
+                            debgpt_home=debgpt_home, warmup=prepared)
         model.kwargs['max_new_tokens'] = args.max_new_tokens
     else:
         raise NotImplementedError(f'{args.llm} is not yet implemented')
@@ -0,0 +1,238 @@
+'''
+MIT License
+
+Copyright (c) 2024 Mo Zhou <lumin@debian.org>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+from typing import Callable, Dict, List, Optional, Tuple
+import time
+import rich
+from . import assembler
+from .tokens import estimate_tokens
+console = rich.get_console()
+
+__doc__ = '''
+Map-reduce over the information that does not fit in the context window,
+e.g., multi-MB build logs. The oversized source blocks are split into
+chunks that fit. Each chunk is asked the question on its own (map), in
+parallel when the frontend supports it. The partial answers then take the
+place of the oversized blocks in the first prompt (reduce). When the
+partial answers do not fit either, they are combined in groups, level by
+level, until they do.
+'''
+
+MAP_PROMPT = '''The above is part {i} of {n} of {what}, which is too long \
+to be read at once. Based on this part only, answer the question below. Be \
+concise. If this part is irrelevant to the question, just say so.'''
+
+COMBINE_PROMPT = '''The above are answers to the question below, each based \
+on a different part of {what}. Combine them into one concise answer.'''
+
+ANSWERS_CAPTION = '''The following are answers to the question, each based \
+on a different part of {what}, which is too long to be read at once:'''
+
+
+def _cut(line: str, budget: int, count: Callable[[str], int]) -> List[str]:
+    '''
+    cut a line that alone exceeds the budget into pieces that fit
+    '''
+    n = count(line) + 1
+    if n <= budget:
+        return [line]
+    k = max(1, len(line) * budget // n)
+    return [line[i:i + k] for i in range(0, len(line), k)]
+
+
+def split(text: str, max_tokens: int,
+          count: Callable[[str], int] = estimate_tokens) -> List[str]:
+    '''
+    split a block into chunks of at most max_tokens. Every chunk keeps the
+    caption and the markdown fences around the content.
+    '''
+    prologue, body, epilogue = assembler.split_fences(text)
+    budget = max(1, max_tokens - count('\n'.join(prologue + epilogue)) - 16)
+    chunks, current, size = [], [], 0
+    for line in body:
+        for piece in _cut(line, budget, count):
+            n = count(piece) + 1
+            if current and size + n > budget:
+                chunks.append(current)
+                current, size = [], 0
+            current.append(piece)
+            size += n
+    if current or not chunks:
+        chunks.append(current)
+    return ['\n'.join(prologue + x + epilogue) for x in chunks]
+
+
+def query_all(f, prompts: List[str],
+              max_concurrency: Optional[int] = None) -> List[Dict]:
+    '''
+    ask each prompt in a new conversation. The frontends that support it
+    (see frontend.AsyncOpenAIFrontend.query_many) run them concurrently,
+    the others one after another. The session of f is left untouched.
+    Returns the result dicts of query_many.
+    '''
+    if hasattr(f, 'query_many'):
+        return f.query_many(prompts, max_concurrency)
+    results = []
+    session = f.session
+    for prompt in prompts:
+        f.reset()
+        start = time.time()
+        reply = f.query([{'role': 'user', 'content': prompt}])
+        results.append({'messages': f.session, 'reply': reply,
+                        'error': None, 'latency': time.time() - start,
+                        'retries': 0, 'usage': None})
+    f.reset()
+    f.session = session
+    return results
+
+
+def _report(labels: List[str], prompts: List[str], results: List[Dict],
+            count: Callable[[str], int]) -> Tuple[int, int]:
+    '''
+    log the tokens and the latency of each query. Returns the total tokens
+    in and out. The numbers starting with ~ are local estimations.
+    '''
+    total_in, total_out = 0, 0
+    for label, prompt, result in zip(labels, prompts, results):
+        usage = result.get('usage', None)
+        if usage is not None:
+            n_in, n_out = usage['prompt_tokens'], usage['completion_tokens']
+            approx = ''
+        else:
+            n_in, n_out = count(prompt), count(result['reply'] or '')
+            approx = '~'
+        total_in += n_in
+        total_out += n_out
+        status = '' if result['error'] is None \
+            else f' [red]failed: {result["error"]}[/red]'
+        console.log(f'mapreduce> {label}: {approx}{n_in} tokens in,'
+                    + f' {approx}{n_out} tokens out,'
+                    + f' {result["latency"]:.1f}s'
+                    + f' ({result["retries"]} retries){status}')
+    return total_in, total_out
+
+
+def _answer(result: Dict) -> str:
+    if result['error'] is not None:
+        return f'[this part failed: {result["error"]}]'
+    return result['reply'].strip()
+
+
+def _answers_block(what: str, answers: List[str]) -> str:
+    lines = [ANSWERS_CAPTION.format(what=what)]
+    for i, answer in enumerate(answers):
+        lines.extend([f'Answer {i+1} of {len(answers)}:', '```', answer,
+                      '```'])
+    lines.append('')
+    return '\n'.join(lines)
+
+
+def _group(answers: List[str], budget: int,
+           count: Callable[[str], int]) -> List[List[str]]:
+    '''
+    pack consecutive answers into groups that fit in the budget
+    '''
+    groups, current, size = [], [], 0
+    for answer in answers:
+        n = count(answer) + 8
+        if current and size + n > budget:
+            groups.append(current)
+            current, size = [], 0
+        current.append(answer)
+        size += n
+    if current:
+        groups.append(current)
+    return groups
+
+
+def run(f, blocks: List[Tuple[str, str, str]], question: str, budget: int,
+        count: Callable[[str], int] = estimate_tokens,
+        max_concurrency: Optional[int] = None) -> List[str]:
+    '''
+    blocks: list of (source key, spec, text), e.g., ('file', 'build.log', ...)
+    question: the question asked about the information
+    budget: number of tokens available for the blocks (assembler.prompt_budget)
+    returns the texts of the blocks, where each oversized block is replaced
+    by the answers to the question about its chunks.
+    '''
+    texts = [text for (_, _, text) in blocks]
+    sizes = [count(text) for text in texts]
+    if sum(sizes) <= budget:
+        return texts
+    start = time.time()
+    caps = assembler.allocate(sizes, budget)
+    chunk_budget = max(1, budget - count(MAP_PROMPT + question) - 64)
+    oversized = [i for i in range(len(blocks)) if sizes[i] > caps[i]]
+    whats = {i: f'the information from --{blocks[i][0]} {blocks[i][1]}'
+             for i in oversized}
+
+    # map: ask the question about every chunk
+    labels, prompts, owners = [], [], []
+    for i in oversized:
+        chunks = split(texts[i], chunk_budget, count)
+        console.log(f'mapreduce> splitting --{blocks[i][0]} {blocks[i][1]}'
+                    + f' (~{sizes[i]} tokens) into {len(chunks)} parts')
+        for j, chunk in enumerate(chunks):
+            labels.append(f'--{blocks[i][0]} {blocks[i][1]}'
+                          + f' part {j+1}/{len(chunks)}')
+            prompts.append(chunk + '\n' + MAP_PROMPT.format(
+                i=j + 1, n=len(chunks), what=whats[i]) + '\n' + question)
+            owners.append(i)
+    results = query_all(f, prompts, max_concurrency)
+    total_in, total_out = _report(labels, prompts, results, count)
+    answers = {i: [] for i in oversized}
+    for i, result in zip(owners, results):
+        answers[i].append(_answer(result))
+
+    # reduce: combine the answers in groups until they fit
+    level = 1
+    while True:
+        for i in oversized:
+            texts[i] = _answers_block(whats[i], answers[i])
+        sizes = [count(text) for text in texts]
+        caps = assembler.allocate(sizes, budget)
+        todo = [i for i in oversized if sizes[i] > caps[i]
+                and len(_group(answers[i], chunk_budget, count))
+                < len(answers[i])]
+        if sum(sizes) <= budget or not todo:
+            break
+        labels, prompts, owners = [], [], []
+        for i in todo:
+            groups = _group(answers[i], chunk_budget, count)
+            for j, group in enumerate(groups):
+                labels.append(f'--{blocks[i][0]} {blocks[i][1]} combine'
+                              + f' {level}.{j+1}/{len(groups)}')
+                prompts.append(_answers_block(whats[i], group)
+                               + COMBINE_PROMPT.format(what=whats[i])
+                               + '\n' + question)
+                owners.append(i)
+            answers[i] = []
+        results = query_all(f, prompts, max_concurrency)
+        n_in, n_out = _report(labels, prompts, results, count)
+        total_in, total_out = total_in + n_in, total_out + n_out
+        for i, result in zip(owners, results):
+            answers[i].append(_answer(result))
+        level += 1
+    console.log(f'mapreduce> done in {time.time() - start:.1f}s.'
+                + f' total: {total_in} tokens in, {total_out} tokens out')
+    return texts
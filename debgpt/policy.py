@@ -22,8 +22,15 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 '''
 import os
-import requests
+import re
+import bisect
+import json
+import mmap
+import threading
 import rich
+from . import web
+from . import retrieval
+from typing import Dict, List, Optional, Tuple
 console = rich.get_console()
 
 
@@ -31,50 +38,211 @@ class DebianPolicy(object):
     '''
     cache the plain text policy document.
     and query its sections / subsections.
+
+    A section index (section number -> byte offsets) is kept next to the
+    cached document, so that each lookup is a dictionary hit plus a slice
+    of the memory-mapped document. The index is rebuilt automatically when
+    the document changes. Use DebianPolicy.shared(...) to reuse the same
+    mapping across the whole process.
+
+    search(query) ranks the sections by keyword relevance (BM25), with the
+    search index stored next to the document as well.
     '''
     NAME = 'Debian Policy'
     URL = 'https://www.debian.org/doc/debian-policy/policy.txt'
     SEP_SECTION = '***'
     SEP_SUBSECTION = '==='
     SEP_SUBSUBSECTION = '---'
+    SOURCE = 'policy'
+    INDEX_VERSION = 1
 
     def __init__(self, cache: str = 'policy.txt'):
-        if not os.path.exists(cache):
-            r = requests.get(self.URL)
-            with open(cache, 'wb') as f:
-                f.write(r.content)
-            console.log(f'DebianPolicy> cached {self.NAME} at {cache}')
-        with open(cache, 'rt') as f:
-            self.lines = [x.rstrip() for x in f.readlines()]
+        # without the HTTP cache, the document is downloaded only once.
+        # with it, the document is revalidated after its time-to-live.
+        if not os.path.exists(cache) or web.cache_enabled():
+            r = web.get(self.URL, source=self.SOURCE)
+            if os.path.exists(cache) and r.status_code != 200:
+                console.log(f'DebianPolicy> failed to refresh {self.NAME}'
+                            + f' (HTTP {r.status_code}). Using {cache}')
+            elif not (r.from_cache and os.path.exists(cache)):
+                # write to a temporary file first. An existing mapping of
+                # the old document must never see a truncated file.
+                tmp = f'{cache}.{os.getpid()}.{threading.get_ident()}.tmp'
+                with open(tmp, 'wb') as f:
+                    f.write(r.content)
+                os.replace(tmp, cache)
+                console.log(f'DebianPolicy> cached {self.NAME} at {cache}')
+        self.cache = cache
+        self.stat = self._stat()
+        with open(cache, 'rb') as f:
+            # mmap refuses to map an empty file
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) \
+                if self.stat['size'] > 0 else b''
+        self.index = self._load_index()
+        self.search_index: Optional[retrieval.BM25] = None
+        self._chunks: Optional[Dict[str, List[int]]] = None
+
+    @classmethod
+    def shared(cls, cache: str) -> 'DebianPolicy':
+        '''
+        return the process-wide instance for the given cache file. It is
+        reloaded when the file on disk changes.
+        '''
+        key = (cls, os.path.realpath(cache))
+        with _documents_lock:
+            doc = _documents.get(key, None)
+            if doc is None or not doc.is_current():
+                doc = _documents[key] = cls(cache)
+        return doc
+
+    def is_current(self) -> bool:
+        return os.path.exists(self.cache) and self._stat() == self.stat
+
+    @property
+    def index_path(self) -> str:
+        return self.cache + '.idx'
+
+    def _stat(self) -> Dict[str, int]:
+        st = os.stat(self.cache)
+        return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+    def _load_index(self) -> Dict[str, List[int]]:
+        '''
+        load the section index from disk, or rebuild it if it is missing
+        or does not match the cached document.
+        '''
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'rt') as f:
+                try:
+                    idx = json.load(f)
+                except json.JSONDecodeError:
+                    idx = {}
+            if idx.get('version') == self.INDEX_VERSION \
+                    and idx.get('stat') == self.stat:
+                return idx['sections']
+        sections = self._build_index()
+        tmp = f'{self.index_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wt') as f:
+            json.dump({'version': self.INDEX_VERSION, 'stat': self.stat,
+                       'sections': sections}, f)
+        os.replace(tmp, self.index_path)
+        return sections
+
+    def _build_index(self) -> Dict[str, List[int]]:
+        '''
+        scan the document once and record the [start, end) byte offsets of
+        every numbered (sub)section. A section starts at its title line, and
+        ends right before the title line of the next heading of the same level.
+        '''
+        seps = {self.SEP_SECTION.encode(): 1,
+                self.SEP_SUBSECTION.encode(): 2,
+                self.SEP_SUBSUBSECTION.encode(): 3}
+        title = re.compile(rb'^(\w+(?:\.\w+)*)\. ')
+        sections: Dict[str, List[int]] = {}
+        opened: Dict[int, str] = {}
+        buf, size = self.buffer, len(self.buffer)
+        prev_offset, offset = 0, 0
+        while offset < size:
+            level = seps.get(buf[offset:offset + 3], None)
+            if level is not None:
+                if level in opened:
+                    sections[opened.pop(level)][1] = prev_offset
+                m = title.match(buf[prev_offset:offset])
+                if m and m.group(1).count(b'.') + 1 == level:
+                    number = m.group(1).decode()
+                    if number not in sections:
+                        sections[number] = [prev_offset, -1]
+                        opened[level] = number
+            newline = buf.find(b'\n', offset)
+            prev_offset, offset = offset, size if newline < 0 else newline + 1
+        for number in opened.values():
+            sections[number][1] = size
+        return sections
+
+    def chunks(self) -> Dict[str, List[int]]:
+        '''
+        split the document into disjoint chunks: the [start, end) byte
+        offsets of each section, up to the title of its first subsection.
+        '''
+        if self._chunks is None:
+            starts = sorted(start for (start, _) in self.index.values())
+            chunks = {}
+            for number, (start, end) in self.index.items():
+                i = bisect.bisect_right(starts, start)
+                chunks[number] = [start, min(end, starts[i])
+                                  if i < len(starts) else end]
+            self._chunks = chunks
+        return self._chunks
+
+    def _load_search_index(self) -> retrieval.BM25:
+        path = self.cache + '.bm25'
+        if os.path.exists(path):
+            with open(path, 'rt') as f:
+                try:
+                    idx = json.load(f)
+                except json.JSONDecodeError:
+                    idx = {}
+            if idx.get('version') == self.INDEX_VERSION \
+                    and idx.get('stat') == self.stat:
+                return retrieval.BM25.from_json(idx['bm25'])
+        chunks = self.chunks()
+        bm25 = retrieval.BM25.build((number, self._text(start, end))
+                                    for (number, (start, end)) in chunks.items())
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wt') as f:
+            json.dump({'version': self.INDEX_VERSION, 'stat': self.stat,
+                       'bm25': bm25.to_json()}, f)
+        os.replace(tmp, path)
+        return bm25
+
+    def search(self, query: str, k: int = 3) -> List[str]:
+        '''
+        numbers of the k sections most relevant to the query, best first.
+        Only the text of a section before its first subsection counts.
+        '''
+        if self.search_index is None:
+            self.search_index = self._load_search_index()
+        return [number for (number, _) in self.search_index.search(query, k)]
+
+    def section(self, index: str) -> str:
+        '''
+        the text of a section, up to the title of its first subsection.
+        '''
+        start, end = self.chunks()[index]
+        return self._text(start, end)
+
+    def view(self, index: str) -> memoryview:
+        '''
+        zero-copy view of the raw bytes of a section.
+        '''
+        if index not in self.index:
+            return memoryview(b'')
+        start, end = self.index[index]
+        return memoryview(self.buffer)[start:end]
+
+    def _text(self, start: int, end: int) -> str:
+        return self._decode(memoryview(self.buffer)[start:end])
 
     def __getitem__(self, index: str):
-        sep = {1: self.SEP_SECTION, 2: self.SEP_SUBSECTION,
-               3: self.SEP_SUBSUBSECTION}[len(index.split('.'))]
-        ret = []
-        prev = ''
-        in_range = False
-        for cursor in self.lines:
-            if cursor.startswith(sep) and prev.startswith(f'{index}. '):
-                # start
-                ret.append(prev)
-                ret.append(cursor)
-                in_range = True
-            elif cursor.startswith(sep) and in_range:
-                # stop
-                ret.pop(-1)
-                in_range = False
-                break
-            elif in_range:
-                ret.append(cursor)
-            else:
-                pass
-            prev = cursor
-        return '\n'.join(ret)
+        return self._decode(self.view(index))
+
+    @staticmethod
+    def _decode(view: memoryview) -> str:
+        text = str(view, 'utf-8')
+        lines = text.split('\n')
+        if text.endswith('\n'):
+            lines.pop(-1)
+        return '\n'.join(x.rstrip() for x in lines)
+
+
+_documents: Dict[Tuple[type, str], DebianPolicy] = {}
+_documents_lock = threading.Lock()
 
 
 class DebianDevref(DebianPolicy):
     NAME = "Debian Developer's Reference"
     URL = 'https://www.debian.org/doc/manuals/developers-reference/developers-reference.en.txt'
+    SOURCE = 'devref'
 
     def __init__(self, cache: str = 'devref.txt'):
         super().__init__(cache)
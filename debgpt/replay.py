@@ -21,15 +21,32 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 '''
+from typing import Dict, Iterable, Iterator, Optional
+from collections import deque
 from rich.markup import escape
 from rich.panel import Panel
+import contextlib
 import json
 import argparse
+import os
+import re
+import shlex
+import subprocess
 import rich
+from . import journal
 console = rich.get_console()
 
+__doc__ = '''
+Replay of the recorded sessions, i.e., the JSONL journals, or the JSON
+arrays written by older versions. Both are read as a stream, one message at
+a time, so archived sessions of hundreds of MB replay in constant memory.
+'''
+
 
-def process_entry(entry):
+def process_entry(entry, out=console):
+    if entry.get('reset', False):
+        out.rule('Session Reset')
+        return
     if entry['role'] == 'user':
         title = 'User Input'
         border_style = 'cyan'
@@ -44,24 +61,175 @@ def process_entry(entry):
 
     panel = Panel(escape(entry['content']),
                   title=title, border_style=border_style)
-    console.print(panel)
+    out.print(panel)
+
+
+_SEPARATORS = re.compile(r'[\s,]*')
+
+
+def _iter_json_array(path: str, chunk_size: int = 2**20) -> Iterator[Dict]:
+    '''
+    incrementally parse a JSON array of messages, e.g. [{...}, {...}]
+    '''
+    decoder = json.JSONDecoder()
+    with open(path, 'rt') as f:
+        buf, pos, eof, started = '', 0, False, False
+        want = chunk_size
+        while True:
+            pos = _SEPARATORS.match(buf, pos).end()
+            if pos < len(buf) and not started:
+                if buf[pos] != '[':
+                    raise ValueError(f'{path}: not a JSON array')
+                pos, started = pos + 1, True
+                continue
+            if pos < len(buf) and buf[pos] == ']':
+                return
+            if pos < len(buf):
+                try:
+                    obj, pos = decoder.raw_decode(buf, pos)
+                    want = chunk_size
+                    yield obj
+                    continue
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                    # an incomplete element. read more, and read twice as
+                    # much next time, so that a huge element is not parsed
+                    # over and over again.
+                    want *= 2
+            elif eof:
+                raise ValueError(f'{path}: unexpected end of file')
+            chunk = f.read(want)
+            eof = not chunk
+            buf, pos = buf[pos:] + chunk, 0
+
+
+def iter_records(path: str) -> Iterator[Dict]:
+    '''
+    the records of a journal (.jsonl), or of a JSON array, one by one
+    '''
+    if path.endswith('.jsonl'):
+        return journal.read(path)
+    return _iter_json_array(path)
+
+
+def _reversed_lines(path: str, block: int = 2**16) -> Iterator[bytes]:
+    '''
+    the non-empty lines of a file, from the last one to the first one
+    '''
+    with open(path, 'rb') as f:
+        end = f.seek(0, os.SEEK_END)
+        # pieces of the line being read, in reversed order
+        pending = []
+        while end > 0:
+            start = max(0, end - block)
+            f.seek(start)
+            parts = f.read(end - start).split(b'\n')
+            end = start
+            if len(parts) == 1:
+                pending.append(parts[0])
+                continue
+            line = parts[-1] + b''.join(reversed(pending))
+            if line:
+                yield line
+            yield from (x for x in reversed(parts[1:-1]) if x)
+            pending = [parts[0]]
+        line = b''.join(reversed(pending))
+        if line:
+            yield line
+
+
+def _tail_journal(path: str, n: int, match) -> Iterable[Dict]:
+    '''
+    the last n messages of a journal that match, read backwards from the
+    end of the file.
+    '''
+    if n <= 0:
+        return []
+    ret = []
+    for i, line in enumerate(_reversed_lines(path)):
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            # a truncated last line, e.g., after a crash
+            if i == 0:
+                continue
+            raise
+        if not record.get('reset', False) and match(record):
+            ret.append(record)
+            if len(ret) == n:
+                break
+    return reversed(ret)
+
+
+def select(path: str, *, tail: Optional[int] = None,
+           grep: Optional[str] = None) -> Iterable[Dict]:
+    '''
+    the records to replay. grep keeps the messages whose content matches
+    the regular expression, and tail keeps the last n (matching) messages.
+    '''
+    regex = re.compile(grep) if grep is not None else None
+
+    def match(record: Dict) -> bool:
+        return regex is None or regex.search(record['content']) is not None
+
+    if tail is not None and path.endswith('.jsonl'):
+        return _tail_journal(path, tail, match)
+    records = (x for x in iter_records(path)
+               if (x.get('reset', False) and regex is None and tail is None)
+               or (not x.get('reset', False) and match(x)))
+    if tail is not None:
+        return deque(records, maxlen=max(0, tail))
+    return records
+
 
+@contextlib.contextmanager
+def _output(pager: bool):
+    '''
+    the console to print to. With pager, the output goes through $PAGER
+    (less -R by default) as it is produced. The pager reads it lazily, and
+    the pipe blocks the replay when the pager is not reading.
+    '''
+    if not pager:
+        yield console
+        return
+    command = shlex.split(os.getenv('PAGER', 'less -R'))
+    proc = subprocess.Popen(command, stdin=subprocess.PIPE, text=True)
+    out = rich.console.Console(file=proc.stdin, force_terminal=True,
+                               width=console.width)
+    try:
+        yield out
+    except BrokenPipeError:
+        # the user quit the pager
+        pass
+    finally:
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        proc.wait()
 
-def replay(path):
-    with open(path) as f:
-        J = json.load(f)
 
-    for entry in J:
-        process_entry(entry)
+def replay(path, *, tail: Optional[int] = None, grep: Optional[str] = None,
+           pager: bool = False):
+    with _output(pager) as out:
+        for entry in select(path, tail=tail, grep=grep):
+            process_entry(entry, out)
 
 
 def main():
     parser = argparse.ArgumentParser(
         description='Replay chat messages from a JSON file.')
     parser.add_argument('input_file', metavar='FILE',
-                        help='JSON file containing the chat messages')
+                        help='JSON or JSONL file containing the chat messages')
+    parser.add_argument('--tail', type=int, default=None,
+                        help='only replay the last N messages')
+    parser.add_argument('--grep', type=str, default=None,
+                        help='only replay the messages matching the regex')
+    parser.add_argument('--pager', action='store_true',
+                        help='page through the output with $PAGER')
     args = parser.parse_args()
-    replay(args.input_file)
+    replay(args.input_file, tail=args.tail, grep=args.grep, pager=args.pager)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,115 @@
+'''
+MIT License
+
+Copyright (c) 2024 Mo Zhou <lumin@debian.org>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+from typing import Dict, Iterable, List, Tuple
+import math
+import re
+
+__doc__ = '''
+Keyword retrieval over a set of text chunks (e.g., the sections of Debian
+Policy), so that only the relevant ones go into the prompt.
+
+This is a plain BM25 ranking in pure Python. The index is an inverted index
+of (chunk, term frequency) postings, which is JSON serializable and can be
+stored next to the document.
+'''
+
+_WORD = re.compile(r'[a-z0-9]+(?:[-_+][a-z0-9]+)*')
+_STOPWORDS = frozenset('''
+a an and are as at be but by can for from has have if in into is it its may
+must not of on or should such that the their then there these this to was
+were will with which who what when where how do does i we you my our
+'''.split())
+
+
+def _stem(word: str) -> str:
+    '''
+    very light stemming, so that e.g. "packages" matches "package"
+    '''
+    if len(word) > 4 and word.endswith('ies'):
+        return word[:-3] + 'y'
+    if len(word) > 3 and word.endswith('s') and not word.endswith(('ss', 'us', 'is')):
+        return word[:-1]
+    return word
+
+
+def tokenize(text: str) -> List[str]:
+    return [_stem(x) for x in _WORD.findall(text.lower())
+            if x not in _STOPWORDS]
+
+
+class BM25(object):
+    '''
+    Okapi BM25 ranking of chunks for a keyword query.
+    '''
+    k1: float = 1.5
+    b: float = 0.75
+
+    def __init__(self, keys: List[str], lengths: List[int],
+                 postings: Dict[str, List[List[int]]]):
+        self.keys = keys
+        self.lengths = lengths
+        # term -> [[chunk number, term frequency], ...]
+        self.postings = postings
+        self.avgdl = sum(lengths) / max(1, len(lengths))
+
+    @classmethod
+    def build(cls, chunks: Iterable[Tuple[str, str]]) -> 'BM25':
+        keys, lengths = [], []
+        postings: Dict[str, List[List[int]]] = {}
+        for i, (key, text) in enumerate(chunks):
+            terms = tokenize(text)
+            keys.append(key)
+            lengths.append(len(terms))
+            tf: Dict[str, int] = {}
+            for term in terms:
+                tf[term] = tf.get(term, 0) + 1
+            for term, n in tf.items():
+                postings.setdefault(term, []).append([i, n])
+        return cls(keys, lengths, postings)
+
+    def to_json(self) -> Dict:
+        return {'keys': self.keys, 'lengths': self.lengths,
+                'postings': self.postings}
+
+    @classmethod
+    def from_json(cls, obj: Dict) -> 'BM25':
+        return cls(obj['keys'], obj['lengths'], obj['postings'])
+
+    def search(self, query: str, k: int = 3) -> List[Tuple[str, float]]:
+        '''
+        the k best matching chunks as (key, score), best first. Chunks
+        sharing no term with the query are never returned.
+        '''
+        n = len(self.keys)
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term, [])
+            if not postings:
+                continue
+            idf = math.log((n - len(postings) + 0.5) / (len(postings) + 0.5) + 1)
+            for (i, tf) in postings:
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[i] / self.avgdl)
+                scores[i] = scores.get(i, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        best = sorted(scores.items(), key=lambda x: (-x[1], x[0]))[:k]
+        return [(self.keys[i], score) for (i, score) in best]
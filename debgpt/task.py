@@ -24,16 +24,18 @@ SOFTWARE.
 import rich
 import os
 import sys
-from . import frontend
-from . import debian
 from . import defaults
-from rich.panel import Panel
 import tempfile
 console = rich.get_console()
 
 
 def task_backend(ag) -> None:
     from . import backend
+    if ag.prepare:
+        from . import llm
+        path = llm.prepare(ag)
+        console.log(f'Prepared weights saved at {path}.')
+        exit(0)
     b = backend.create_backend(ag)
     try:
         b.server()
@@ -45,7 +47,14 @@ def task_backend(ag) -> None:
 
 def task_replay(ag) -> None:
     from . import replay
-    replay.replay(ag.json_file_path)
+    replay.replay(ag.json_file_path, tail=ag.tail, grep=ag.grep,
+                  pager=ag.pager)
+    exit(0)
+
+
+def task_batch(ag) -> None:
+    from . import batch
+    batch.run(ag)
     exit(0)
 
 
@@ -54,7 +63,15 @@ def task_git(ag) -> None:
     exit(1)
 
 
+def task_stdin(ag) -> str:
+    from . import debian
+    return debian.stdin()
+
+
 def task_git_commit(ag) -> None:
+    from . import frontend
+    from . import debian
+    from rich.panel import Panel
     f = ag.frontend_instance
     msg = "Previous commit titles:\n"
     msg += "```"
@@ -107,6 +124,7 @@ def task_fortune(ag):
     else:
         msg = ag.ask
     # let frontend work
+    from . import frontend
     f = ag.frontend_instance
     frontend.query_once(f, msg)
     # exit
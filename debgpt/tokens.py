@@ -0,0 +1,121 @@
+'''
+MIT License
+
+Copyright (c) 2024 Mo Zhou <lumin@debian.org>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+from typing import Callable, Dict, List, Optional
+import functools
+import hashlib
+import rich
+console = rich.get_console()
+
+__doc__ = '''
+Token accounting for chat sessions.
+
+The token count of every message is cached by the hash of its role and
+content, so counting a growing session only tokenizes the new messages.
+The tokenizer is loaded lazily on first use. When no tokenizer is
+available, a rough estimation is used instead.
+'''
+
+Encoder = Callable[[str], List[int]]
+
+
+def estimate_tokens(text: str) -> int:
+    '''
+    rough estimation: one token is about four characters of English text.
+    '''
+    return (len(text) + 3) // 4
+
+
+def tiktoken_encoder(model: str) -> Encoder:
+    '''
+    the BPE tokenizer of an OpenAI model. Requires python3-tiktoken.
+    '''
+    import tiktoken
+    try:
+        enc = tiktoken.encoding_for_model(model)
+    except KeyError:
+        enc = tiktoken.get_encoding('cl100k_base')
+    # special tokens like <|endoftext|> are common in logs and source files.
+    # count them as plain text instead of raising ValueError.
+    return functools.partial(enc.encode, disallowed_special=())
+
+
+def huggingface_encoder(model_id: str) -> Encoder:
+    '''
+    the tokenizer of a huggingface model, only if it is already in the local
+    huggingface cache. Requires python3-tokenizers and huggingface_hub.
+    '''
+    from huggingface_hub import try_to_load_from_cache
+    from tokenizers import Tokenizer
+    path = try_to_load_from_cache(model_id, 'tokenizer.json')
+    if not isinstance(path, str):
+        raise FileNotFoundError(f'tokenizer of {model_id} is not cached')
+    tok = Tokenizer.from_file(path)
+    return lambda text: tok.encode(text, add_special_tokens=False).ids
+
+
+class TokenCounter(object):
+    '''
+    count the tokens in a list of chat messages (see frontend._check).
+    '''
+    # tokens taken by the chat format for each message (role, separators),
+    # and for priming the reply.
+    MESSAGE_OVERHEAD: int = 4
+    REPLY_OVERHEAD: int = 3
+
+    def __init__(self, encoder: Optional[Callable[[], Encoder]] = None):
+        '''
+        encoder: a factory that creates the encode function. It is called on
+        first use. None means to use estimate_tokens.
+        '''
+        self._factory = encoder
+        self._encode: Optional[Encoder] = None
+        self.cache: Dict[bytes, int] = {}
+
+    def count_text(self, text: str) -> int:
+        if self._factory is not None:
+            try:
+                self._encode = self._factory()
+            except Exception as e:
+                console.log(f'TokenCounter> tokenizer unavailable ({e}).'
+                            + ' Falling back to estimation.')
+            self._factory = None
+        if self._encode is None:
+            return estimate_tokens(text)
+        return len(self._encode(text))
+
+    def count_message(self, message: Dict[str, str]) -> int:
+        key = hashlib.blake2b(message['role'].encode() + b'\0'
+                              + message['content'].encode(),
+                              digest_size=16).digest()
+        n = self.cache.get(key, None)
+        if n is None:
+            n = self.cache[key] = self.MESSAGE_OVERHEAD \
+                + self.count_text(message['content'])
+        return n
+
+    def __call__(self, messages: List[Dict[str, str]]) -> int:
+        if not messages:
+            return 0
+        return sum(self.count_message(x) for x in messages) \
+            + self.REPLY_OVERHEAD
@@ -0,0 +1,229 @@
+'''
+MIT License
+
+Copyright (c) 2024 Mo Zhou <lumin@debian.org>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+from typing import TYPE_CHECKING, Dict, Optional, Union
+import hashlib
+import json
+import os
+import threading
+import time
+import rich
+if TYPE_CHECKING:
+    # requests is imported on the first request. It is slow to import, and
+    # many invocations of debgpt do not access the web at all.
+    import requests
+console = rich.get_console()
+
+__doc__ = '''
+Shared HTTP access for the text loaders in debian.py and policy.py.
+
+Responses can be kept in an on-disk cache. Each entry stores the body
+together with its ETag / Last-Modified headers. Within the time-to-live of
+its source, an entry is served without touching the network. After that it
+is revalidated with a conditional request, which normally costs a 304.
+
+All requests go through one shared, pooled session with keep-alive, a
+per-host connection limit, timeouts, and retries with exponential backoff.
+'''
+
+# time-to-live (seconds) of cached responses, per kind of source.
+DEFAULT_TTL: Dict[str, float] = {
+    'default': 3600,
+    'bts': 300,
+    'buildd': 600,
+    'html': 3600,
+    'archw': 86400,
+    'pynew': 86400,
+    'policy': 7 * 86400,
+    'devref': 7 * 86400,
+}
+
+
+_session: Optional['requests.Session'] = None
+_session_lock = threading.Lock()
+_settings: Dict[str, float] = {'timeout': 30.0, 'retries': 3, 'backoff': 0.5,
+                               'pool_maxsize': 4}
+
+
+def configure_session(*, timeout: float = 30.0, retries: int = 3,
+                      backoff: float = 0.5, pool_maxsize: int = 4) -> None:
+    '''
+    set up the shared session. It is (re)created on the next request.
+    timeout: seconds to wait for connecting, and for each read.
+    retries: retry count for connection errors and 429/5xx responses.
+    backoff: backoff factor. The n-th retry sleeps backoff * 2^(n-1) seconds.
+    pool_maxsize: maximum number of connections to each host.
+    '''
+    global _session
+    with _session_lock:
+        _settings.update(timeout=timeout, retries=retries, backoff=backoff,
+                         pool_maxsize=pool_maxsize)
+        _session = None
+
+
+def session() -> 'requests.Session':
+    '''
+    the shared session, created on first use.
+    '''
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+            retry = Retry(total=_settings['retries'],
+                          backoff_factor=_settings['backoff'],
+                          status_forcelist=(429, 500, 502, 503, 504),
+                          allowed_methods=('GET', 'HEAD'),
+                          raise_on_status=False)
+            adapter = HTTPAdapter(pool_maxsize=_settings['pool_maxsize'],
+                                  pool_block=True, max_retries=retry)
+            _session = requests.Session()
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
+
+def _request(url: str, headers: Optional[Dict[str, str]] = None):
+    return session().get(url, headers=headers, timeout=_settings['timeout'])
+
+
+class CachedResponse(object):
+    '''
+    a minimal stand-in for requests.Response, whose body lives in the cache.
+    The body is only read from disk when .content or .text is accessed.
+    '''
+    from_cache: bool = True
+
+    def __init__(self, url: str, path: str, encoding: Optional[str]):
+        self.url = url
+        self.path = path
+        self.encoding = encoding
+        self.status_code = 200
+
+    @property
+    def content(self) -> bytes:
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    @property
+    def text(self) -> str:
+        return str(self.content, self.encoding or 'utf-8', errors='replace')
+
+
+class HTTPCache(object):
+    '''
+    on-disk HTTP cache with conditional-GET revalidation.
+    '''
+
+    def __init__(self, directory: str, ttl: Optional[Dict[str, float]] = None):
+        self.directory = directory
+        self.ttl = dict(DEFAULT_TTL)
+        self.ttl.update(ttl or {})
+        os.makedirs(directory, exist_ok=True)
+
+    def _paths(self, url: str):
+        key = hashlib.sha256(url.encode()).hexdigest()
+        path = os.path.join(self.directory, key)
+        return path + '.json', path + '.body'
+
+    def _write(self, path: str, data: Union[bytes, str]) -> None:
+        # write then rename, so that concurrent readers never see partial data
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wb' if isinstance(data, bytes) else 'wt') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def get(self, url: str, *, source: str = 'default'):
+        meta_path, body_path = self._paths(url)
+        meta = None
+        if os.path.exists(meta_path) and os.path.exists(body_path):
+            with open(meta_path, 'rt') as f:
+                try:
+                    meta = json.load(f)
+                except json.JSONDecodeError:
+                    meta = None
+        headers = {}
+        if meta is not None:
+            ttl = self.ttl.get(source, self.ttl['default'])
+            if time.time() - meta['checked'] < ttl:
+                return CachedResponse(url, body_path, meta['encoding'])
+            if meta['etag']:
+                headers['If-None-Match'] = meta['etag']
+            if meta['last_modified']:
+                headers['If-Modified-Since'] = meta['last_modified']
+        import requests
+        try:
+            r = _request(url, headers)
+        except requests.RequestException as e:
+            if meta is None:
+                raise
+            console.log(f'HTTPCache> {url}: {e}. Using the stale copy.')
+            return CachedResponse(url, body_path, meta['encoding'])
+        if r.status_code == 304 and meta is not None:
+            meta['checked'] = time.time()
+            self._write(meta_path, json.dumps(meta))
+            return CachedResponse(url, body_path, meta['encoding'])
+        r.from_cache = False
+        if r.status_code == 200:
+            self._write(body_path, r.content)
+            self._write(meta_path, json.dumps({
+                'url': url,
+                'checked': time.time(),
+                'encoding': r.encoding or r.apparent_encoding,
+                'etag': r.headers.get('ETag', None),
+                'last_modified': r.headers.get('Last-Modified', None),
+            }))
+        return r
+
+
+_cache: Optional[HTTPCache] = None
+
+
+def enable_cache(directory: str, ttl: Optional[Dict[str, float]] = None) -> None:
+    '''
+    let all subsequent get() calls go through an on-disk cache.
+    '''
+    global _cache
+    _cache = HTTPCache(directory, ttl)
+
+
+def disable_cache() -> None:
+    global _cache
+    _cache = None
+
+
+def cache_enabled() -> bool:
+    return _cache is not None
+
+
+def get(url: str, *, source: str = 'default'):
+    '''
+    HTTP GET through the cache (if enabled). The returned object provides
+    .text, .content, .status_code, and .from_cache.
+    '''
+    if _cache is not None:
+        return _cache.get(url, source=source)
+    r = _request(url)
+    r.from_cache = False
+    return r
@@ -0,0 +1,139 @@
+'''
+MIT License
+
+Copyright (c) 2024 Mo Zhou <lumin@debian.org>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+import json
+import threading
+import time
+import pytest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeLLM(object):
+    '''
+    stands in for llm.Mistral7B in the backend. The reply tells how many
+    messages the LLM was given. "hang" is never answered, and "fail" raises
+    an error, e.g., out of memory.
+    '''
+    NAME = 'FakeLLM'
+    kwargs = {'max_new_tokens': 8, 'temperature': 0.7}
+
+    def __init__(self):
+        # sizes of the batches given to generate_batch
+        self.batches = []
+
+    class tok:
+        @staticmethod
+        def encode(text, add_special_tokens=False):
+            return text.split()
+
+    def _reply(self, messages):
+        if messages[-1]['content'] == 'hang':
+            time.sleep(3600)
+        if messages[-1]['content'] == 'fail':
+            raise RuntimeError('out of memory')
+        return f'reply to {len(messages)} messages'
+
+    def __call__(self, messages, session=None):
+        messages.append({'role': 'assistant',
+                         'content': self._reply(messages)})
+        return messages
+
+    def generate_batch(self, batch):
+        self.batches.append(len(batch))
+        return [self(messages) for messages in batch]
+
+    def generate_stream(self, messages, session=None):
+        reply = self._reply(messages)
+        for piece in reply.split(' '):
+            yield piece + ' '
+        messages.append({'role': 'assistant', 'content': reply})
+
+
+class _OpenAIHandler(BaseHTTPRequestHandler):
+    '''
+    a fake OpenAI-compatible chat completions server. The reply echoes the
+    last user message. The first `rate_limited` requests are answered with
+    HTTP 429.
+    '''
+    delay = 0.0
+    rate_limited = 0
+    lock = threading.Lock()
+    requests = []
+    inflight = 0
+    max_inflight = 0
+
+    def do_POST(self):
+        cls = type(self)
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        with cls.lock:
+            cls.requests.append(body)
+            limited = len(cls.requests) <= cls.rate_limited
+            cls.inflight += 1
+            cls.max_inflight = max(cls.max_inflight, cls.inflight)
+        try:
+            time.sleep(cls.delay)
+            if limited:
+                payload = json.dumps({'error': {'message': 'slow down',
+                                                'type': 'rate_limit'}})
+                self._reply(429, payload.encode(), {'Retry-After': '0.1'})
+                return
+            content = body['messages'][-1]['content']
+            payload = {'id': 'chatcmpl-0', 'object': 'chat.completion',
+                       'created': 0, 'model': body['model'],
+                       'choices': [{'index': 0, 'finish_reason': 'stop',
+                                    'message': {'role': 'assistant',
+                                                'content': f'echo: {content}'}}],
+                       'usage': {'prompt_tokens': 1, 'completion_tokens': 1,
+                                 'total_tokens': 2}}
+            self._reply(200, json.dumps(payload).encode())
+        finally:
+            with cls.lock:
+                cls.inflight -= 1
+
+    def _reply(self, status, payload, headers={}):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def openai_server():
+    '''
+    yields the handler class (to tweak and inspect), with its base_url set
+    '''
+    handler = type('Handler', (_OpenAIHandler,), {
+        'requests': [], 'lock': threading.Lock()})
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    handler.base_url = f'http://127.0.0.1:{httpd.server_port}/v1'
+    yield handler
+    httpd.shutdown()
+    httpd.server_close()
@@ -0,0 +1,91 @@
+'''
+MIT License
+
+Copyright (c) 2024 Mo Zhou <lumin@debian.org>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+import pytest
+from debgpt import assembler
+
+
+def _block(caption: str, nlines: int) -> str:
+    lines = [caption, '```'] + [f'line {i:05d}' for i in range(nlines)]
+    return '\n'.join(lines + ['```', ''])
+
+
+@pytest.mark.parametrize('sizes,budget,expected', (
+    ([10, 20, 30], 100, [10, 20, 30]),
+    ([10, 200, 300], 210, [10, 100, 100]),
+    ([50, 50], 60, [30, 30]),
+))
+def test_allocate(sizes, budget, expected):
+    assert assembler.allocate(sizes, budget) == expected
+
+
+@pytest.mark.parametrize('head', (1.0, 0.5, 0.2))
+def test_truncate(head):
+    text = _block('The following is a file named x:', 10000)
+    short = assembler.truncate(text, 500, head)
+    assert assembler.estimate_tokens(short) <= 500
+    lines = short.split('\n')
+    assert lines[:2] == ['The following is a file named x:', '```']
+    assert lines[-2:] == ['```', '']
+    assert 'lines omitted' in short
+    assert ('line 00000' in short) and (('line 09999' in short) == (head < 1))
+
+
+def test_fit():
+    small = ('file', _block('small', 10))
+    bts = ('bts', _block('bts', 10000))
+    man = ('man', _block('man', 10000))
+    texts = assembler.fit([small, bts, man], 2000)
+    assert texts[0] == small[1]
+    assert sum(assembler.estimate_tokens(x) for x in texts) <= 2000
+    # the newest part of the BTS page is kept preferably
+    assert 'line 09999' in texts[1] and 'line 01000' not in texts[1]
+    # nothing happens when everything fits
+    assert assembler.fit([small, small], 2000) == [small[1], small[1]]
+
+
+def test_context_window():
+    import argparse
+
+    class _ZMQFrontend:
+        def __init__(self, llm):
+            self.llm = llm
+
+        def info(self):
+            return {'llm': self.llm, 'kwargs': {}}
+
+    def _args(**kwargs):
+        return argparse.Namespace(**dict(
+            {'context_window': 0, 'frontend': 'openai',
+             'openai_model': 'gpt-4'}, **kwargs))
+    assert assembler.context_window(_args()) == 8192
+    assert assembler.context_window(_args(context_window=100)) == 100
+    assert assembler.context_window(_args(openai_model='unknown')) is None
+    assert 'unknown' in assembler._unknown
+    # the model that the backend runs
+    assert assembler.context_window(_args(
+        frontend='zmq', frontend_instance=_ZMQFrontend('Mixtral8x7B'))) \
+        == 32768
+    assert assembler.context_window(_args(
+        frontend='zmq', frontend_instance=_ZMQFrontend('Llama'))) is None
+    assert assembler.context_window(_args(frontend='zmq')) is None
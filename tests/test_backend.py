@@ -0,0 +1,190 @@
+'''
+MIT License
+
+Copyright (c) 2024 Mo Zhou <lumin@debian.org>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+import argparse
+import copy
+import json
+import multiprocessing
+import socket
+import threading
+import pytest
+import zmq
+from conftest import FakeLLM
+from debgpt import backend, frontend
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _args(port: int, batch_size: int = 1,
+          batch_window: float = 10) -> argparse.Namespace:
+    return argparse.Namespace(host='tcp://127.0.0.1', port=port,
+                              batch_size=batch_size, batch_window=batch_window,
+                              kv_cache=0, prefix_cache=0)
+
+
+def _serve(port: int) -> None:
+    backend.ZMQBackend(_args(port), model=FakeLLM()).server()
+
+
+@pytest.fixture
+def server():
+    '''
+    a backend serving in a thread. The requests it receives are recorded.
+    '''
+    port = _free_port()
+    b = backend.ZMQBackend(_args(port), model=FakeLLM())
+    b.requests = []
+    resolve = b.resolve
+
+    def _resolve(request):
+        b.requests.append(copy.deepcopy(request))
+        return resolve(request)
+    b.resolve = _resolve
+    threading.Thread(target=b.server, daemon=True).start()
+    yield b, f'tcp://127.0.0.1:{port}'
+
+
+def _frontend(address, tmp_path):
+    return frontend.ZMQFrontend(argparse.Namespace(
+        zmq_backend=address, debgpt_home=str(tmp_path)))
+
+
+def test_delta_in_order(server, tmp_path):
+    b, address = server
+    f = _frontend(address, tmp_path)
+    assert f.query('hello') == 'reply to 1 messages'
+    assert f.query('again') == 'reply to 3 messages'
+    assert f.synced == 4 and b.sessions[str(f.uuid)] == f.session
+    # only the new message is sent
+    assert [(x['seq'], len(x['messages'])) for x in b.requests] \
+        == [(0, 1), (2, 1)]
+    f.stream = False
+    assert f.query('third') == 'reply to 5 messages'
+
+
+def test_resync_on_gap(server, tmp_path):
+    b, address = server
+    f = _frontend(address, tmp_path)
+    f.query('hello')
+    # e.g., a reply that the backend sent, but the client did not record
+    f.synced = 1
+    assert f.query('again') == 'reply to 3 messages'
+    assert [(x['seq'], len(x['messages'])) for x in b.requests] \
+        == [(0, 1), (1, 2), (0, 3)]
+    assert f.synced == 4 and b.sessions[str(f.uuid)] == f.session
+
+
+def test_evicted_session(server, tmp_path):
+    b, address = server
+    b.max_sessions = 2
+    fs = [_frontend(address, tmp_path) for _ in range(3)]
+    for f in fs:
+        f.query('hello')
+    assert list(b.sessions) == [str(fs[1].uuid), str(fs[2].uuid)]
+    # the oldest conversation has to be resent
+    assert fs[0].query('again') == 'reply to 3 messages'
+    assert b.requests[-1]['seq'] == 0
+    assert str(fs[1].uuid) not in b.sessions
+
+
+def test_backend_restart(tmp_path):
+    port = _free_port()
+    mp = multiprocessing.get_context('spawn')
+    proc = mp.Process(target=_serve, args=(port,), daemon=True)
+    proc.start()
+    f = _frontend(f'tcp://127.0.0.1:{port}', tmp_path)
+    try:
+        assert f.query('hello') == 'reply to 1 messages'
+        proc.kill()
+        proc.join()
+        proc = mp.Process(target=_serve, args=(port,), daemon=True)
+        proc.start()
+        # the new backend does not have the conversation
+        assert f.query('again') == 'reply to 3 messages'
+        assert f.synced == 4
+    finally:
+        proc.kill()
+
+
+def test_batched_stream(tmp_path):
+    port = _free_port()
+    b = backend.ZMQBackend(_args(port, batch_size=2, batch_window=5000),
+                           model=FakeLLM())
+    threading.Thread(target=b.server, daemon=True).start()
+    fs = [_frontend(f'tcp://127.0.0.1:{port}', tmp_path) for _ in range(2)]
+    replies = []
+    threads = [threading.Thread(target=lambda f=f: replies.append(
+        f.query('hello'))) for f in fs]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+    # the streaming clients were served together
+    assert replies == ['reply to 1 messages'] * 2
+    assert b.llm.batches == [2]
+
+
+@pytest.mark.parametrize('stream', [True, False])
+def test_generation_error(server, tmp_path, stream):
+    b, address = server
+    f = _frontend(address, tmp_path)
+    f.stream = stream
+    assert f.query('hello') == 'reply to 1 messages'
+    with pytest.raises(RuntimeError, match='out of memory'):
+        f.query('fail')
+    # the server keeps serving, and the conversation is resent
+    f.session.pop()
+    assert f.query('again') == 'reply to 3 messages'
+    assert b.requests[-1]['seq'] == 0
+
+
+def test_malformed_request(server):
+    b, address = server
+    sock = zmq.Context.instance().socket(zmq.REQ)
+    sock.connect(address)
+    for request in (b'{not json', b'42', b'{"messages": "hello"}',
+                    b'{"uuid": "x", "seq": 0, "messages": [{"role": 1}]}'):
+        sock.send(request)
+        assert 'error' in json.loads(sock.recv())
+    assert 'x' not in b.sessions
+    sock.send_string(json.dumps([{'role': 'user', 'content': 'hello'}]))
+    assert json.loads(sock.recv())[-1]['content'] == 'reply to 1 messages'
+    sock.close()
+
+
+def test_legacy_and_info(server):
+    b, address = server
+    sock = zmq.Context.instance().socket(zmq.REQ)
+    sock.connect(address)
+    sock.send_string(json.dumps([{'role': 'user', 'content': 'hello'}]))
+    reply = json.loads(sock.recv())
+    assert reply[-1] == {'role': 'assistant',
+                         'content': 'reply to 1 messages'}
+    sock.send_string(json.dumps({'info': True}))
+    assert json.loads(sock.recv()) == {'llm': 'FakeLLM',
+                                       'kwargs': FakeLLM.kwargs}
+    sock.close()
@@ -0,0 +1,101 @@
+'''
+MIT License
+
+Copyright (c) 2024 Mo Zhou <lumin@debian.org>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+import json
+import pytest
+from debgpt import batch
+from debgpt import cli
+from debgpt import web
+
+
+@pytest.fixture(autouse=True)
+def _reset_http_cache():
+    yield
+    web.disable_cache()
+
+
+def _manifest(tmp_path, jobs):
+    for name in ('a.txt', 'b.txt'):
+        (tmp_path / name).write_text(f'content of {name}\n')
+    path = tmp_path / 'jobs.jsonl'
+    path.write_text('\n'.join(json.dumps(x) for x in jobs) + '\n')
+    return str(path)
+
+
+def _results(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_job_args(tmp_path):
+    ag = cli.parse_args(['-F', 'dryrun', '--debgpt_home', str(tmp_path)])
+    job = {'id': 'x', 'file': ['a', 'b'], 'policy': '4.6', 'ask': ':summary'}
+    jag, order = batch.job_args(ag, job)
+    assert order == ['file', 'file', 'policy']
+    assert jag.file == ['a', 'b'] and jag.policy == ['4.6']
+    assert jag.ask == ':summary' and jag.bts == []
+    # without id, the job is identified by its content
+    path = _manifest(tmp_path, [{'file': 'a.txt'}, {'file': 'b.txt'}])
+    ids = [job['id'] for job in batch.load_manifest(path)]
+    assert len(set(ids)) == 2
+    bad = _manifest(tmp_path, [{'file': 'a.txt', 'typo': 1}])
+    with pytest.raises(ValueError):
+        batch.load_manifest(bad)
+
+
+def test_batch_dryrun(tmp_path):
+    path = _manifest(tmp_path, [{'id': 'a', 'file': str(tmp_path / 'a.txt'),
+                                 'ask': 'what is it?'}])
+    results = str(tmp_path / 'out.jsonl')
+    with pytest.raises(SystemExit):
+        cli.main(['-F', 'dryrun', '--debgpt_home', str(tmp_path),
+                  'batch', path, results])
+    record, = _results(results)
+    assert 'content of a.txt' in record['prompt']
+    assert record['prompt'].endswith('what is it?')
+
+
+def test_batch_openai(tmp_path, openai_server):
+    jobs = [{'id': 'a', 'file': str(tmp_path / 'a.txt'), 'ask': 'A?'},
+            {'id': 'b', 'file': str(tmp_path / 'b.txt'), 'ask': 'B?'},
+            {'id': 'c', 'file': str(tmp_path / 'missing.txt')}]
+    path = _manifest(tmp_path, jobs)
+    argv = ['-F', 'openai', '--openai_base_url', openai_server.base_url,
+            '--openai_api_key', 'sk-fake', '--debgpt_home', str(tmp_path),
+            'batch', path]
+    with pytest.raises(SystemExit):
+        cli.main(argv)
+    records = {x['id']: x for x in _results(tmp_path / 'jobs.results.jsonl')}
+    assert records['a']['reply'].startswith('echo: ')
+    assert records['a']['reply'].endswith('A?')
+    assert records['b']['error'] is None
+    assert records['c']['reply'] is None and records['c']['error']
+    assert len(openai_server.requests) == 2
+    # re-run: only the failed job is tried again
+    (tmp_path / 'missing.txt').write_text('now it exists\n')
+    with pytest.raises(SystemExit):
+        cli.main(argv)
+    records = _results(tmp_path / 'jobs.results.jsonl')
+    assert len(records) == 4
+    assert records[-1]['id'] == 'c' and records[-1]['error'] is None
+    assert len(openai_server.requests) == 3
@@ -0,0 +1,198 @@
+'''
+MIT License
+
+Copyright (c) 2024 Mo Zhou <lumin@debian.org>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+import argparse
+import json
+import os
+import socket
+import threading
+import time
+import pytest
+import zmq
+from conftest import FakeLLM
+from debgpt import backend, broker, frontend
+
+
+def _echo_worker(args, address, identity):
+    '''
+    a worker without LLM. It replies with its identity after args['delay']
+    seconds. It crashes on the first "crash" message, and on every "poison"
+    message.
+    '''
+    sock = zmq.Context().socket(zmq.DEALER)
+    sock.setsockopt(zmq.IDENTITY, identity)
+    sock.connect(address)
+    sock.send(broker.READY)
+    while True:
+        frames = sock.recv_multipart()
+        envelope, request = frames[:-1], json.loads(frames[-1])
+        content = request['messages'][-1]['content']
+        if content == 'crash' and not os.path.exists(args['crash_flag']):
+            open(args['crash_flag'], 'w').close()
+            os._exit(1)
+        if content == 'poison':
+            raise RuntimeError('poisoned')
+        time.sleep(args['delay'])
+        sock.send_multipart(envelope + [b'token', identity])
+        message = {'role': 'assistant', 'content': identity.decode()}
+        sock.send_multipart(envelope + [json.dumps(
+            {'seq': request['seq'] + 2, 'message': message}).encode()])
+
+
+def _fake_worker(args, address, identity):
+    '''
+    a backend.ZMQWorker serving FakeLLM
+    '''
+    worker = backend.ZMQWorker(argparse.Namespace(**args), address, identity,
+                               model=FakeLLM())
+    worker.server()
+
+
+def _broker(target, **kwargs):
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    args = argparse.Namespace(host='tcp://127.0.0.1', port=port, workers=2,
+                              worker_devices='', device='cpu', batch_size=1,
+                              batch_window=10, kv_cache=0, prefix_cache=0,
+                              **kwargs)
+    b = broker.Broker(args, target=target)
+    b.health_interval = 0.1
+    thread = threading.Thread(target=b.server, daemon=True)
+    thread.start()
+    deadline = time.time() + 30
+    while not all(w.ready for w in b.workers) and time.time() < deadline:
+        time.sleep(0.05)
+    return f'tcp://127.0.0.1:{port}', b
+
+
+def _stop(b):
+    for worker in b.workers:
+        if worker.process is not None:
+            worker.process.terminate()
+
+
+@pytest.fixture
+def endpoint(tmp_path):
+    address, b = _broker(_echo_worker, delay=0.3,
+                         crash_flag=str(tmp_path / 'crashed'))
+    yield address, b
+    _stop(b)
+
+
+@pytest.fixture
+def fake_endpoint():
+    address, b = _broker(_fake_worker, worker_timeout=1.0)
+    yield address, b
+    _stop(b)
+
+
+def _ask(address, content, uuid='conversation'):
+    sock = zmq.Context.instance().socket(zmq.DEALER)
+    sock.connect(address)
+    request = {'uuid': uuid, 'seq': 0, 'stream': True,
+               'messages': [{'role': 'user', 'content': content}]}
+    sock.send_multipart([b'', json.dumps(request).encode()])
+    return sock
+
+
+def _reply(sock, timeout=30000):
+    frames = []
+    while sock.poll(timeout):
+        frames.append(sock.recv_multipart()[1:])
+        if frames[-1][0] != b'token':
+            break
+    sock.close()
+    return frames
+
+
+def test_broker_dispatch(endpoint):
+    address, b = endpoint
+    socks = [_ask(address, f'hello {i}', uuid=f'c{i}') for i in range(4)]
+    replies = [_reply(s) for s in socks]
+    # streamed token, then the reply
+    assert all(len(x) == 2 and x[0][0] == b'token' for x in replies)
+    workers = [json.loads(x[-1][0])['message']['content'] for x in replies]
+    # least loaded: both workers served the concurrent requests
+    assert len(set(workers)) == 2
+    # the conversation sticks to its worker
+    again = _reply(_ask(address, 'again', uuid='c0'))
+    assert json.loads(again[-1][0])['message']['content'] == workers[0]
+    assert all(not w.inflight for w in b.workers)
+
+
+def test_broker_restart(endpoint):
+    address, b = endpoint
+    # both go to the same worker
+    crash = _ask(address, 'crash')
+    time.sleep(0.1)
+    queued = _ask(address, 'queued')
+    # the request being processed fails. the queued one is sent again.
+    assert 'exited' in json.loads(_reply(crash)[-1][0])['error']
+    assert json.loads(_reply(queued)[-1][0])['seq'] == 2
+    assert sum(w.generation for w in b.workers) == 3
+
+
+def test_broker_poison(endpoint):
+    address, b = endpoint
+    reply = _reply(_ask(address, 'poison'))
+    # not sent again to crash the other workers
+    assert 'exited with code 1' in json.loads(reply[-1][0])['error']
+    reply = _reply(_ask(address, 'hello', uuid='other'))
+    assert json.loads(reply[-1][0])['seq'] == 2
+    time.sleep(0.5)
+    assert sum(w.generation for w in b.workers) == 3
+
+
+def _frontend(address, tmp_path):
+    return frontend.ZMQFrontend(argparse.Namespace(
+        zmq_backend=address, debgpt_home=str(tmp_path)))
+
+
+def test_broker_zmq_worker(fake_endpoint, tmp_path):
+    address, b = fake_endpoint
+    fs = [_frontend(address, tmp_path) for _ in range(2)]
+    for f in fs:
+        assert f.query('hello') == 'reply to 1 messages'
+    fs[0].stream = False
+    for f in fs:
+        # the worker keeps the conversation: only the new message is sent
+        assert f.query('again') == 'reply to 3 messages'
+        assert f.synced == 4
+    assert all(not w.inflight for w in b.workers)
+
+
+def test_broker_worker_timeout(fake_endpoint, tmp_path):
+    address, b = fake_endpoint
+    f = _frontend(address, tmp_path)
+    with pytest.raises(RuntimeError, match='no progress'):
+        f.query('hang')
+    # the other worker keeps serving, and the wedged one is restarted
+    for _ in range(4):
+        g = _frontend(address, tmp_path)
+        assert g.query('hello') == 'reply to 1 messages'
+    deadline = time.time() + 30
+    while not all(w.ready for w in b.workers) and time.time() < deadline:
+        time.sleep(0.05)
+    assert all(w.ready for w in b.workers)
+    assert sum(w.generation for w in b.workers) == 3
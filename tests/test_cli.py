@@ -21,8 +21,20 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 '''
+import asyncio
+import threading
+import time
 import pytest
-from debgpt.cli import main
+from debgpt.cli import main, _run_loaders, parse_args, parse_args_order
+from debgpt.cli import gather_information_ordered
+from debgpt import web
+
+
+@pytest.fixture(autouse=True)
+def _reset_http_cache():
+    # main() enables the process-wide HTTP cache
+    yield
+    web.disable_cache()
 
 
 @pytest.mark.parametrize('cmd', (
@@ -37,3 +49,68 @@ from debgpt.cli import main
 def test_cli_system_exit(cmd: str):
     with pytest.raises(SystemExit):
         main(cmd.split())
+
+
+def test_gather_parallel(tmp_path):
+    argv = ['-F', 'dryrun', '-A', ':summary']
+    for i in range(6):
+        path = tmp_path / f'file{i}.txt'
+        path.write_text(f'content of file {i}\n' * (i + 1))
+        argv.extend(['-f', str(path)])
+    prompts = []
+    for jobs in ('1', '4'):
+        full = argv + ['--jobs', jobs]
+        ag = parse_args(full)
+        prompts.append(gather_information_ordered(None, ag, parse_args_order(full)))
+    assert prompts[0] == prompts[1]
+    assert prompts[0].index('file0.txt') < prompts[0].index('file5.txt')
+
+
+def test_parse_args_order():
+    argv = ['-Hf', 'a', '--policy-search', 'x', '--bts', '1',
+            '--policy_search=y', '--devref-search', 'z', '--policy', '1']
+    assert parse_args_order(argv) == ['file', 'policy_search', 'bts',
+                                      'policy_search', 'devref_search', 'policy']
+    ag = parse_args(argv)
+    assert ag.policy_search == ['x', 'y'] and ag.devref_search == ['z']
+
+
+@pytest.mark.parametrize('jobs', [1, 3])
+def test_run_loaders(jobs):
+    lock = threading.Lock()
+    running, peak, order = [0], [0], []
+
+    def _enter(i):
+        with lock:
+            order.append(i)
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+
+    def _exit():
+        with lock:
+            running[0] -= 1
+
+    def _loader(i):
+        if i % 2:
+            async def _load():
+                _enter(i)
+                await asyncio.sleep(0.1)
+                _exit()
+                return str(i)
+        else:
+            def _load():
+                _enter(i)
+                time.sleep(0.1)
+                _exit()
+                return str(i)
+        return ('cmd', str(i), _load)
+    start = time.time()
+    infos = _run_loaders([_loader(i) for i in range(6)], jobs)
+    assert infos == [str(i) for i in range(6)]
+    # at most `jobs` at a time, coroutines and threads together
+    assert peak[0] == jobs
+    if jobs == 1:
+        # e.g., --cmd make --cmd 'cat build.log'
+        assert order == list(range(6))
+    else:
+        assert time.time() - start < 0.5
@@ -21,6 +21,11 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 '''
+import asyncio
+import os
+import shutil
+import subprocess
+import time
 import pytest
 from debgpt import debian
 
@@ -51,3 +56,68 @@ def test_html(url):
     print(debian.html(url, raw=False))
 
 
+
+
+def test_command_line():
+    text = debian.command_line('printf a\\nb\\n')
+    assert text.splitlines()[1:4] == ['```', 'a', 'b']
+    with pytest.raises(subprocess.CalledProcessError):
+        debian.command_line('false')
+
+
+@pytest.mark.parametrize('limits, note', (
+    ({'max_lines': 100}, 'truncated at 100 lines'),
+    ({'max_bytes': 1000}, 'truncated at 1000 bytes'),
+    ({'timeout': 0.5}, 'timed out after 0.5s'),
+))
+def test_command_line_budget(limits, note):
+    cmd = ['sh', '-c', 'seq 1000; sleep 10'] if 'timeout' in limits \
+        else ['yes']
+    start = time.time()
+    lines, timed_out = asyncio.run(debian._arun_cmdline(cmd, **limits))
+    assert timed_out == ('timeout' in limits)
+    assert time.time() - start < 5
+    assert note in lines[-1]
+    assert len(lines) <= 1002
+
+
+def test_command_line_concurrent():
+    async def _run():
+        return await asyncio.gather(*[
+            debian.acommand_line('sleep 0.5') for _ in range(4)])
+    start = time.time()
+    asyncio.run(_run())
+    assert time.time() - start < 1.5
+
+
+def test_man_cache(tmp_path):
+    if shutil.which('man') is None or asyncio.run(debian._man_key('man')) is None:
+        pytest.skip('man page unavailable')
+    first = debian.man('man', debgpt_home=str(tmp_path))
+    assert len(list((tmp_path / 'cmd_cache').iterdir())) == 1
+    assert debian.man('man', debgpt_home=str(tmp_path)) == first
+
+
+def test_man_concurrent(tmp_path, monkeypatch):
+    # a slow man, whose pages are the files in tmp_path
+    bindir = tmp_path / 'bin'
+    bindir.mkdir()
+    script = bindir / 'man'
+    script.write_text('#!/bin/sh\nsleep 0.5\n'
+                      + 'if [ "$1" = -w ]; then echo %s/$2.1; '
+                      'else cat %s/$1.1; fi\n' % (tmp_path, tmp_path))
+    script.chmod(0o755)
+    monkeypatch.setenv('PATH', f'{bindir}:{os.environ["PATH"]}')
+    names = [f'page{i}' for i in range(8)]
+    for name in names:
+        (tmp_path / f'{name}.1').write_text(f'manual of {name}\n')
+
+    async def _run():
+        return await asyncio.gather(*[
+            debian.aman(x, debgpt_home=str(tmp_path)) for x in names])
+    start = time.time()
+    pages = asyncio.run(_run())
+    # man -w does not block the other loaders either
+    assert time.time() - start < 2.5
+    assert all(f'manual of {x}' in page for (x, page) in zip(names, pages))
+    assert len(list((tmp_path / 'cmd_cache').iterdir())) == 8
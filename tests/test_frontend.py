@@ -0,0 +1,179 @@
+'''
+MIT License
+
+Copyright (c) 2024 Mo Zhou <lumin@debian.org>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+import argparse
+import os
+import pytest
+from debgpt import frontend
+
+
+def _frontend(openai_server, tmp_path, cls=frontend.AsyncOpenAIFrontend,
+              response_cache=False):
+    args = argparse.Namespace(openai_api_key='sk-fake',
+                              openai_base_url=openai_server.base_url,
+                              openai_model='gpt-4', temperature=0.5,
+                              top_p=1.0, verbose=True,
+                              debgpt_home=str(tmp_path),
+                              response_cache=response_cache,
+                              no_response_cache=False, response_cache_size=1)
+    return cls(args)
+
+
+def test_query_many(openai_server, tmp_path):
+    openai_server.delay = 0.1
+    f = _frontend(openai_server, tmp_path)
+    questions = [f'question {i}' for i in range(10)]
+    results = f.query_many(questions, max_concurrency=3)
+    assert [x['reply'] for x in results] == [f'echo: {q}' for q in questions]
+    assert all(x['error'] is None for x in results)
+    assert all(x['latency'] >= 0.1 for x in results)
+    assert results[0]['messages'][0]['role'] == 'system'
+    assert results[0]['messages'][-1]['role'] == 'assistant'
+    assert openai_server.max_inflight == 3
+    # the interactive session is not affected
+    assert len(f.session) == 1
+
+
+@pytest.mark.parametrize('max_retries, error', [(5, False), (1, True)])
+def test_query_many_rate_limit(openai_server, tmp_path, max_retries, error):
+    openai_server.rate_limited = 2
+    f = _frontend(openai_server, tmp_path)
+    f.max_retries = max_retries
+    session = [{'role': 'user', 'content': 'hello'}]
+    result, = f.query_many([session])
+    if error:
+        assert result['reply'] is None
+        assert 'RateLimitError' in result['error']
+    else:
+        assert result['reply'] == 'echo: hello'
+        # Retry-After: 0.1 was honored
+        assert result['retries'] == 2 and result['latency'] >= 0.2
+        assert result['messages'][:1] == session
+
+
+def test_response_cache(openai_server, tmp_path):
+    f = _frontend(openai_server, tmp_path, frontend.OpenAIFrontend,
+                  response_cache=True)
+    f.stream = False
+    assert f.query('hello') == 'echo: hello'
+    assert len(openai_server.requests) == 1
+    # same conversation in a new process
+    f = _frontend(openai_server, tmp_path, frontend.OpenAIFrontend,
+                  response_cache=True)
+    f.stream = False
+    assert f.query('hello') == 'echo: hello'
+    assert len(f.session) == 3
+    assert len(openai_server.requests) == 1
+    # a follow-up is a different conversation
+    assert f.query('again') == 'echo: again'
+    assert len(openai_server.requests) == 2
+    # so are different sampling parameters
+    f.kwargs['temperature'] = 0.0
+    f.reset()
+    f.query([{'role': 'user', 'content': 'hello'}])
+    assert len(openai_server.requests) == 3
+    # the async frontend shares the cache
+    f = _frontend(openai_server, tmp_path, response_cache=True)
+    result, = f.query_many(['hello'])
+    assert result['reply'] == 'echo: hello'
+    assert len(openai_server.requests) == 3
+
+
+def test_minimal_args(openai_server, tmp_path):
+    # e.g., the __main__ block of frontend.py, or third-party callers
+    args = argparse.Namespace(openai_api_key='sk-fake',
+                              openai_base_url=openai_server.base_url,
+                              openai_model='gpt-4', temperature=0.5,
+                              top_p=1.0, verbose=False,
+                              debgpt_home=str(tmp_path))
+    f = frontend.OpenAIFrontend(args)
+    assert f.response_cache is None
+
+
+def test_zmq_cache_params(tmp_path):
+    import json
+    import threading
+    import zmq
+    router = zmq.Context.instance().socket(zmq.ROUTER)
+    port = router.bind_to_random_port('tcp://127.0.0.1')
+    infos = [{'llm': 'Mistral7B', 'kwargs': {'temperature': 0.7}},
+             {'llm': 'Mixtral8x7B', 'kwargs': {'temperature': 0.7}}]
+
+    def _backend():
+        for info in infos:
+            frames = router.recv_multipart()
+            assert json.loads(frames[-1]) == {'info': True}
+            router.send_multipart(frames[:-1] + [json.dumps(info).encode()])
+    thread = threading.Thread(target=_backend, daemon=True)
+    thread.start()
+    keys = []
+    for temperature in (0.5, 0.5, 0.0):
+        args = argparse.Namespace(zmq_backend=f'tcp://127.0.0.1:{port}',
+                                  debgpt_home=str(tmp_path),
+                                  temperature=temperature, top_p=1.0)
+        f = frontend.ZMQFrontend(args)
+        if temperature == 0.0:
+            f.backend_info = infos[0]
+        keys.append(frontend.ResponseCache.key([], f.cache_params()))
+        # asked only once
+        keys.append(frontend.ResponseCache.key([], f.cache_params()))
+    thread.join(10)
+    router.close()
+    # another backend model, or other sampling parameters
+    assert keys[0] == keys[1] and keys[2] == keys[3] and keys[4] == keys[5]
+    assert len({keys[0], keys[2], keys[4]}) == 3
+
+
+def test_response_cache_eviction(tmp_path):
+    cache = frontend.ResponseCache(str(tmp_path), max_bytes=100)
+    keys = [cache.key([{'role': 'user', 'content': str(i)}], {}) for i in range(3)]
+    cache.put(keys[0], 'x' * 30)
+    cache.put(keys[1], 'y' * 30)
+    # make keys[0] the most recently used one
+    os.utime(cache._path(keys[1]), ns=(0, 0))
+    assert cache.get(keys[0]) == 'x' * 30
+    cache.put(keys[2], 'z' * 30)
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) == 'x' * 30
+    assert cache.get(keys[2]) == 'z' * 30
+
+
+def test_journal_resume(openai_server, tmp_path):
+    f = _frontend(openai_server, tmp_path, frontend.OpenAIFrontend)
+    f.stream = False
+    f('hello')
+    path = tmp_path / f'{f.uuid}.jsonl'
+    # the turn is in the journal before the session ends
+    assert len(path.read_text().splitlines()) == 3
+    f('again')
+    f.dump()
+    assert len(path.read_text().splitlines()) == 5
+    # resume the conversation in another frontend
+    g = _frontend(openai_server, tmp_path, frontend.OpenAIFrontend)
+    g.stream = False
+    g.resume(str(path))
+    assert g.uuid == f.uuid and g.session == f.session
+    assert g('third') == 'echo: third'
+    assert openai_server.requests[-1]['messages'][:5] == f.session
+    g.dump()
+    assert len(path.read_text().splitlines()) == 7
@@ -0,0 +1,94 @@
+'''
+MIT License
+
+Copyright (c) 2024 Mo Zhou <lumin@debian.org>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+import os
+import time
+import pytest
+from debgpt import debian
+from debgpt import htmltext
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+BTS_FIXTURES = {'1056388': 'bts_1056388.html',
+                'src:pytorch': 'bts_src_pytorch.html'}
+
+
+class _Response(object):
+    from_cache = True
+    status_code = 200
+
+    def __init__(self, text: str):
+        self.text = text
+
+
+@pytest.fixture
+def saved_pages(monkeypatch):
+    # serve the saved fixtures instead of the real bugs.debian.org
+    def _get(url, *, source='default'):
+        name = BTS_FIXTURES.get(url.rsplit('/', 1)[-1], 'bts_1056388.html')
+        with open(os.path.join(FIXTURES, name), 'rt') as f:
+            return _Response(f.read())
+    monkeypatch.setattr(debian.web, 'get', _get)
+    default = htmltext.extractor
+    yield
+    htmltext.set_extractor(default)
+
+
+def _load_with(extractor, func, *args):
+    htmltext.set_extractor(extractor)
+    return func(*args)
+
+
+@pytest.mark.parametrize('idx', tuple(BTS_FIXTURES.keys()))
+def test_extractors_bts(idx, saved_pages):
+    pytest.importorskip('lxml')
+    reference = _load_with('bs4', debian.bts, idx)
+    assert reference == _load_with('lxml', debian.bts, idx)
+    assert 'Message #5 received' not in reference
+
+
+def test_extractors_html(saved_pages):
+    pytest.importorskip('lxml')
+    url = 'https://bugs.debian.org/1056388'
+    reference = _load_with('bs4', debian.html, url)
+    assert reference == _load_with('lxml', debian.html, url)
+    assert 'Message #5 received' in reference
+
+
+def test_extractor_benchmark(saved_pages, repeat: int = 5):
+    '''
+    run `PYTHONPATH=. python3 tests/test_htmltext.py` for a longer benchmark.
+    '''
+    for name in sorted(set(BTS_FIXTURES.values())):
+        with open(os.path.join(FIXTURES, name), 'rt') as f:
+            page = f.read()
+        for extractor in htmltext.EXTRACTORS:
+            htmltext.set_extractor(extractor)
+            start = time.perf_counter()
+            for _ in range(repeat):
+                htmltext.get_text(page, drop=(('p', 'msgreceived'),))
+            elapsed = (time.perf_counter() - start) / repeat
+            print(f'{name} ({len(page)} bytes) {extractor}: {1000*elapsed:.2f}ms')
+
+
+if __name__ == '__main__':
+    test_extractor_benchmark(None, repeat=50)
@@ -0,0 +1,65 @@
+'''
+MIT License
+
+Copyright (c) 2024 Mo Zhou <lumin@debian.org>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+import json
+from debgpt import journal
+
+
+def _lines(path):
+    with open(path) as f:
+        return [json.loads(x) for x in f]
+
+
+def test_journal(tmp_path):
+    path = str(tmp_path / 'session.jsonl')
+    log = journal.Journal(path)
+    session = [{'role': 'user', 'content': 'hi'}]
+    log.sync(session)
+    session.append({'role': 'assistant', 'content': 'hello'})
+    log.sync(session)
+    log.sync(session)
+    # only the new messages are appended
+    assert _lines(path) == session
+    # reset, then a new conversation in the same session
+    session = [{'role': 'user', 'content': 'again'}]
+    log.sync(session)
+    log.close()
+    assert _lines(path)[2] == {'reset': True}
+    assert journal.load(path) == session
+    # resume: the loaded messages are not journaled twice
+    session = journal.load(path)
+    log = journal.Journal(path, session)
+    session.append({'role': 'assistant', 'content': 'welcome back'})
+    log.sync(session)
+    log.close()
+    assert len(_lines(path)) == 5
+    assert journal.load(path)[-1]['content'] == 'welcome back'
+
+
+def test_journal_truncated(tmp_path):
+    path = tmp_path / 'session.jsonl'
+    path.write_text(json.dumps({'role': 'user', 'content': 'hi'}) + '\n'
+                    + '{"role": "assist')
+    assert journal.load(str(path)) == [{'role': 'user', 'content': 'hi'}]
+    assert journal.locate(str(path), str(tmp_path)) == str(path)
+    assert journal.locate('session', str(tmp_path)) == str(path)
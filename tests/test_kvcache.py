@@ -0,0 +1,130 @@
+'''
+MIT License
+
+Copyright (c) 2024 Mo Zhou <lumin@debian.org>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+import pytest
+from debgpt import kvcache
+
+
+@pytest.mark.parametrize('a, b, n', [
+    ([], [1, 2], 0),
+    ([1, 2, 3], [1, 2, 3], 3),
+    ([1, 2, 3], [1, 2, 4, 5], 2),
+    ([1, 2, 3, 4], [1, 2], 2),
+    ([5], [1], 0),
+])
+def test_common_prefix(a, b, n):
+    assert kvcache.common_prefix(a, b) == n
+
+
+def test_session_cache_reuse():
+    cache = kvcache.SessionCache(max_bytes=100)
+    assert cache.take('a', [1, 2, 3]) == (0, None)
+    cache.put('a', [1, 2, 3, 4], 'states-a', 10)
+    # follow-up turn: the previous prompt and reply are a prefix
+    assert cache.take('a', [1, 2, 3, 4, 5, 6]) == (4, 'states-a')
+    # taken out while in use
+    assert len(cache) == 0 and cache.nbytes == 0
+    cache.put('a', [1, 2, 3, 4, 5, 6, 7], 'states-a2', 12)
+    # re-tokenization may differ near the end of the previous reply
+    assert cache.take('a', [1, 2, 3, 4, 9]) == (4, 'states-a2')
+    cache.put('a', [1, 2], 'states-a3', 10)
+    assert cache.take('a', [7, 8]) == (0, None)
+    assert (cache.hits, cache.misses) == (2, 2)
+    # no session, no caching
+    cache.put(None, [1], 'x', 1)
+    assert cache.take(None, [1]) == (0, None)
+
+
+def test_session_cache_eviction():
+    cache = kvcache.SessionCache(max_bytes=100)
+    cache.put('a', [1], 'states-a', 40)
+    cache.put('b', [2], 'states-b', 40)
+    cache.put('a', [1, 1], 'states-a', 40)
+    # 'b' is the least recently used one
+    cache.put('c', [3], 'states-c', 40)
+    assert list(cache.entries) == ['a', 'c']
+    assert cache.nbytes == 80
+    # too large to be cached at all
+    cache.put('d', [4], 'states-d', 101)
+    assert list(cache.entries) == ['a', 'c']
+
+
+def _radix(max_bytes=1000):
+    # the "states" of a run of tokens are the tokens themselves
+    return kvcache.RadixCache(max_bytes, slice=lambda s, a, b: s[a:b],
+                              nbytes=len)
+
+
+def _joined(segments):
+    return [x for segment in segments for x in segment]
+
+
+def test_radix_cache_shared_prefix():
+    cache = _radix()
+    system = [1, 2, 3, 4]
+    assert cache.match(system + [5, 6]) == (0, [])
+    cache.insert(system + [5, 6], system + [5, 6, 7])
+    cache.insert(system + [8, 9], system + [8, 9])
+    # the system message is stored once
+    assert cache.nbytes == 8
+    matched, segments = cache.match(system + [8, 10])
+    assert matched == 5 and _joined(segments) == system + [8]
+    matched, segments = cache.match(system + [5, 6, 11])
+    assert matched == 6 and _joined(segments) == system + [5, 6]
+    # split in the middle of an edge
+    cache.insert([1, 2, 7], [1, 2, 7])
+    assert cache.nbytes == 9
+    for ids in ([1, 2, 3, 4, 5, 6], [1, 2, 3, 4, 8, 9], [1, 2, 7]):
+        matched, segments = cache.match(ids)
+        assert matched == len(ids) and _joined(segments) == ids
+    assert (cache.hits, cache.misses) == (5, 1)
+    assert cache.hit_tokens == 5 + 6 + 6 + 6 + 3
+
+
+def test_radix_cache_split_long_match():
+    # the partial match of an edge is at least as long as its tail
+    cache = _radix()
+    for ids in ([1, 2, 3, 4, 5, 7], [1, 2, 3, 4, 8], [1, 2, 5, 6]):
+        cache.insert(ids, ids)
+    for ids in ([1, 2, 3, 4, 5, 7], [1, 2, 3, 4, 8], [1, 2, 5, 6]):
+        matched, segments = cache.match(ids)
+        assert matched == len(ids) and _joined(segments) == ids
+    matched, segments = cache.match([1, 2, 3, 4, 5, 6])
+    assert matched == 5 and _joined(segments) == [1, 2, 3, 4, 5]
+    assert cache.nbytes == 9
+
+
+def test_radix_cache_eviction():
+    cache = _radix(max_bytes=10)
+    cache.insert([1, 2, 3, 4], [1, 2, 3, 4])
+    cache.insert([1, 2, 5, 6], [1, 2, 5, 6])
+    cache.insert([7, 8, 9], [7, 8, 9])
+    assert cache.nbytes == 9
+    # touch [1, 2, 3, 4], so that [1, 2, 5, 6] is the least recently used
+    cache.match([1, 2, 3, 4])
+    cache.match([7, 8, 9])
+    cache.insert([10, 11, 12], [10, 11, 12])
+    assert cache.nbytes == 10
+    assert cache.match([1, 2, 5, 6])[0] == 2
+    assert cache.match([1, 2, 3, 4])[0] == 4
+    assert cache.match([10, 11, 12])[0] == 3
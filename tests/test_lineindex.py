@@ -0,0 +1,86 @@
+'''
+MIT License
+
+Copyright (c) 2024 Mo Zhou <lumin@debian.org>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+import os
+import pytest
+from debgpt import lineindex
+from debgpt.debian import _load_file, file
+
+
+RANGES = [(None, None), (0, 10), (5, 7), (100, 120), (999, None), (-1, None),
+          (-500, None), (None, -3), (-20, -10), (100, -100), (3, 2),
+          (5000, None), (-5000, 10), (0, 0)]
+
+
+@pytest.mark.parametrize('content', (
+    ''.join(f'line {i}  \n' for i in range(1000)),
+    ''.join(f'line {i}\r\n' for i in range(1000)) + 'no newline at the end',
+    '\n' * 300,
+    'x' * 100000 + '\n' + 'y' * 10,
+    '',
+    # progress bars: a bare \r also ends a line in text mode
+    ''.join(f'step {i}\r' + ('done\n' if i % 7 == 0 else '')
+            for i in range(1000)),
+    ''.join(('\r\n', '\r', '\n', '\r\r\n', 'x')[i % 5] * (i % 3 + 1)
+            for i in range(2000)) + '\r',
+    '\r' * 300,
+))
+def test_read_lines(tmp_path, monkeypatch, content):
+    # small chunks, so that the ranges span many of them
+    monkeypatch.setattr(lineindex, 'CHUNK', 64)
+    monkeypatch.setattr(lineindex, 'CACHE_MIN_BYTES', 0)
+    path = tmp_path / 'build.log'
+    path.write_bytes(content.encode())
+    expected = _load_file(str(path))
+    for start, end in RANGES:
+        got = lineindex.read_lines(str(path), start, end,
+                                   str(tmp_path / 'cache'))
+        assert got == expected[start:end], (start, end)
+
+
+def test_index_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(lineindex, 'CACHE_MIN_BYTES', 0)
+    path = tmp_path / 'build.log'
+    path.write_text(''.join(f'line {i}\n' for i in range(100)))
+    cache = tmp_path / 'cache'
+    assert lineindex.read_lines(str(path), 10, 12, str(cache)) \
+        == ['line 10', 'line 11']
+    assert len(os.listdir(cache)) == 1
+    # the index is rebuilt when the file changes
+    path.write_text(''.join(f'new line {i}\n' for i in range(100)))
+    assert lineindex.read_lines(str(path), 10, 12, str(cache)) \
+        == ['new line 10', 'new line 11']
+    # tail ranges do not need the index
+    cache2 = tmp_path / 'cache2'
+    assert lineindex.read_lines(str(path), -2, None, str(cache2)) \
+        == ['new line 98', 'new line 99']
+    assert not cache2.exists()
+
+
+def test_file_range(tmp_path):
+    path = tmp_path / 'setup.py'
+    path.write_text(''.join(f'line {i}\n' for i in range(100)))
+    text = file(f'{path}:-3-', debgpt_home=str(tmp_path))
+    assert text.split('\n')[2:5] == ['line 97', 'line 98', 'line 99']
+    text = file(f'{path}:10-12')
+    assert text.split('\n')[2:4] == ['line 10', 'line 11']
@@ -0,0 +1,181 @@
+'''
+MIT License
+
+Copyright (c) 2024 Mo Zhou <lumin@debian.org>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+import copy
+import os
+import pytest
+th = pytest.importorskip('torch')
+llm = pytest.importorskip('debgpt.llm')
+
+
+@pytest.fixture(scope='module')
+def tiny(tmp_path_factory):
+    '''
+    a tiny randomly initialized model in the Mistral architecture, and a
+    word level tokenizer, saved like a model from the hub
+    '''
+    from tokenizers import Tokenizer, models, pre_tokenizers, decoders
+    from transformers import PreTrainedTokenizerFast
+    from transformers import MistralConfig, MistralForCausalLM
+    words = ['<unk>', '<s>', '</s>', 'user', 'assistant', 'system'] + \
+        [chr(ord('a') + i) for i in range(26)]
+    tokenizer = Tokenizer(models.WordLevel(
+        {w: i for (i, w) in enumerate(words)}, unk_token='<unk>'))
+    tokenizer.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    tokenizer.decoder = decoders.WordPiece()
+    tok = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, unk_token='<unk>', bos_token='<s>',
+        eos_token='</s>', model_input_names=['input_ids', 'attention_mask'])
+    tok.chat_template = "{% for m in messages %}{{ m['role'] }} " \
+        "{{ m['content'] }} {% endfor %}" \
+        "{% if add_generation_prompt %}assistant{% endif %}"
+    th.manual_seed(0)
+    model = MistralForCausalLM(MistralConfig(
+        vocab_size=len(words), hidden_size=16, intermediate_size=32,
+        num_hidden_layers=2, num_attention_heads=2, num_key_value_heads=1,
+        bos_token_id=1, eos_token_id=2))
+    path = str(tmp_path_factory.mktemp('tiny'))
+    model.save_pretrained(path)
+    tok.save_pretrained(path)
+    return path
+
+
+@pytest.fixture
+def mistral(tiny, monkeypatch):
+    '''
+    creates llm.Mistral7B instances of the tiny model, on the CPU, with
+    greedy decoding
+    '''
+    monkeypatch.setattr(llm.Mistral7B, 'model_id', tiny)
+
+    def _create(**kwargs):
+        model = llm.Mistral7B(device='cpu', precision='fp32', **kwargs)
+        model.kwargs = {'max_new_tokens': 6, 'do_sample': False,
+                        'pad_token_id': 2}
+        return model
+    return _create
+
+
+CONVERSATIONS = [
+    [{'role': 'user', 'content': 'a'}],
+    [{'role': 'user', 'content': 'b c d e f g h'}],
+    [{'role': 'system', 'content': 'i'}, {'role': 'user', 'content': 'j k'}],
+]
+
+
+@pytest.mark.parametrize('is_pipeline', [True, False])
+def test_generate_batch(mistral, monkeypatch, is_pipeline):
+    monkeypatch.setattr(llm.Mistral7B, 'is_pipeline', is_pipeline)
+    model = mistral()
+    # decoder-only models pad on the left, with the eos token
+    assert model.tok.padding_side == 'left'
+    assert model.tok.pad_token_id == model.kwargs['pad_token_id'] == 2
+    alone = [model.generate_batch([copy.deepcopy(x)])[0][-1]
+             for x in CONVERSATIONS]
+    assert all(x['role'] == 'assistant' and x['content'] for x in alone)
+    # padding does not change the replies of the shorter conversations
+    batch = model.generate_batch(copy.deepcopy(CONVERSATIONS))
+    assert [x[-1] for x in batch] == alone
+
+
+def test_prepared_mark(tmp_path):
+    expected = {'model_id': 'm', 'revision': 'r1', 'precision': 'fp16',
+                'dtype': 'torch.float16'}
+    assert llm.matches(dict(expected, transformers='4.41'), expected)
+    for key, value in (('model_id', 'other'), ('revision', 'r2'),
+                       ('dtype', 'torch.float32')):
+        assert not llm.matches(dict(expected, **{key: value}), expected)
+    # the model is not in the local huggingface cache
+    assert llm.matches(expected, dict(expected, revision=None))
+    assert llm.read_mark(str(tmp_path)) is None
+    (tmp_path / llm.PREPARED_MARK).write_text('{"model_id": ')
+    assert llm.read_mark(str(tmp_path)) is None
+
+
+def test_prepare(mistral, tiny, tmp_path, monkeypatch):
+    import argparse
+    import json
+    args = argparse.Namespace(llm='Mistral7B', device='cpu',
+                              precision='fp32', max_new_tokens=4,
+                              debgpt_home=str(tmp_path))
+    monkeypatch.setattr(llm, '_revision', lambda model_id: 'r1')
+    path = llm.prepare(args)
+    mark = llm.read_mark(path)
+    assert mark['model_id'] == tiny and mark['revision'] == 'r1'
+    assert mark['dtype'] == 'torch.float32'
+
+    def _source():
+        return llm.create_llm(args).model.config._name_or_path
+    # loaded from the prepared weights
+    assert _source() == path
+
+    def _stale(**kwargs):
+        with open(os.path.join(path, llm.PREPARED_MARK), 'wt') as f:
+            json.dump(dict(mark, **kwargs), f)
+    for stale in ({'model_id': 'other'}, {'revision': 'r0'},
+                  {'dtype': 'torch.float16'}):
+        _stale(**stale)
+        # loaded from the model, and prepared again
+        assert _source() == tiny
+        assert llm.read_mark(path) == mark
+        assert _source() == path
+    # a new revision of the model
+    monkeypatch.setattr(llm, '_revision', lambda model_id: 'r2')
+    assert _source() == tiny
+    assert llm.read_mark(path)['revision'] == 'r2'
+    assert not [x for x in os.listdir(os.path.dirname(path))
+                if x.endswith('.tmp')]
+
+
+@pytest.mark.parametrize('cache', ['kv', 'prefix', 'both'])
+def test_generate_cached(mistral, cache):
+    model = mistral()
+    reused = []
+
+    def _spy(func):
+        def _wrapper(*args):
+            result = func(*args)
+            reused.append(result[0])
+            return result
+        return _wrapper
+    if cache in ('kv', 'both'):
+        model.enable_kv_cache(2**20)
+        model.kv_cache.take = _spy(model.kv_cache.take)
+    if cache in ('prefix', 'both'):
+        model.enable_prefix_cache(2**20)
+        model.prefix_cache.match = _spy(model.prefix_cache.match)
+    conversation = [{'role': 'system', 'content': 'a b c d e f'},
+                    {'role': 'user', 'content': 'g h'}]
+    for turn in range(3):
+        # the same reply as without the cache
+        expected = model.generate_batch([copy.deepcopy(conversation)])
+        if turn == 1:
+            generated = list(model.generate_stream(conversation, 'session'))
+            assert ''.join(generated) == conversation[-1]['content']
+        else:
+            model.generate(conversation, 'session')
+        assert conversation == expected[0]
+        conversation.append({'role': 'user', 'content': 'i j k'})
+    # the earlier turns were reused, from each cache
+    first = 2 if cache == 'both' else 1
+    assert not any(reused[:first]) and all(reused[first:])
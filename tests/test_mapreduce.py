@@ -0,0 +1,97 @@
+'''
+MIT License
+
+Copyright (c) 2024 Mo Zhou <lumin@debian.org>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+from debgpt import frontend, mapreduce
+from debgpt.cli import parse_args, parse_args_order, gather_information_ordered
+
+
+class _Summarizer(object):
+    '''
+    answers every prompt with a short reply
+    '''
+    def __init__(self):
+        self.prompts = []
+
+    def query_many(self, prompts, max_concurrency=None):
+        self.prompts.extend(prompts)
+        return [{'messages': [], 'reply': f'answer {len(self.prompts)}',
+                 'error': None, 'latency': 0.0, 'retries': 0, 'usage': None}
+                for _ in prompts]
+
+
+def _block(n: int) -> str:
+    lines = [f'line {i} of the log' for i in range(n)]
+    return '\n'.join(['The following is the content of build.log:', '```']
+                     + lines + ['```', ''])
+
+
+def test_split():
+    text = _block(1000)
+    chunks = mapreduce.split(text, 500)
+    assert len(chunks) > 1
+    assert all(mapreduce.estimate_tokens(x) <= 500 for x in chunks)
+    assert all(x.startswith('The following is the content') for x in chunks)
+    body = [line for x in chunks for line in x.split('\n')[2:-2]]
+    assert body == text.split('\n')[2:-2]
+    # a single line longer than the budget
+    chunks = mapreduce.split('x' * 10000, 500)
+    assert ''.join(chunks) == 'x' * 10000
+
+
+def test_run():
+    f = _Summarizer()
+    blocks = [('file', 'small.txt', 'small file'),
+              ('file', 'build.log', _block(5000))]
+    texts = mapreduce.run(f, blocks, 'why did the build fail?', 2000)
+    assert texts[0] == 'small file'
+    assert 'answer 1' in texts[1] and 'line 0 of' not in texts[1]
+    assert all(x.endswith('why did the build fail?') for x in f.prompts)
+    assert 'part 1 of' in f.prompts[0]
+    # everything fits
+    f = _Summarizer()
+    assert mapreduce.run(f, blocks[:1], 'why?', 2000) == ['small file']
+    assert not f.prompts
+
+
+def test_run_combine():
+    f = _Summarizer()
+    f.query_many = lambda prompts, max_concurrency=None: [
+        {'messages': [], 'reply': 'long answer ' * 100, 'error': None,
+         'latency': 0.0, 'retries': 0, 'usage': None} for _ in prompts]
+    texts = mapreduce.run(f, [('cmd', 'make', _block(20000))], 'why?', 3000)
+    assert mapreduce.estimate_tokens(texts[0]) <= 3000
+
+
+def test_cli_map_reduce(openai_server, tmp_path):
+    path = tmp_path / 'build.log'
+    path.write_text('\n'.join(f'line {i}' for i in range(3000)))
+    argv = ['-F', 'openai', '--openai_base_url', openai_server.base_url,
+            '--openai_api_key', 'sk-fake', '--debgpt_home', str(tmp_path),
+            '--context_window', '2000', '--map_reduce', '-f', str(path),
+            '-A', 'why did the build fail?']
+    ag = parse_args(argv)
+    ag.frontend_instance = frontend.create_frontend(ag)
+    assert isinstance(ag.frontend_instance, frontend.AsyncOpenAIFrontend)
+    msg = gather_information_ordered(None, ag, parse_args_order(argv))
+    assert len(openai_server.requests) > 1
+    assert 'Answer 1 of' in msg and msg.endswith('why did the build fail?')
@@ -36,3 +36,99 @@ def test_policy(section):
 def test_devref(section):
     devref = DebianDevref()
     print(devref[section])
+
+
+_DOCUMENT = '''\
+Debian Policy Manual
+********************
+
+1. About this manual
+********************
+
+Intro text.
+
+1.1. Scope
+==========
+
+Scope text.
+
+1.2. New versions
+=================
+
+Versions text.
+
+1.2.1. Details
+--------------
+
+Details text.
+
+2. The Debian Archive
+*********************
+
+2.1. DFSG
+=========
+
+Last text.
+'''
+
+
+def _linear_lookup(lines, index):
+    # the original linear scan, used as the reference implementation
+    sep = {1: '***', 2: '===', 3: '---'}[len(index.split('.'))]
+    ret, prev, in_range = [], '', False
+    for cursor in lines:
+        if cursor.startswith(sep) and prev.startswith(f'{index}. '):
+            ret.extend([prev, cursor])
+            in_range = True
+        elif cursor.startswith(sep) and in_range:
+            ret.pop(-1)
+            break
+        elif in_range:
+            ret.append(cursor)
+        prev = cursor
+    return '\n'.join(ret)
+
+
+@pytest.mark.parametrize('section', ('1', '1.1', '1.2', '1.2.1', '2', '2.1', '3'))
+def test_policy_index(section, tmp_path):
+    cache = tmp_path / 'policy.txt'
+    cache.write_text(_DOCUMENT)
+    policy = DebianPolicy(str(cache))
+    assert (tmp_path / 'policy.txt.idx').exists()
+    assert policy[section] == _linear_lookup(_DOCUMENT.splitlines(), section)
+
+
+def test_policy_index_rebuild(tmp_path):
+    cache = tmp_path / 'policy.txt'
+    cache.write_text(_DOCUMENT)
+    assert 'Scope text.' in DebianPolicy(str(cache))['1.1']
+    cache.write_text(_DOCUMENT.replace('Scope text.', 'Changed scope.'))
+    assert 'Changed scope.' in DebianPolicy(str(cache))['1.1']
+
+
+def test_policy_shared(tmp_path):
+    cache = tmp_path / 'policy.txt'
+    cache.write_text(_DOCUMENT)
+    policy = DebianPolicy.shared(str(cache))
+    assert DebianPolicy.shared(str(cache)) is policy
+    assert bytes(policy.view('1.1')).startswith(b'1.1. Scope\n')
+    # replacing the document invalidates the shared instance
+    tmp = tmp_path / 'policy.txt.new'
+    tmp.write_text(_DOCUMENT + '\nTrailer.\n')
+    tmp.replace(cache)
+    assert DebianPolicy.shared(str(cache)) is not policy
+    assert DebianPolicy.shared(str(cache))['2.1'].endswith('Trailer.')
+
+
+def test_policy_search(tmp_path):
+    cache = tmp_path / 'policy.txt'
+    cache.write_text(_DOCUMENT.replace('Versions text.', 'New versions of the policy.'))
+    policy = DebianPolicy(str(cache))
+    # the chunks are disjoint: a section ends where its first subsection starts
+    assert policy.section('1') == '1. About this manual\n' + '*' * 20 + '\n\nIntro text.\n'
+    assert policy.section('1.2.1') == '1.2.1. Details\n' + '-' * 14 + '\n\nDetails text.\n'
+    assert policy.search('scope', k=3) == ['1.1']
+    assert policy.search('versions', k=3)[0] == '1.2'
+    assert (tmp_path / 'policy.txt.bm25').exists()
+    # the stored index is reused
+    assert DebianPolicy(str(cache)).search('dfsg') == ['2.1']
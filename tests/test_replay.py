@@ -0,0 +1,76 @@
+'''
+MIT License
+
+Copyright (c) 2024 Mo Zhou <lumin@debian.org>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+import json
+import pytest
+from debgpt import replay
+
+
+def _messages(n):
+    roles = ('user', 'assistant')
+    return [{'role': roles[i % 2], 'content': f'message {i}\n' + 'x' * (i * 7)}
+            for i in range(n)]
+
+
+@pytest.mark.parametrize('indent', [None, 2])
+@pytest.mark.parametrize('chunk_size', [1, 7, 4096])
+def test_iter_json_array(tmp_path, indent, chunk_size):
+    messages = _messages(50)
+    path = tmp_path / 'session.json'
+    path.write_text(json.dumps(messages, indent=indent))
+    assert list(replay._iter_json_array(str(path), chunk_size)) == messages
+    path.write_text('[]')
+    assert list(replay._iter_json_array(str(path), chunk_size)) == []
+    path.write_text(json.dumps(messages)[:-20])
+    with pytest.raises((ValueError, json.JSONDecodeError)):
+        list(replay._iter_json_array(str(path), chunk_size))
+
+
+@pytest.mark.parametrize('block', [1, 5, 2**16])
+def test_reversed_lines(tmp_path, block):
+    path = tmp_path / 'lines.txt'
+    lines = [b'first', b'', b'x' * 100, b'last']
+    path.write_bytes(b'\n'.join(lines) + b'\n')
+    assert list(replay._reversed_lines(str(path), block)) == \
+        [b'last', b'x' * 100, b'first']
+
+
+@pytest.mark.parametrize('suffix', ['.json', '.jsonl'])
+def test_select(tmp_path, suffix):
+    messages = _messages(20)
+    path = tmp_path / f'session{suffix}'
+    if suffix == '.json':
+        path.write_text(json.dumps(messages))
+    else:
+        records = messages[:10] + [{'reset': True}] + messages[10:]
+        path.write_text(''.join(json.dumps(x) + '\n' for x in records)
+                        + '{"role": "user", "cont')
+    path = str(path)
+    assert [x['content'] for x in replay.select(path, tail=3)] == \
+        [x['content'] for x in messages[-3:]]
+    assert list(replay.select(path, grep=r'message 1\d')) == messages[10:20]
+    assert list(replay.select(path, grep='message 1', tail=2)) == messages[18:]
+    assert list(replay.select(path, tail=0)) == []
+    assert list(replay.select(path, tail=-1)) == []
+    everything = list(replay.select(path))
+    assert [x for x in everything if 'reset' not in x] == messages
@@ -0,0 +1,49 @@
+'''
+MIT License
+
+Copyright (c) 2024 Mo Zhou <lumin@debian.org>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+import pytest
+from debgpt import retrieval
+
+
+@pytest.mark.parametrize('text, terms', [
+    ('The Packages file', ['package', 'file']),
+    ('Build-Depends on python3-numpy', ['build-depend', 'python3-numpy']),
+    ('library dependencies', ['library', 'dependency']),
+])
+def test_tokenize(text, terms):
+    assert retrieval.tokenize(text) == terms
+
+
+def test_bm25():
+    chunks = [('a', 'maintainer scripts: preinst, postinst, prerm, postrm'),
+              ('b', 'the copyright file must be in machine-readable format'),
+              ('c', 'maintainer scripts must be idempotent. '
+               'maintainer scripts are run by dpkg.'),
+              ('d', 'the changelog file records the changes')]
+    bm25 = retrieval.BM25.build(chunks)
+    assert [k for (k, _) in bm25.search('maintainer scripts', k=3)] == ['c', 'a']
+    assert bm25.search('copyright file', k=1)[0][0] == 'b'
+    assert bm25.search('nothing matches this', k=3) == []
+    # the index survives a round trip through JSON
+    again = retrieval.BM25.from_json(bm25.to_json())
+    assert again.search('changelog') == bm25.search('changelog')
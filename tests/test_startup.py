@@ -0,0 +1,72 @@
+'''
+MIT License
+
+Copyright (c) 2024 Mo Zhou <lumin@debian.org>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+import subprocess
+import sys
+import pytest
+
+# modules that are slow to import, and not needed by the cases below
+_HEAVY = ('prompt_toolkit', 'requests', 'bs4', 'lxml', 'openai', 'zmq',
+          'debgpt.debian', 'debgpt.policy', 'debgpt.htmltext')
+# budget (microseconds) for `import debgpt.cli`, including rich. It took
+# about 200ms before the imports were made lazy, and about 50ms after.
+_BUDGET = 120_000
+
+
+def _importtime(code: str):
+    '''
+    run code in a fresh interpreter with -X importtime. returns the
+    cumulative import time (us) of each imported module.
+    '''
+    p = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                       capture_output=True, text=True, timeout=60)
+    assert p.returncode == 0, p.stderr
+    modules = {}
+    for line in p.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = int(cumulative)
+    return modules
+
+
+def test_import_cli():
+    modules = _importtime('import debgpt.cli')
+    assert 'debgpt.cli' in modules
+    assert not [x for x in _HEAVY if x in modules]
+    # the fastest of three runs, to tolerate a busy machine
+    fastest = min([modules['debgpt.cli']] + [
+        _importtime('import debgpt.cli')['debgpt.cli'] for _ in range(2)])
+    assert fastest < _BUDGET
+
+
+@pytest.mark.parametrize('argv, heavy', [
+    (['--version'], _HEAVY),
+    (['-F', 'dryrun', '-f', __file__, '-A', 'hi'],
+     [x for x in _HEAVY if x != 'debgpt.debian']),
+])
+def test_startup(argv, heavy, tmp_path):
+    code = 'from debgpt import cli; cli.main(%r)' % (
+        argv + ['--debgpt_home', str(tmp_path)])
+    modules = _importtime(code)
+    assert not [x for x in heavy if x in modules]
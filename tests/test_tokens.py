@@ -0,0 +1,65 @@
+'''
+MIT License
+
+Copyright (c) 2024 Mo Zhou <lumin@debian.org>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+import pytest
+from debgpt import tokens
+
+
+def test_token_counter_incremental():
+    calls = []
+
+    def _encoder():
+        def _encode(text):
+            calls.append(text)
+            return text.split()
+        return _encode
+    counter = tokens.TokenCounter(_encoder)
+    session = [{'role': 'system', 'content': 'you are helpful'},
+               {'role': 'user', 'content': 'hello there'}]
+    first = counter(session)
+    assert first == 5 + 2 * counter.MESSAGE_OVERHEAD + counter.REPLY_OVERHEAD
+    session.append({'role': 'assistant', 'content': 'hi'})
+    assert counter(session) == first + 1 + counter.MESSAGE_OVERHEAD
+    # only the new message was tokenized
+    assert calls == ['you are helpful', 'hello there', 'hi']
+
+
+def test_token_counter_fallback():
+    def _broken():
+        raise FileNotFoundError('no tokenizer here')
+    counter = tokens.TokenCounter(_broken)
+    assert counter.count_text('x' * 40) == tokens.estimate_tokens('x' * 40)
+    assert counter([]) == 0
+
+
+def test_token_counter_tiktoken():
+    pytest.importorskip('tiktoken')
+    counter = tokens.TokenCounter(lambda: tokens.tiktoken_encoder('gpt-4'))
+    assert counter.count_text('hello world') > 0
+
+
+def test_tiktoken_special_tokens():
+    pytest.importorskip('tiktoken')
+    encode = tokens.tiktoken_encoder('gpt-4')
+    # e.g., a log or a source file mentioning a special token
+    assert len(encode('end of text: <|endoftext|>')) > 1
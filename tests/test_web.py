@@ -0,0 +1,176 @@
+'''
+MIT License
+
+Copyright (c) 2024 Mo Zhou <lumin@debian.org>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+import pytest
+import requests
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from debgpt import web
+from debgpt import debian
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # shared state of the stand-in server
+    body = b'<html><body><p>version one</p></body></html>'
+    etag = '"v1"'
+    hits = []
+
+    def do_GET(self):
+        self.hits.append(self.headers.get('If-None-Match', None))
+        if self.headers.get('If-None-Match', None) == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    _Handler.hits.clear()
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}'
+    httpd.shutdown()
+    httpd.server_close()
+    web.disable_cache()
+
+
+def test_http_cache_ttl(server, tmp_path):
+    cache = web.HTTPCache(str(tmp_path), ttl={'html': 3600})
+    r = cache.get(server + '/page', source='html')
+    assert not r.from_cache and 'version one' in r.text
+    r = cache.get(server + '/page', source='html')
+    assert r.from_cache and 'version one' in r.text
+    assert len(_Handler.hits) == 1
+
+
+def test_http_cache_concurrent(server, tmp_path):
+    # e.g., batch jobs fetching the same URL in a thread pool
+    cache = web.HTTPCache(str(tmp_path), ttl={'html': 0})
+    errors = []
+
+    def _get():
+        try:
+            assert 'version one' in cache.get(server + '/page',
+                                              source='html').text
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=_get) for _ in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    assert not [x for x in tmp_path.iterdir() if x.name.endswith('.tmp')]
+
+
+def test_http_cache_revalidate(server, tmp_path, monkeypatch):
+    cache = web.HTTPCache(str(tmp_path), ttl={'bts': 0})
+    cache.get(server + '/page', source='bts')
+    # unchanged: conditional request answered with 304
+    r = cache.get(server + '/page', source='bts')
+    assert r.from_cache and 'version one' in r.text
+    assert _Handler.hits == [None, '"v1"']
+    # changed: the new body replaces the cached one
+    monkeypatch.setattr(_Handler, 'body', b'<p>version two</p>')
+    monkeypatch.setattr(_Handler, 'etag', '"v2"')
+    r = cache.get(server + '/page', source='bts')
+    assert not r.from_cache and 'version two' in r.text
+    assert 'version two' in cache.get(server + '/page', source='html').text
+
+
+def test_http_cache_stale_if_error(server, tmp_path, monkeypatch):
+    cache = web.HTTPCache(str(tmp_path), ttl={'default': 0})
+    cache.get(server + '/page')
+
+    def _refuse(*args, **kwargs):
+        raise requests.ConnectionError('refused')
+    monkeypatch.setattr(web, '_request', _refuse)
+    # the server is gone, but the cached copy is still usable
+    r = cache.get(server + '/page')
+    assert r.from_cache and 'version one' in r.text
+
+
+def test_debian_html_cached(server, tmp_path):
+    web.enable_cache(str(tmp_path))
+    first = debian.html(server + '/page')
+    second = debian.html(server + '/page')
+    assert first == second
+    assert 'version one' in first
+    assert len(_Handler.hits) == 1
+
+
+class _FlakyHandler(BaseHTTPRequestHandler):
+    hits = []
+
+    def do_GET(self):
+        self.hits.append(self.path)
+        if self.path == '/slow':
+            time.sleep(1.0)
+        if self.path == '/flaky' and len(self.hits) < 3:
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def flaky_server():
+    _FlakyHandler.hits.clear()
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), _FlakyHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}'
+    httpd.shutdown()
+    httpd.server_close()
+    web.configure_session()
+
+
+def test_session_retry(flaky_server):
+    web.configure_session(retries=3, backoff=0.01)
+    r = web.get(flaky_server + '/flaky')
+    assert r.status_code == 200 and r.text == 'ok'
+    assert len(_FlakyHandler.hits) == 3
+
+
+def test_session_timeout(flaky_server):
+    web.configure_session(timeout=0.2, retries=0)
+    with pytest.raises(requests.RequestException):
+        web.get(flaky_server + '/slow')